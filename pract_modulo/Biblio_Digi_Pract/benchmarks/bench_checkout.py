@@ -0,0 +1,107 @@
+# Benchmark de contención del préstamo: una avalancha de usuarios pide a la vez el mismo libro (POST /Prestamos/) y se comprueba
+# que en cada ronda hay exactamente un préstamo concedido y el resto recibe un 409, midiendo el rendimiento y la latencia.
+#
+# Se ejecuta desde la carpeta del proyecto, con las mismas variables de entorno de BDD que la API:
+#   python -m benchmarks.bench_checkout --clients 200 --rounds 20
+# Por defecto la app se ejecuta dentro del propio proceso; con --url se ataca a una API ya levantada (uvicorn, docker...)
+from source_code.database import Local_Session
+from source_code.models import UserDB, Book_DB, Genre_DB, Loan_Item_DB
+from source_code.loans import return_statement
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+import httpx
+
+
+# Usuarios y libro del benchmark, creados directamente en la BDD para no pasar por el cifrado de contraseñas
+def setup(clients: int):
+    tag = uuid.uuid4().hex[:8]
+    with Local_Session() as db:
+        db.execute(pg_insert(Genre_DB).values(genre_name="Benchmark").on_conflict_do_nothing(index_elements=["genre_name"]))
+        genre_id = db.scalar(select(Genre_DB.genre_id).where(Genre_DB.genre_name=="Benchmark"))
+        book_ref = db.scalar(pg_insert(Book_DB).values(name=f"Libro popular {tag}", author="Autor Del Benchmark", genre_id=genre_id)
+                             .returning(Book_DB.ref_number))
+        user_ids = db.scalars(pg_insert(UserDB).values([{"full_name": "Usuario De Benchmark", "hashed_password": "-",
+                                                         "contact_mail": f"bench{tag}_{i}@example.com"} for i in range(clients)])
+                              .returning(UserDB.user_id)).all()
+        db.commit()
+    return book_ref, user_ids
+
+
+# Entre rondas se devuelve el libro directamente en la BDD, con la misma sentencia que las devoluciones de la API para que el
+# préstamo, el ejemplar y los contadores del libro queden igual que tras una devolución
+def reset(book_ref: int):
+    with Local_Session() as db:
+        db.execute(return_statement(Loan_Item_DB.book_ref_number==book_ref))
+        db.commit()
+
+
+async def flash_crowd(client, book_ref: int, user_ids: list):
+    async def one(user_id):
+        start = time.perf_counter()
+        response = await client.post("/Prestamos/", json={"user_id": user_id, "book_ref_number": book_ref})
+        return response.status_code, time.perf_counter() - start
+    return await asyncio.gather(*[one(user_id) for user_id in user_ids])
+
+
+async def run(args):
+    book_ref, user_ids = setup(args.clients)
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60)
+        lifespan = None
+    else:
+        from source_code.main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", limits=limits, timeout=60)
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+    latencies = []
+    statuses = {}
+    bad_rounds = 0
+    elapsed = 0.0
+    try:
+        for round_number in range(args.rounds):
+            reset(book_ref)
+            start = time.perf_counter()
+            results = await flash_crowd(client, book_ref, user_ids)
+            elapsed += time.perf_counter() - start
+            round_statuses = [code for code, _ in results]
+            for code in round_statuses:
+                statuses[code] = statuses.get(code, 0) + 1
+            latencies += [latency for _, latency in results]
+            winners = round_statuses.count(201)
+            if winners != 1 or round_statuses.count(409) != len(results) - 1:
+                bad_rounds += 1
+                print(f"Ronda {round_number}: {winners} préstamos concedidos, respuestas {sorted(set(round_statuses))}")
+    finally:
+        await client.aclose()
+        if lifespan:
+            await lifespan.__aexit__(None, None, None)
+        reset(book_ref)
+    latencies.sort()
+    total = len(latencies)
+    print(f"Rondas: {args.rounds}, clientes por ronda: {args.clients}, peticiones: {total}")
+    print(f"Respuestas: {dict(sorted(statuses.items()))}")
+    print(f"Rondas con un único ganador: {args.rounds - bad_rounds}/{args.rounds}")
+    print(f"Rendimiento: {total / elapsed:.0f} peticiones/s")
+    print(f"Latencia ms: media {statistics.mean(latencies) * 1000:.1f}, p50 {latencies[total // 2] * 1000:.1f}, "
+          f"p95 {latencies[int(total * 0.95)] * 1000:.1f}, p99 {latencies[int(total * 0.99)] * 1000:.1f}, "
+          f"máx {latencies[-1] * 1000:.1f}")
+    return bad_rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Contención de préstamos sobre un único libro")
+    parser.add_argument("--clients", type=int, default=200, help="peticiones simultáneas por ronda")
+    parser.add_argument("--rounds", type=int, default=20, help="número de rondas")
+    parser.add_argument("--url", default=None, help="URL de una API ya levantada, por defecto se ejecuta en este proceso")
+    args = parser.parse_args()
+    raise SystemExit(1 if asyncio.run(run(args)) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# Micro-benchmarks de los caminos de CPU de cada petición: los validadores de entrada (Book, Film, User, UserUpdate, Loan) con
+# datos válidos e inválidos, hash_password, Film_DB.actors_listing y pasar a JSON los objetos del ORM. En cada grupo se comparan
+# implementaciones (cómo valida FastAPI el cuerpo frente a model_validate_json, jsonable_encoder frente a los esquemas de
+# respuesta...) y el resultado se puede guardar como línea base y comparar con ella para detectar regresiones antes de desplegar.
+#
+# Cada caso se repite hasta llenar unas décimas de segundo por muestra y se toman varias muestras; se compara la mediana. Como
+# la línea base puede venir de otra máquina, los tiempos se comparan normalizados por un caso de referencia de Python puro que
+# mide la velocidad de la máquina (con --absolute se comparan tal cual). Los datos de entrada son siempre los mismos.
+#
+# No necesita BDD ni la API levantada:
+#   python -m benchmarks.bench_hot_paths                                   (compara con benchmarks/baseline_hot_paths.json)
+#   python -m benchmarks.bench_hot_paths --save benchmarks/baseline_hot_paths.json
+#   python -m benchmarks.bench_hot_paths --filter validators --max-regression 0.15
+from source_code.validators import Book, Film, User, UserUpdate, Loan, BookResponse, FilmResponse, LoanResponse, Page
+from source_code.models import Book_DB, Film_DB, Loan_DB
+from source_code.passwords import hash_password
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter, ValidationError
+from datetime import datetime, timedelta, timezone
+import argparse
+import platform
+import statistics
+import timeit
+import json
+import os
+import orjson
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline_hot_paths.json")
+REFERENCE = "referencia/python_puro"
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+BOOK = {"name": "Harry Potter y la piedra filosofal", "author": "Joanne Kathleen Rowling"}
+FILM = {"name": "El Señor de los Anillos: La Comunidad del Anillo", "actors": "Elijah Wood, Ian McKellen, Viggo Mortensen"}
+USER = {"full_name": "Ana Garcia Herrero", "contact_mail": "ana.garcia@example.com", "age": 24, "hashed_password": "ILOVEFLOWERS"}
+USER_UPDATE = {"full_name": "Mi Usuario Simple", "age": 27}
+LOAN = {"user_id": 2, "book_ref_number": 3, "film_ref_number": None}
+BAD_BOOK = {"name": "Harry Potter y la piedra filosofal", "author": "Joanne Rowling"}  # el autor no son tres palabras
+BAD_LOAN = {"user_id": 2, "book_ref_number": None, "film_ref_number": None}  # ni libro ni película
+CAST_SHORT = "Leonardo DiCaprio, Joseph Gordon-Levitt, Elliot Page"
+CAST_LONG = ", ".join(f"Actor Secundario {i}" for i in range(40)) + ", Actor Secundario 3, , Actor Secundario 7"
+
+
+def make_book(i: int):
+    return Book_DB(ref_number=i, name=f"Libro de prueba número {i}", author="Autora Con Un Nombre Bastante Largo", genre_id=1 + i % 20,
+                   total_copies=3, available_copies=i % 4, available=i % 4 > 0, date_registered=START + timedelta(minutes=i))
+
+
+def make_film(i: int, actors: str = CAST_SHORT):
+    return Film_DB(ref_number=i, name=f"Película de prueba número {i}", actors=actors, genre_id=1 + i % 20, total_copies=2,
+                   available_copies=i % 3, available=i % 3 > 0, date_registered=START + timedelta(minutes=i))
+
+
+def make_loan(i: int):
+    return Loan_DB(loan_id=i, loan_date=START + timedelta(hours=i), user_id=1 + i % 50, book_ref_number=i, film_ref_number=None,
+                   return_date=None)
+
+
+# Cómo llega el cuerpo a FastAPI: lo parsea con json.loads y valida el diccionario. model_validate_json lo hace todo en Rust
+def fastapi_body(model, body: bytes):
+    return model.model_validate(json.loads(body))
+
+
+def invalid(model, data: dict):
+    try:
+        model.model_validate(data)
+    except ValidationError:
+        return
+    raise AssertionError(f"{model.__name__} debería rechazar {data}")
+
+
+# Alternativa a split_actors + casting_listing con dict.fromkeys para quitar repetidos, para ver si compensaría cambiarla
+def actors_listing_fromkeys(actors: str):
+    names = list(dict.fromkeys(a for a in (a.strip() for a in actors.split(",")) if a))
+    listing = {"Info": "Film casting"} if names else {}
+    listing.update((f"A{i}", a) for i, a in enumerate(names))
+    return listing
+
+
+def reference():
+    total = 0
+    for i in range(1000):
+        total += i * i % 7
+    return total
+
+
+# Casos: (grupo/nombre, función sin argumentos). Las entradas se preparan fuera de la función para medir solo el camino
+def build_cases():
+    cases = {REFERENCE: reference}
+
+    for name, model, data in (("Book", Book, BOOK), ("Film", Film, FILM), ("User", User, USER), ("UserUpdate", UserUpdate, USER_UPDATE),
+                              ("Loan", Loan, LOAN)):
+        body = json.dumps(data).encode("utf-8")
+        cases[f"validators/{name}/fastapi"] = lambda model=model, body=body: fastapi_body(model, body)
+        cases[f"validators/{name}/model_validate_json"] = lambda model=model, body=body: model.model_validate_json(body)
+    cases["validators/Book/invalido"] = lambda: invalid(Book, BAD_BOOK)
+    cases["validators/Loan/invalido"] = lambda: invalid(Loan, BAD_LOAN)
+
+    for rounds in (4, 10):
+        cases[f"hashing/hash_password/rounds_{rounds}"] = lambda rounds=rounds: hash_password("ILOVEFLOWERS", rounds)
+
+    for label, actors in (("3_actores", CAST_SHORT), ("40_actores", CAST_LONG)):
+        film = make_film(1, actors)
+        assert film.actors_listing() == actors_listing_fromkeys(actors)
+        cases[f"actors_listing/{label}/actual"] = film.actors_listing
+        cases[f"actors_listing/{label}/fromkeys"] = lambda actors=actors: actors_listing_fromkeys(actors)
+
+    single = {"Book": (make_book(1), BookResponse), "Film": (make_film(1), FilmResponse), "Loan": (make_loan(1), LoanResponse)}
+    for name, (item, schema) in single.items():
+        adapter = TypeAdapter(schema)
+        cases[f"encoding/{name}/jsonable_encoder"] = lambda item=item: json.dumps(jsonable_encoder(item)).encode("utf-8")
+        cases[f"encoding/{name}/esquema_orjson"] = lambda item=item, adapter=adapter: orjson.dumps(
+            adapter.dump_python(adapter.validate_python(item, from_attributes=True), mode="json"))
+        cases[f"encoding/{name}/esquema_bytes"] = lambda item=item, adapter=adapter: adapter.dump_json(
+            adapter.validate_python(item, from_attributes=True))
+    page = {"items": [make_book(i) for i in range(1, 21)], "next_cursor": "WzIwXQ"}
+    page_adapter = TypeAdapter(Page[BookResponse])
+    cases["encoding/Page20/jsonable_encoder"] = lambda: json.dumps(jsonable_encoder(page)).encode("utf-8")
+    cases["encoding/Page20/esquema_bytes"] = lambda: page_adapter.dump_json(page_adapter.validate_python(page, from_attributes=True))
+    return cases
+
+
+# Mediana y mínimo en microsegundos por llamada. timeit desactiva el recolector de basura mientras mide
+def measure(function, sample_seconds: float, samples: int):
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= sample_seconds or number >= 10 ** 7:
+            break
+        number = max(number * 2, int(number * sample_seconds / max(elapsed, 1e-9)))
+    times = [timer.timeit(number) / number * 1e6 for _ in range(samples)]
+    return {"median_us": round(statistics.median(times), 4), "min_us": round(min(times), 4), "number": number}
+
+
+def machine():
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+            "cpus": os.cpu_count()}
+
+
+def compare(results: dict, baseline: dict, max_regression: float, absolute: bool, filtered: bool):
+    base = baseline["results"]
+    scale = 1.0
+    if not absolute and REFERENCE in base and REFERENCE in results:
+        scale = results[REFERENCE]["median_us"] / base[REFERENCE]["median_us"]
+        print(f"\nMáquina {scale:.2f} veces {'más lenta' if scale >= 1 else 'más rápida'} que la de la línea base (caso {REFERENCE})")
+    print(f"{'caso':<52}{'base µs':>11}{'ahora µs':>11}{'cambio':>9}")
+    regressions = []
+    for name, result in results.items():
+        if name == REFERENCE or name not in base:
+            continue
+        expected = base[name]["median_us"] * scale
+        change = result["median_us"] / expected - 1
+        flag = ""
+        if change > max_regression:
+            regressions.append(name)
+            flag = "  REGRESIÓN"
+        print(f"{name:<52}{expected:>11.2f}{result['median_us']:>11.2f}{change:>+9.0%}{flag}")
+    missing = sorted(set(base) - set(results) - {REFERENCE})
+    if missing and not filtered:
+        print(f"Casos de la línea base que no se han medido: {', '.join(missing)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de validadores, cifrado y serialización con línea base")
+    parser.add_argument("--filter", nargs="+", default=[], help="solo los casos que contienen alguno de estos textos")
+    parser.add_argument("--sample-seconds", type=float, default=0.2, help="segundos aproximados de cada muestra")
+    parser.add_argument("--samples", type=int, default=5, help="muestras por caso, se compara la mediana")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="línea base con la que comparar")
+    parser.add_argument("--save", help="guardar los resultados como línea base en este fichero")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="empeoramiento máximo admitido sobre la línea base (0.25 = 25%%)")
+    parser.add_argument("--absolute", action="store_true", help="comparar los tiempos sin normalizar por la velocidad de la máquina")
+    args = parser.parse_args()
+
+    cases = build_cases()
+    results = {}
+    print(f"{'caso':<52}{'mediana µs':>12}{'mínimo µs':>12}{'llamadas':>10}")
+    for name, function in cases.items():
+        if name != REFERENCE and args.filter and not any(text in name for text in args.filter):
+            continue
+        results[name] = measure(function, args.sample_seconds, args.samples)
+        print(f"{name:<52}{results[name]['median_us']:>12.2f}{results[name]['min_us']:>12.2f}{results[name]['number']:>10}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"machine": machine(), "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "results": results},
+                      f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Línea base guardada en {args.save}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No hay línea base en {args.baseline}, se crea con --save")
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.max_regression, args.absolute, bool(args.filter))
+    if regressions:
+        print(f"{len(regressions)} casos han empeorado más de un {args.max_regression:.0%}: {', '.join(regressions)}")
+        raise SystemExit(1)
+    print("Sin regresiones respecto a la línea base")
+
+
+if __name__ == "__main__":
+    main()
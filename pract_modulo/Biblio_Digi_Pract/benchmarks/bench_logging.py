@@ -0,0 +1,131 @@
+# Benchmark del coste del logging por petición: repite los mensajes que escribe una petición típica (traza de recibida/resuelta
+# más el mensaje con el resultado) con la configuración anterior (logging.basicConfig, f-strings y escritura síncrona) y con la
+# actual (argumentos sin formatear, cola y JSON escrito desde el hilo del QueueListener, con y sin muestreo), a nivel INFO y WARNING.
+# Mide el tiempo que pasa el hilo de la petición (el event loop) dentro del logging, la CPU total por petición contando la del
+# hilo de escritura y los bytes escritos. Con --write-delay-us cada escritura tarda además ese tiempo, como cuando stderr es una
+# tubería que el recolector de logs no vacía a tiempo.
+#
+# No necesita BDD ni la API levantada, la salida va a un fichero temporal:
+#   python -m benchmarks.bench_logging --requests 20000
+#   python -m benchmarks.bench_logging --requests 5000 --write-delay-us 200
+from source_code.logs import Log_Queue_Handler, Json_Formatter, Request_Id_Filter, Sampling_Filter, request_id_var
+from logging.handlers import QueueListener
+from uuid import uuid4
+import argparse
+import logging
+import queue
+import tempfile
+import time
+
+
+class Book:
+    name = "Harry Potter y la piedra filosofal"
+    ref_number = 10227
+
+
+# Los mensajes de una petición de alta de un libro, como estaban antes (f-strings, se formatean aunque no se escriban)
+def old_request(logger, book):
+    logger.info(f"Recibida petición para añadir a la BDD el libro {book.name}")
+    logger.info("Procesando el genero del libro pasado por parámetro")
+    logger.info(f"Libro {book.name} registrado en la BDD correctamente")
+    logger.info("Petición resuelta")
+
+
+# Los mismos mensajes como están ahora: la traza en su propio logger y los argumentos sin formatear
+def new_request(logger, request_logger, book):
+    request_logger.info("Recibida petición para añadir a la BDD el libro %s", book.name)
+    request_logger.info("Procesando el genero del libro pasado por parámetro")
+    logger.info("Libro %s registrado en la BDD correctamente", book.name)
+    request_logger.info("Petición resuelta")
+
+
+class Slow_Stream_Handler(logging.StreamHandler):
+
+    def __init__(self, stream, delay: float):
+        super().__init__(stream)
+        self.delay = delay
+
+    def emit(self, record):
+        super().emit(record)
+        if self.delay:
+            time.sleep(self.delay)
+
+
+def isolated_logger(name: str, level: str):
+    logger = logging.getLogger(name)
+    logger.handlers.clear()
+    logger.filters.clear()
+    logger.propagate = False
+    logger.setLevel(level)
+    return logger
+
+
+def run_requests(request_ids, call):
+    caller = 0.0
+    for request_id in request_ids:
+        token = request_id_var.set(request_id)
+        start = time.perf_counter()
+        call()
+        caller += time.perf_counter() - start
+        request_id_var.reset(token)
+    return caller
+
+
+def run_old(name: str, level: str, request_ids, output, delay: float):
+    logger = isolated_logger(name, level)
+    handler = Slow_Stream_Handler(output, delay)
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+    return run_requests(request_ids, lambda: old_request(logger, Book))
+
+
+def run_new(name: str, level: str, request_ids, output, delay: float, sampling: float):
+    logger = isolated_logger(name, level)
+    request_logger = isolated_logger(f"{name}.peticiones", level)
+    log_queue = queue.SimpleQueue()
+    handler = Log_Queue_Handler(log_queue)
+    handler.addFilter(Request_Id_Filter())
+    output_handler = Slow_Stream_Handler(output, delay)
+    output_handler.setFormatter(Json_Formatter())
+    listener = QueueListener(log_queue, output_handler)
+    for target in (logger, request_logger):
+        target.addHandler(handler)
+    if sampling < 1.0:
+        request_logger.addFilter(Sampling_Filter(sampling))
+    listener.start()
+    caller = run_requests(request_ids, lambda: new_request(logger, request_logger, Book))
+    listener.stop()  # espera a que el hilo de escritura vacíe la cola
+    return caller
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coste del logging por petición a nivel INFO y WARNING")
+    parser.add_argument("--requests", type=int, default=20000, help="peticiones simuladas por configuración")
+    parser.add_argument("--write-delay-us", type=float, default=0, help="espera extra en cada escritura (salida lenta)")
+    parser.add_argument("--runs", type=int, default=3, help="repeticiones de cada configuración, se queda con la mejor")
+    args = parser.parse_args()
+    delay = args.write_delay_us / 1e6
+
+    configurations = [("anterior (síncrono)", lambda name, level, ids, out: run_old(name, level, ids, out, delay)),
+                      ("cola + JSON", lambda name, level, ids, out: run_new(name, level, ids, out, delay, 1.0)),
+                      ("cola + JSON, muestreo 10%", lambda name, level, ids, out: run_new(name, level, ids, out, delay, 0.1))]
+    print(f"{'configuración':<28}{'nivel':<9}{'hilo µs/pet.':>13}{'CPU µs/pet.':>13}{'bytes/pet.':>12}")
+    for level in ("INFO", "WARNING"):
+        for index, (name, run) in enumerate(configurations):
+            best = None
+            for attempt in range(args.runs):
+                request_ids = [uuid4().hex for _ in range(args.requests)]
+                with tempfile.TemporaryFile("w+", encoding="utf-8") as output:
+                    cpu_start = time.process_time()
+                    caller = run(f"bench.{level}.{index}.{attempt}", level, request_ids, output)
+                    cpu = time.process_time() - cpu_start
+                    size = output.tell()
+                if best is None or caller < best[0]:
+                    best = (caller, cpu, size)
+            caller, cpu, size = best
+            print(f"{name:<28}{level:<9}{caller / args.requests * 1e6:>13.1f}{cpu / args.requests * 1e6:>13.1f}"
+                  f"{size / args.requests:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
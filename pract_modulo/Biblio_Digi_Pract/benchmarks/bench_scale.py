@@ -0,0 +1,189 @@
+# Curvas de latencia de las consultas de los endpoints según crece la BDD. Para cada escala carga los datos con seed_scale y
+# ejecuta muchas veces, con valores al azar, las mismas sentencias que lanzan get_user, get_book, loan_returned y delete_book.
+# Cada llamada va en su propia transacción y se deshace, así las devoluciones y los borrados no cambian los datos entre llamadas.
+# Al final se comparan p50/p95/p99 de cada caso entre escalas para ver qué consultas crecen con el volumen de datos.
+#
+# Se mide sin la API (sin HTTP, sin la caché de respuestas de get_book) con una sesión síncrona, para ver solo el coste de la BDD
+# y del ORM. Las sentencias por llamada se cuentan con los eventos del engine: si crecen con la escala es que el ORM está
+# cargando filas relacionadas.
+#
+# BORRA LOS DATOS DE LA BDD DE DB_NAME en cada escala (ver seed_scale), así que se usa con una BDD aparte. --reset solo hace falta
+# si la BDD ya tenía datos antes de empezar: desde la segunda escala se borran siempre los que ha cargado la escala anterior:
+#   DB_NAME=db_biblioteca_escala python -m benchmarks.bench_scale --create --reset --scales 0.001 0.01 0.1
+#   DB_NAME=db_biblioteca_escala python -m benchmarks.bench_scale --reset --scales 0.1 1 --output resultados/escala.json
+#   DB_NAME=db_biblioteca_escala python -m benchmarks.bench_scale --no-seed          (mide con los datos que ya tiene la BDD)
+from benchmarks.seed_scale import seed_database, scaled_sizes, create_database, FULL_SCALE
+from source_code.database import engine, Local_Session, DB_NAME
+from source_code.models import UserDB, Book_DB, Loan_Item_DB
+from source_code.loans import return_statement, user_loan_items
+from sqlalchemy import event, select, text
+import argparse
+import random
+import time
+import json
+import os
+
+
+class Statement_Counter:
+
+    def __init__(self, engine):
+        self.statements = 0
+        event.listen(engine, "before_cursor_execute", self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+
+# Cada caso es la parte de BDD de su endpoint en main.py, con un valor de entrada de los que prepara samples()
+
+def get_user(db, name):
+    return db.scalars(select(UserDB).where(UserDB.full_name==name)).all()
+
+
+def get_book(db, name):
+    return db.scalar(select(Book_DB).where(Book_DB.name==name))
+
+
+def loan_returned(db, item):
+    user_id, book_ref_number, film_ref_number = item
+    return db.execute(return_statement(user_loan_items(user_id, book_ref_number, film_ref_number))).all()
+
+
+def delete_book(db, ref_number):
+    existing_book = db.scalar(select(Book_DB).where(Book_DB.ref_number==ref_number))
+    if existing_book:
+        db.delete(existing_book)
+        db.flush()
+
+
+CASES = {"get_user": get_user, "get_book": get_book, "loan_returned": loan_returned, "delete_book": delete_book}
+
+
+# Valores de entrada de cada caso, escogidos al azar (con semilla) entre los datos que hay: nombres de usuarios y de libros,
+# artículos sin devolver (usuario y libro o película) y referencias de libros
+def samples(rng, count: int):
+    with engine.connect() as conn:
+        users = conn.scalar(text("SELECT max(user_id) FROM users")) or 0
+        books = conn.scalar(text("SELECT max(ref_number) FROM books")) or 0
+        user_ids = [rng.randint(1, users) for _ in range(count)] if users else []
+        book_refs = [rng.randint(1, books) for _ in range(count)] if books else []
+        user_names = dict(conn.execute(text("SELECT user_id, full_name FROM users WHERE user_id = ANY(:ids)"), {"ids": user_ids}).all())
+        book_names = dict(conn.execute(text("SELECT ref_number, name FROM books WHERE ref_number = ANY(:refs)"), {"refs": book_refs}).all())
+        open_items = conn.execute(text("SELECT p.user_id, i.book_ref_number, i.film_ref_number FROM prestamo p "
+                                       "JOIN loan_items i ON i.loan_id = p.loan_id "
+                                       "WHERE p.return_date IS NULL AND i.return_date IS NULL ORDER BY i.loan_item_id")).all()
+    return {"get_user": [user_names[i] for i in user_ids if i in user_names],
+            "get_book": [book_names[r] for r in book_refs if r in book_names],
+            "loan_returned": [tuple(row) for row in rng.sample(open_items, min(count, len(open_items)))],
+            "delete_book": book_refs}
+
+
+def percentile(ordered: list, fraction: float):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(case, values: list, counter: Statement_Counter, warmup: int, max_seconds: float):
+    latencies = []
+    statements = 0
+    db = Local_Session()
+    deadline = time.perf_counter() + max_seconds
+    try:
+        for i, value in enumerate(values):
+            before = counter.statements
+            start = time.perf_counter()
+            case(db, value)
+            elapsed = time.perf_counter() - start
+            db.rollback()
+            if i >= warmup:
+                latencies.append(elapsed * 1000)
+                statements += counter.statements - before
+            if time.perf_counter() > deadline:
+                break
+    finally:
+        db.close()
+    if not latencies:
+        return None
+    latencies.sort()
+    return {"calls": len(latencies), "statements": round(statements / len(latencies), 2),
+            "p50_ms": round(percentile(latencies, 0.50), 3), "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3), "max_ms": round(latencies[-1], 3)}
+
+
+def data_sizes():
+    with engine.connect() as conn:
+        return {table: conn.scalar(text(f"SELECT count(*) FROM {table}")) for table in ("users", "books", "films", "prestamo", "loan_items")}
+
+
+def run_scale(label: str, args, counter: Statement_Counter, cases: list):
+    sizes = data_sizes()
+    print(f"\n== {label}: {sizes['users']} usuarios, {sizes['books']} libros, {sizes['films']} películas, "
+          f"{sizes['prestamo']} préstamos, {sizes['loan_items']} artículos")
+    values = samples(random.Random(args.seed), args.calls + args.warmup)
+    print(f"{'caso':<16}{'llamadas':>10}{'sentencias':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'máx ms':>10}")
+    results = {}
+    for name in cases:
+        result = measure(CASES[name], values[name], counter, args.warmup, args.max_seconds)
+        if result is None:
+            print(f"{name:<16}{'sin datos para este caso':>40}")
+            continue
+        results[name] = result
+        print(f"{name:<16}{result['calls']:>10}{result['statements']:>12.2f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}{result['max_ms']:>10.2f}")
+    return {"label": label, "sizes": sizes, "results": results}
+
+
+# Cada caso en una fila con sus percentiles en cada escala, y cuánto ha crecido el p50 de la escala más pequeña a la más grande
+def print_curves(runs: list, cases: list):
+    if len(runs) < 2:
+        return
+    print("\nCurvas de latencia (p50 / p95 ms) por número de préstamos")
+    header = "".join(f"{run['sizes']['prestamo']:>20}" for run in runs)
+    print(f"{'caso':<16}{header}{'crece p50':>12}")
+    for name in cases:
+        cells = [run["results"].get(name) for run in runs]
+        line = "".join(f"{cell['p50_ms']:>10.2f} /{cell['p95_ms']:>7.2f} " if cell else f"{'-':>20}" for cell in cells)
+        growth = f"x{cells[-1]['p50_ms'] / cells[0]['p50_ms']:.1f}" if cells[0] and cells[-1] and cells[0]["p50_ms"] else "-"
+        print(f"{name:<16}{line}{growth:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latencia de las consultas de los endpoints a distintas escalas de datos")
+    parser.add_argument("--scales", type=float, nargs="+", default=[0.001, 0.01, 0.1],
+                        help=f"fracciones de la escala completa ({FULL_SCALE['loans']} préstamos)")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES), help="casos que se miden")
+    parser.add_argument("--calls", type=int, default=200, help="llamadas por caso y escala")
+    parser.add_argument("--warmup", type=int, default=10, help="llamadas iniciales de cada caso que no cuentan")
+    parser.add_argument("--max-seconds", type=float, default=30, help="tiempo máximo por caso y escala")
+    parser.add_argument("--seed", type=int, default=1, help="semilla de los datos y de los valores de entrada")
+    parser.add_argument("--create", action="store_true", help="crear la BDD de DB_NAME si no existe y aplicar las migraciones")
+    parser.add_argument("--reset", action="store_true", help="borrar los datos que ya tenga la BDD antes de la primera escala")
+    parser.add_argument("--no-seed", action="store_true", help="no cargar datos, medir con los que ya tiene la BDD")
+    parser.add_argument("--output", help="guardar los resultados en este fichero JSON")
+    args = parser.parse_args()
+
+    if args.create:
+        create_database()
+    counter = Statement_Counter(engine)
+    runs = []
+    if args.no_seed:
+        runs.append(run_scale(f"Datos de {DB_NAME}", args, counter, args.cases))
+    for i, scale in enumerate([] if args.no_seed else sorted(args.scales)):
+        sizes = scaled_sizes(scale)
+        print(f"\nCargando la escala {scale:g} en {DB_NAME}...")
+        seeded = seed_database(**sizes, seed=args.seed, reset=args.reset or i > 0, log=lambda line: None)
+        print(f"Cargada en {seeded['timings_s']['total']:.1f} s")
+        run = run_scale(f"Escala {scale:g}", args, counter, args.cases)
+        run["seed_s"] = seeded["timings_s"]
+        runs.append(run)
+    print_curves(runs, args.cases)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"database": DB_NAME, "seed": args.seed, "runs": runs}, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Resultados guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
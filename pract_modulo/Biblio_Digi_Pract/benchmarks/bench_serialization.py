@@ -0,0 +1,81 @@
+# Benchmark de la serialización de las respuestas: compara, para páginas de un listado de libros de distintos tamaños, el camino
+# anterior (FastAPI sin response_model: jsonable_encoder recorre cada objeto del ORM y JSONResponse lo pasa a JSON con json.dumps)
+# con el actual (el esquema de respuesta valida los objetos con pydantic y ORJSONResponse genera el JSON) y con el de la caché de
+# respuestas (pydantic genera directamente los bytes del JSON). Mide tiempo de CPU por respuesta y tamaño del cuerpo.
+#
+# No necesita BDD: los libros son objetos del ORM creados en memoria, como los que devuelve una consulta
+#   python -m benchmarks.bench_serialization --sizes 50 200 1000
+from source_code.models import Book_DB
+from source_code.validators import BookResponse, Page
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import TypeAdapter
+from datetime import datetime, timedelta, timezone
+import argparse
+import json
+import statistics
+import time
+
+adapter = TypeAdapter(Page[BookResponse])
+
+
+def make_page(size: int):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    items = [Book_DB(ref_number=i, name=f"Libro de prueba número {i}", author="Autora Con Un Nombre Bastante Largo", genre_id=1 + i % 20,
+                     total_copies=3, available_copies=i % 4, available=i % 4 > 0, date_registered=start + timedelta(minutes=i))
+             for i in range(1, size + 1)]
+    return {"items": items, "next_cursor": "WzEwMDBd"}
+
+
+def old_path(page):
+    return JSONResponse(content=jsonable_encoder(page)).body
+
+
+def response_model_path(page):
+    return ORJSONResponse(content=adapter.dump_python(adapter.validate_python(page, from_attributes=True), mode="json")).body
+
+
+def cache_path(page):
+    return adapter.dump_json(adapter.validate_python(page, from_attributes=True))
+
+
+PATHS = [("jsonable_encoder + json", old_path), ("response_model + orjson", response_model_path), ("esquema -> bytes (caché)", cache_path)]
+
+
+# Tiempo de CPU por respuesta en microsegundos: la mediana de varias tandas, para quitar el ruido del resto de la máquina
+def measure(function, page, repeat: int, rounds: int = 5):
+    function(page)
+    samples = []
+    for _ in range(rounds):
+        start = time.process_time()
+        for _ in range(repeat):
+            function(page)
+        samples.append((time.process_time() - start) / repeat * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coste de serializar los listados con y sin esquema de respuesta")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 1000], help="elementos por página")
+    parser.add_argument("--budget", type=float, default=0.5, help="segundos aproximados de medida por camino y tamaño")
+    args = parser.parse_args()
+
+    print(f"{'elementos':>9}  {'camino':<26}{'µs/resp.':>10}{'µs/elem.':>10}{'bytes':>9}{'ahorro':>8}")
+    for size in args.sizes:
+        page = make_page(size)
+        bodies = [function(page) for _, function in PATHS]
+        # Los tres caminos tienen que devolver los mismos elementos con los mismos campos, si no la comparación no vale
+        parsed = [json.loads(body)["items"] for body in bodies]
+        assert all([(e["ref_number"], sorted(e)) for e in items] == [(e["ref_number"], sorted(e)) for e in parsed[0]] for items in parsed)
+        reference = None
+        for (name, function), body in zip(PATHS, bodies):
+            start = time.perf_counter()
+            function(page)
+            repeat = max(1, int(args.budget / 5 / max(time.perf_counter() - start, 1e-6)))
+            cpu_us = measure(function, page, repeat)
+            reference = reference or cpu_us
+            print(f"{size:>9}  {name:<26}{cpu_us:>10.0f}{cpu_us / size:>10.2f}{len(body):>9}{1 - cpu_us / reference:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# Benchmark de los perfiles de servidor: levanta la API con cada perfil, le manda carga constante durante unos segundos con N
+# clientes a la vez y compara peticiones por segundo, latencias (p50, p99) y memoria de todos los procesos del servidor.
+#
+# Perfiles:
+#   uvicorn          un proceso de uvicorn con el event loop de asyncio y el parser h11 (lo que arrancaba antes el Dockerfile)
+#   uvicorn-uvloop   un proceso de uvicorn con uvloop y httptools
+#   gunicorn         el perfil de producción de gunicorn.conf.py (WEB_CONCURRENCY workers, preload y fork)
+#
+# Se ejecuta desde la carpeta del proyecto, con las mismas variables de entorno de BDD que la API y el esquema ya migrado:
+#   python -m benchmarks.bench_server --duration 20 --concurrency 64
+# Para comparar con los mismos límites que en producción se puede ejecutar dentro del contenedor (docker run --cpus 2 --memory 1g
+# ... python -m benchmarks.bench_server) o atacar con --url a un contenedor ya levantado con esos límites
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+PROFILES = {
+    "uvicorn": ["-m", "uvicorn", "source_code.main:app", "--loop", "asyncio", "--http", "h11", "--log-level", "warning"],
+    "uvicorn-uvloop": ["-m", "uvicorn", "source_code.main:app", "--loop", "uvloop", "--http", "httptools", "--log-level", "warning"],
+    "gunicorn": ["-m", "gunicorn", "-c", "gunicorn.conf.py", "source_code.main:app", "--log-level", "warning"],
+}
+
+
+def launch(profile: str, port: int):
+    command = [sys.executable] + PROFILES[profile]
+    command += ["--bind", f"127.0.0.1:{port}"] if profile == "gunicorn" else ["--port", str(port)]
+    # La salida va a un fichero y no a una tubería: con los logs de cada petición la tubería se llenaría y bloquearía al servidor
+    log = tempfile.TemporaryFile()
+    server = subprocess.Popen(command, env=dict(os.environ, API_DEBUG="false"), stdout=log, stderr=subprocess.STDOUT)
+    server.log = log
+    return server
+
+
+async def wait_ready(client, server, timeout: float = 60):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if server is not None and server.poll() is not None:
+            server.log.seek(0)
+            raise RuntimeError(f"El servidor no ha arrancado:\n{server.log.read().decode()[-2000:]}")
+        try:
+            if (await client.get("/Estadisticas/arranque")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.05)
+    raise RuntimeError("El servidor no ha contestado a tiempo")
+
+
+# Memoria proporcional (PSS) del servidor y de todos sus procesos hijos: las páginas compartidas entre procesos se reparten entre
+# ellos, así que la suma es la memoria real que ocupa y se ve lo que ahorra compartir el código importado antes del fork
+def memory_mb(pid: int):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    total_kb, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/smaps_rollup") as f:
+                total_kb += next(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+        except (OSError, StopIteration):
+            pass
+    return total_kb / 1024
+
+
+# Cuando un worker se recicla cierra sus conexiones keep-alive libres, y una petición que el cliente ya estaba enviando por una de
+# ellas se encuentra la conexión cerrada. Como hacen los navegadores y los proxies con las peticiones GET, se reintenta por una
+# conexión nueva (hasta RETRIES veces) y los reintentos se cuentan aparte de los errores
+RETRIES = 3
+
+
+async def load(client, path: str, concurrency: int, duration: float):
+    latencies, errors = [], []
+    retries = 0
+    deadline = time.perf_counter() + duration
+
+    async def get():
+        nonlocal retries
+        for attempt in range(RETRIES):
+            try:
+                return await client.get(path)
+            except (httpx.RemoteProtocolError, httpx.ReadError):
+                if attempt == RETRIES - 1:
+                    raise
+                retries += 1
+
+    async def user():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await get()
+                if response.status_code != 200:
+                    errors.append(f"{response.status_code} {response.text[:200]}")
+            except httpx.HTTPError as e:
+                errors.append(repr(e))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    return latencies, errors, retries, time.perf_counter() - start
+
+
+async def run_profile(name: str, args):
+    server = None if args.url else launch(name, args.port)
+    base_url = args.url or f"http://127.0.0.1:{args.port}"
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+            await wait_ready(client, server)
+            await load(client, args.path, args.concurrency, args.warmup)
+            latencies, errors, retries, elapsed = await load(client, args.path, args.concurrency, args.duration)
+        latencies.sort()
+        n = len(latencies)
+        memory = memory_mb(server.pid) if server is not None and os.path.exists("/proc/self/smaps_rollup") else float("nan")
+        print(f"{name:<16}{n / elapsed:>10.0f}{statistics.median(latencies) * 1000:>9.1f}{latencies[int(n * 0.99)] * 1000:>9.1f}"
+              f"{retries:>11}{len(errors):>8}{memory:>10.0f}")
+        if errors:
+            print(f"{'':<16}primer error: {errors[0]}")
+        return len(errors)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            server.log.close()
+
+
+async def run(args):
+    print(f"{'perfil':<16}{'pet./s':>10}{'p50 ms':>9}{'p99 ms':>9}{'reintentos':>11}{'errores':>8}{'PSS MB':>10}")
+    errors = 0
+    for name in ([args.url] if args.url else args.profiles):
+        errors += await run_profile(name, args)
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rendimiento de la API con cada perfil de servidor")
+    parser.add_argument("--profiles", nargs="+", choices=list(PROFILES), default=list(PROFILES))
+    parser.add_argument("--url", help="atacar a una API ya levantada en lugar de arrancar los perfiles")
+    parser.add_argument("--port", type=int, default=int(os.getenv("BENCH_PORT", 8766)))
+    parser.add_argument("--path", default="/Libros/?limit=20", help="petición GET que se repite")
+    parser.add_argument("--concurrency", type=int, default=64, help="clientes a la vez")
+    parser.add_argument("--duration", type=float, default=20, help="segundos de medida por perfil")
+    parser.add_argument("--warmup", type=float, default=3, help="segundos de carga antes de medir")
+    args = parser.parse_args()
+    raise SystemExit(1 if asyncio.run(run(args)) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Benchmark del arranque en frío: lanza la API con uvicorn en un proceso nuevo y mide cuánto tarda en contestar la primera petición,
+# con el desglose por fases del lifespan (/Estadisticas/arranque) y la latencia de las dos primeras peticiones a un listado.
+# Si el peor arranque supera el objetivo (--target-ms) termina con código 1, para poder usarlo en CI o antes de un despliegue.
+#
+# Se ejecuta desde la carpeta del proyecto, con las mismas variables de entorno de BDD que la API y el esquema ya migrado:
+#   alembic upgrade head
+#   python -m benchmarks.bench_startup --runs 5 --target-ms 3000
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+
+def cold_start(port: int, timeout: float):
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "source_code.main:app", "--port", str(port), "--log-level", "warning"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=30) as client:
+            while True:
+                if server.poll() is not None:
+                    raise RuntimeError(f"La API no ha arrancado:\n{server.stderr.read().decode()[-2000:]}")
+                if time.perf_counter() - start > timeout:
+                    raise RuntimeError(f"La API no ha contestado en {timeout:.0f} s")
+                try:
+                    response = client.get("/Estadisticas/arranque")
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.01)
+            ready = time.perf_counter() - start
+            phases = response.json()
+            latencies = []
+            for _ in range(2):
+                request_start = time.perf_counter()
+                client.get("/Libros/", params={"limit": 20}).raise_for_status()
+                latencies.append(time.perf_counter() - request_start)
+        return ready, phases, latencies
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiempo de arranque en frío de la API")
+    parser.add_argument("--runs", type=int, default=5, help="arranques que se miden")
+    parser.add_argument("--port", type=int, default=int(os.getenv("BENCH_PORT", 8765)))
+    parser.add_argument("--target-ms", type=float, default=3000, help="tiempo máximo de arranque admitido")
+    parser.add_argument("--timeout", type=float, default=60, help="segundos de espera antes de dar el arranque por fallido")
+    args = parser.parse_args()
+
+    readies = []
+    print(f"{'arranque':>9}{'listo ms':>10}{'lifespan':>10}{'esquema':>9}{'cifrado':>9}{'pool':>7}{'cachés':>8}"
+          f"{'1ª pet.':>9}{'2ª pet.':>9}")
+    for run in range(1, args.runs + 1):
+        ready, phases, latencies = cold_start(args.port, args.timeout)
+        readies.append(ready)
+        print(f"{run:>9}{ready * 1000:>10.0f}{phases.get('total_ms', 0):>10.0f}{phases.get('schema_ms', 0):>9.0f}"
+              f"{phases.get('hashing_ms', 0):>9.0f}{phases.get('pool_ms', 0):>7.0f}{phases.get('caches_ms', 0):>8.0f}"
+              f"{latencies[0] * 1000:>9.1f}{latencies[1] * 1000:>9.1f}")
+    worst = max(readies) * 1000
+    print(f"mediana {statistics.median(readies) * 1000:.0f} ms, peor {worst:.0f} ms, objetivo {args.target_ms:.0f} ms")
+    raise SystemExit(1 if worst > args.target_ms else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Benchmark del camino de escritura: cuenta las sentencias SQL y los commits que cuesta cada alta (usuarios, libros, películas y
+# géneros), tanto de las que se crean como de las repetidas que acaban en 409, y mide su latencia.
+#
+# Se ejecuta desde la carpeta del proyecto, con las mismas variables de entorno de BDD que la API:
+#   python -m benchmarks.bench_writes --requests 50
+# La app se ejecuta dentro del propio proceso para poder contar las sentencias con los eventos del engine
+from source_code.database import request_engine
+from sqlalchemy import event
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+import httpx
+
+
+class Statement_Counter:
+
+    def __init__(self, engine):
+        self.statements = 0
+        self.commits = 0
+        event.listen(engine, "before_cursor_execute", self.on_execute)
+        event.listen(engine, "commit", self.on_commit)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def on_commit(self, conn):
+        self.commits += 1
+
+
+# Cada escenario es (nombre, función que devuelve la petición i-ésima como (ruta, parámetros, cuerpo), código esperado)
+def scenarios(tag: str):
+    genre = f"Bench {tag}"
+    return [
+        ("usuario nuevo", lambda i: ("/Usuarios/", None, {"full_name": "Usuario De Benchmark", "hashed_password": "ClaveBench1",
+                                                          "contact_mail": f"w{tag}_{i}@example.com"}), 201),
+        ("usuario repetido", lambda i: ("/Usuarios/", None, {"full_name": "Usuario De Benchmark", "hashed_password": "ClaveBench1",
+                                                             "contact_mail": f"w{tag}_0@example.com"}), 409),
+        ("género nuevo", lambda i: ("/Generos/", None, {"genre_name": f"{genre} {i}"}), 201),
+        ("género repetido", lambda i: ("/Generos/", None, {"genre_name": f"{genre} 0"}), 409),
+        ("libro, género conocido", lambda i: ("/Libros/", {"genre_name": f"{genre} 0"},
+                                              {"name": f"Libro {tag} {i}", "author": "Autor Del Benchmark"}), 201),
+        ("libro, género nuevo", lambda i: ("/Libros/", {"genre_name": f"{genre} libros {i}"},
+                                           {"name": f"Libro nuevo {tag} {i}", "author": "Autor Del Benchmark"}), 201),
+        ("libro repetido", lambda i: ("/Libros/", {"genre_name": f"{genre} 0"},
+                                      {"name": f"Libro {tag} 0", "author": "Autor Del Benchmark"}), 409),
+        ("película, género conocido", lambda i: ("/Peliculas/", {"genre_name": f"{genre} 0"},
+                                                 {"name": f"Pelicula {tag} {i}", "actors": "Actriz Uno, Actor Dos"}), 201),
+    ]
+
+
+async def run(args):
+    from source_code.main import app
+    counter = Statement_Counter(request_engine)
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60)
+    lifespan = app.router.lifespan_context(app)
+    await lifespan.__aenter__()
+    unexpected = 0
+    try:
+        print(f"{'escenario':<28}{'peticiones':>11}{'sentencias':>12}{'commits':>9}{'p50 ms':>9}{'p95 ms':>9}")
+        for name, build, expected in scenarios(uuid.uuid4().hex[:8]):
+            statements = counter.statements
+            commits = counter.commits
+            latencies = []
+            for i in range(args.requests):
+                path, params, body = build(i)
+                start = time.perf_counter()
+                response = await client.post(path, params=params, json=body)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != expected:
+                    unexpected += 1
+                    print(f"{name}: se esperaba {expected} y se ha recibido {response.status_code} {response.text[:200]}")
+            latencies.sort()
+            n = len(latencies)
+            print(f"{name:<28}{n:>11}{(counter.statements - statements) / n:>12.2f}{(counter.commits - commits) / n:>9.2f}"
+                  f"{statistics.median(latencies) * 1000:>9.1f}{latencies[int(n * 0.95)] * 1000:>9.1f}")
+    finally:
+        await client.aclose()
+        await lifespan.__aexit__(None, None, None)
+    return unexpected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sentencias SQL por petición en las altas")
+    parser.add_argument("--requests", type=int, default=50, help="peticiones por escenario")
+    args = parser.parse_args()
+    raise SystemExit(1 if asyncio.run(run(args)) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,475 @@
+# Generador de datos a escala para ver cómo se comportan las consultas con millones de préstamos: usuarios, géneros, libros,
+# películas con su reparto, ejemplares e histórico de préstamos con sus artículos. Los datos son deterministas (la misma semilla y
+# los mismos tamaños dan siempre la misma BDD) y pasan los validadores de la API: nombres y autores de tres palabras con nombres y
+# apellidos españoles, correos únicos, repartos separados por comas...
+#
+# Los datos cuadran entre sí como si se hubieran creado con la API: los préstamos abiertos son los más recientes y cada uno de sus
+# artículos tiene un ejemplar prestado (on_loan) que se descuenta de available_copies de su título. Los títulos y los usuarios
+# más populares (los de referencia más baja) acumulan más préstamos, como pasa en una biblioteca de verdad.
+#
+# Se carga todo con COPY en una sola transacción, como hace pg_restore: se quitan los índices secundarios y las claves foráneas de
+# las tablas, se cargan los datos y se vuelven a crear (un índice construido de una vez es mucho más rápido que mantenerlo fila a
+# fila). Los triggers de los ejemplares iniciales, del género principal y de los códigos de barras se desactivan mientras tanto
+# porque esas filas ya vienen en la carga; los de búsqueda de texto se quedan activos para que search_vector salga igual que
+# desde la API. Si algo falla no se queda nada a medias.
+#
+# BORRA LOS DATOS DE LA BDD DE DB_NAME, así que se usa con una BDD aparte y con las mismas variables de entorno que la API:
+#   DB_NAME=db_biblioteca_escala python -m benchmarks.seed_scale --create --scale 0.01
+#   DB_NAME=db_biblioteca_escala python -m benchmarks.seed_scale --reset --scale 1          (10M de préstamos y 1M de títulos)
+#   DB_NAME=db_biblioteca_escala python -m benchmarks.seed_scale --reset --users 2000 --books 5000 --films 1000 --loans 50000
+from source_code.database import engine, DB_NAME
+from source_code.passwords import hash_password
+from sqlalchemy import create_engine, text
+from datetime import datetime, timezone
+from array import array
+import unicodedata
+import subprocess
+import argparse
+import tempfile
+import random
+import time
+import sys
+import os
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Tamaños con --scale 1. Las opciones --users, --books... cambian cada uno por separado
+FULL_SCALE = {"users": 500_000, "books": 700_000, "films": 300_000, "loans": 10_000_000}
+OPEN_FRACTION = 0.02  # préstamos abiertos (sin devolver), los más recientes
+SEED_PASSWORD = "ClaveEscala1"  # contraseña de todos los usuarios generados
+BARCODE = "EJ{:08d}"  # el mismo formato que el trigger copies_barcode
+
+# El histórico termina en una fecha fija para que los datos no dependan del día en que se generan. Las fechas se calculan en
+# segundos desde epoch, que es mucho más barato que sumar timedelta a datetime millones de veces
+DAY = 86400
+END = datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp()
+LOANS_YEARS = 5  # años de histórico de préstamos
+CATALOG_YEARS = 10  # años en los que se ha ido dando de alta el catálogo, antes del primer préstamo
+FIRST_LOAN = END - 365 * LOANS_YEARS * DAY
+
+# Tablas en el orden en que se cargan, y los triggers que se desactivan durante la carga
+TABLES = ["genero", "users", "actors", "prestamo", "loan_items", "books", "films", "copies", "film_actor",
+          "book_genre_association", "film_genre_association"]
+DISABLED_TRIGGERS = {"books": ["books_initial_copies", "books_main_genre"], "films": ["films_initial_copies", "films_main_genre"],
+                     "copies": ["copies_barcode"]}
+
+FIRST_NAMES = ["Antonio", "Manuel", "José", "Francisco", "David", "Juan", "Javier", "Daniel", "Carlos", "Jesús", "Alejandro",
+               "Miguel", "Rafael", "Pablo", "Sergio", "Fernando", "Jorge", "Luis", "Alberto", "Álvaro", "Adrián", "Diego",
+               "Raúl", "Enrique", "Ramón", "Vicente", "Iván", "Rubén", "Óscar", "Andrés", "Joaquín", "Santiago", "Eduardo",
+               "Víctor", "Roberto", "Jaime", "Mario", "Ignacio", "Alfonso", "Hugo", "María", "Carmen", "Ana", "Isabel", "Laura",
+               "Cristina", "Marta", "Lucía", "Pilar", "Elena", "Sara", "Paula", "Raquel", "Rosa", "Beatriz", "Julia", "Silvia",
+               "Irene", "Patricia", "Andrea", "Rocío", "Alba", "Sonia", "Nuria", "Inés", "Claudia", "Eva", "Lorena", "Teresa",
+               "Sofía", "Noelia", "Alicia", "Natalia", "Marina", "Ainhoa", "Nerea", "Begoña", "Amaia", "Itziar", "Leire"]
+SURNAMES = ["García", "Rodríguez", "González", "Fernández", "López", "Martínez", "Sánchez", "Pérez", "Gómez", "Martín",
+            "Jiménez", "Ruiz", "Hernández", "Díaz", "Moreno", "Muñoz", "Álvarez", "Romero", "Alonso", "Gutiérrez", "Navarro",
+            "Torres", "Domínguez", "Vázquez", "Ramos", "Gil", "Ramírez", "Serrano", "Blanco", "Molina", "Morales", "Suárez",
+            "Ortega", "Delgado", "Castro", "Ortiz", "Rubio", "Marín", "Sanz", "Núñez", "Iglesias", "Medina", "Garrido",
+            "Cortés", "Castillo", "Santos", "Lozano", "Guerrero", "Cano", "Prieto", "Méndez", "Cruz", "Calvo", "Gallego",
+            "Vidal", "León", "Márquez", "Herrera", "Peña", "Flores", "Cabrera", "Campos", "Vega", "Fuentes", "Carrasco",
+            "Diez", "Caballero", "Reyes", "Nieto", "Aguilar", "Pascual", "Santana", "Herrero", "Lorenzo", "Montero",
+            "Hidalgo", "Giménez", "Ibáñez", "Ferrer", "Durán", "Santiago", "Benítez", "Mora", "Vicente", "Arias", "Etxeberria",
+            "Goikoetxea", "Zubizarreta", "Aranburu", "Urrutia"]
+GENRES = ["Novela", "Novela negra", "Ciencia ficción", "Fantasía", "Terror", "Romántica", "Histórica", "Aventuras", "Poesía",
+          "Teatro", "Ensayo", "Biografía", "Divulgación", "Infantil", "Juvenil", "Cómic", "Humor", "Viajes", "Cocina",
+          "Arte", "Música", "Filosofía", "Historia", "Economía", "Drama", "Comedia", "Acción", "Suspense", "Animación",
+          "Documental", "Western", "Musical", "Bélico", "Policiaco"]
+TITLE_STARTS = ["La sombra", "El jardín", "La ciudad", "El silencio", "La memoria", "El viaje", "La casa", "El secreto",
+                "La noche", "El invierno", "La voz", "El camino", "La isla", "El último verano", "La herencia", "El faro",
+                "La biblioteca", "El laberinto", "La tormenta", "El río", "La frontera", "El guardián", "La promesa", "El eco",
+                "La sal", "El reloj", "La huida", "El mapa", "La colmena", "El puerto", "La llave", "El tiempo", "La carta",
+                "El bosque", "La orilla", "El olvido", "La hija", "El mercader", "La luz", "El cielo"]
+TITLE_ENDS = ["del viento", "de los espejos", "de papel", "sin nombre", "de la memoria", "de medianoche", "del norte",
+              "de las hojas", "de cristal", "del desierto", "de los sueños", "de la niebla", "del sur", "de arena",
+              "de las estrellas", "del invierno", "de los libros", "de la lluvia", "del abismo", "de las palabras", "de ceniza",
+              "del mar", "de la montaña", "de los náufragos", "del alba", "de los secretos", "de hierro", "de la luna",
+              "del silencio", "de las campanas", "del olivar", "de sal", "de la frontera", "del tiempo", "de los ríos",
+              "de la calle Mayor", "del faro", "de las brujas", "de Castilla", "del Cantábrico"]
+
+
+def ascii_name(value: str):
+    return unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode("ascii").lower()
+
+
+def person_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(SURNAMES)} {rng.choice(SURNAMES)}"
+
+
+# Nombre único de tres palabras para el k-ésimo actor: recorre todas las combinaciones nombre-apellido-apellido en un orden
+# desordenado (un paso primo con el total), así no hace falta guardar los nombres ya usados
+def unique_person_name(k: int):
+    combinations = len(FIRST_NAMES) * len(SURNAMES) * len(SURNAMES)
+    index = (k * 100_003 + 7) % combinations
+    first, rest = divmod(index, len(SURNAMES) * len(SURNAMES))
+    surname_1, surname_2 = divmod(rest, len(SURNAMES))
+    return f"{FIRST_NAMES[first]} {SURNAMES[surname_1]} {SURNAMES[surname_2]}"
+
+
+# Títulos con aspecto de título ("La sombra del viento"). Cuando una combinación ya ha salido se le añade el número de la
+# entrega ("La sombra del viento 2"), así el nombre (que es único) no se repite
+class Title_Generator:
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.seen = {}
+
+    def __call__(self):
+        base = f"{self.rng.choice(TITLE_STARTS)} {self.rng.choice(TITLE_ENDS)}"
+        count = self.seen.get(base, 0) + 1
+        self.seen[base] = count
+        return base if count == 1 else f"{base} {count}"
+
+
+# Segundos desde epoch a timestamptz en el formato de texto de COPY. La fecha de cada día se formatea una sola vez
+DAYS = {}
+
+
+def timestamp(seconds: float):
+    day, second = divmod(int(seconds), DAY)
+    date = DAYS.get(day)
+    if date is None:
+        date = DAYS[day] = datetime.fromtimestamp(day * DAY, timezone.utc).strftime("%Y-%m-%d")
+    return f"{date} {second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}+00"
+
+
+def nullable(value):
+    return "\\N" if value is None else value
+
+
+def copy_line(row):
+    return "\t".join(["\\N" if v is None else "t" if v is True else "f" if v is False else str(v) for v in row]) + "\n"
+
+
+# Fichero que lee COPY ... FROM STDIN: va generando las líneas a medida que psycopg2 pide datos, así ninguna tabla entera tiene
+# que caber en memoria. psycopg2 envía lo que devuelva read() aunque pase del tamaño que pide
+class Copy_Stream:
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+
+    def read(self, size=-1):
+        chunk = []
+        length = 0
+        for line in self.lines:
+            chunk.append(line)
+            length += len(line)
+            if 0 < size <= length:
+                break
+        return "".join(chunk).encode("utf-8")
+
+
+# Filas de una tabla que se generan a la vez que las de otra (los artículos de cada préstamo, el reparto de cada película...). Se
+# escriben en un fichero temporal y se cargan con su propio COPY cuando termina la tabla principal
+class Spool:
+
+    def __init__(self, table: str, columns: list):
+        self.table = table
+        self.columns = columns
+        self.file = tempfile.TemporaryFile()
+        self.pending = []
+        self.rows = 0
+
+    def add(self, line: str):
+        self.pending.append(line)
+        if len(self.pending) >= 10_000:
+            self.flush()
+
+    def flush(self):
+        self.file.write("".join(self.pending).encode("utf-8"))
+        self.rows += len(self.pending)
+        self.pending = []
+
+    def copy(self, cursor):
+        self.flush()
+        self.file.seek(0)
+        cursor.copy_expert(f"COPY {self.table} ({', '.join(self.columns)}) FROM STDIN", self.file, size=1 << 20)
+        self.file.close()
+        return self.rows
+
+
+def copy_rows(cursor, table: str, columns: list, lines):
+    stream = Copy_Stream(lines)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", stream, size=1 << 20)
+    return cursor.rowcount
+
+
+def scaled_sizes(scale: float, **overrides):
+    sizes = {name: max(1, int(round(value * scale))) for name, value in FULL_SCALE.items()}
+    sizes.update({name: value for name, value in overrides.items() if value is not None})
+    return sizes
+
+
+# Lo que hay que saber de los títulos antes de generar los préstamos: cuántos ejemplares tiene cada uno y el copy_id del primero
+# (los ejemplares de cada título tienen ids consecutivos, primero los de los libros y después los de las películas)
+class Catalog:
+
+    def __init__(self, rng, books: int, films: int):
+        self.total = {"book": bytearray(rng.choices((1, 2, 3, 4, 5), (45, 30, 15, 6, 4), k=books)),
+                      "film": bytearray(rng.choices((1, 2, 3), (60, 30, 10), k=films))}
+        self.lent = {"book": bytearray(books), "film": bytearray(films)}
+        self.first_copy = {}
+        next_copy = 1
+        for kind in ("book", "film"):
+            first = array("q", [0]) * len(self.total[kind])
+            for i, copies in enumerate(self.total[kind]):
+                first[i] = next_copy
+                next_copy += copies
+            self.first_copy[kind] = first
+        self.copies = next_copy - 1
+
+    def size(self, kind: str):
+        return len(self.total[kind])
+
+    def registered(self, kind: str, ref_number: int):
+        return FIRST_LOAN - 365 * CATALOG_YEARS * DAY * (1 - ref_number / (self.size(kind) + 1))
+
+    # Ejemplar libre para un préstamo abierto, o None si ya están todos prestados
+    def lend(self, kind: str, ref_number: int):
+        i = ref_number - 1
+        if self.lent[kind][i] >= self.total[kind][i]:
+            return None
+        self.lent[kind][i] += 1
+        return self.first_copy[kind][i] + self.lent[kind][i] - 1
+
+    def any_copy(self, rng, kind: str, ref_number: int):
+        return self.first_copy[kind][ref_number - 1] + rng.randrange(self.total[kind][ref_number - 1])
+
+
+# Las referencias bajas son más populares: con random() ** 3 el 10 % de los títulos se lleva más de la mitad de los préstamos
+def popular(rng, n: int, skew: float):
+    return 1 + int(n * rng.random() ** skew)
+
+
+def user_lines(rng, users: int, hashed_password: str):
+    for user_id in range(1, users + 1):
+        first, surname_1, surname_2 = person_name(rng).split(" ")
+        mail = f"{ascii_name(first)}.{ascii_name(surname_1)}.{user_id}@correo.example.com"
+        joined = FIRST_LOAN - 730 * DAY * (1 - user_id / (users + 1)) + rng.randrange(DAY)
+        yield copy_line((user_id, f"{first} {surname_1} {surname_2}", timestamp(joined), hashed_password, mail, rng.randint(16, 85)))
+
+
+# Cabeceras de los préstamos; sus artículos van al spool. Los open_loans últimos siguen abiertos y se llevan un ejemplar libre
+# de cada artículo (si todos los ejemplares de un título ya están prestados ese artículo se da por devuelto). Es el bucle que
+# más veces se ejecuta, por eso las líneas se escriben a mano en lugar de pasar por copy_line
+def loan_lines(rng, catalog: Catalog, users: int, loans: int, open_loans: int, items: Spool):
+    books, films = catalog.size("book"), catalog.size("film")
+    book_share = books / (books + films)
+    span = 365 * LOANS_YEARS * DAY
+    first_open = loans - open_loans + 1
+    loan_item_id = 0
+    for loan_id in range(1, loans + 1):
+        loan_date = FIRST_LOAN + span * (loan_id - 1 + rng.random()) / loans
+        returned = timestamp(min(loan_date + DAY * rng.uniform(1, 30), END))
+        r = rng.random()
+        wanted = 1 if r < 0.70 else 2 if r < 0.92 else 3 if r < 0.98 else 4
+        picked = set()
+        for _ in range(wanted):
+            if rng.random() < book_share:
+                picked.add(("book", popular(rng, books, 3)))
+            else:
+                picked.add(("film", popular(rng, films, 3)))
+        book_ref_number = film_ref_number = None
+        still_open = False
+        for kind, ref_number in sorted(picked):
+            copy_id = catalog.lend(kind, ref_number) if loan_id >= first_open else None
+            if copy_id is None:
+                copy_id = catalog.any_copy(rng, kind, ref_number)
+                item_returned = returned
+            else:
+                item_returned = "\\N"
+                still_open = True
+            loan_item_id += 1
+            if kind == "book":
+                book_ref_number = book_ref_number or ref_number
+                items.add(f"{loan_item_id}\t{loan_id}\t{ref_number}\t\\N\t{copy_id}\t{item_returned}\n")
+            else:
+                film_ref_number = film_ref_number or ref_number
+                items.add(f"{loan_item_id}\t{loan_id}\t\\N\t{ref_number}\t{copy_id}\t{item_returned}\n")
+        loan_return = "\\N" if still_open else returned
+        yield (f"{loan_id}\t{timestamp(loan_date)}\t{popular(rng, users, 2)}\t{nullable(book_ref_number)}\t{nullable(film_ref_number)}\t"
+               f"{loan_return}\n")
+
+
+# Títulos de un tipo (libros o películas), con su género principal y a veces uno secundario en la tabla de asociación. En las
+# películas el reparto sale de un grupo de actores con nombre único, y se guarda también en actors/film_actor
+def title_lines(rng, catalog: Catalog, kind: str, genres: int, actors: int, associations: Spool, cast: Spool = None):
+    titles = Title_Generator(rng)
+    for ref_number in range(1, catalog.size(kind) + 1):
+        genre_id = rng.randint(1, genres)
+        associations.add(f"{ref_number}\t{genre_id}\n")
+        if rng.random() < 0.2:
+            second = rng.randint(1, genres)
+            if second != genre_id:
+                associations.add(f"{ref_number}\t{second}\n")
+        total = catalog.total[kind][ref_number - 1]
+        available = total - catalog.lent[kind][ref_number - 1]
+        registered = timestamp(catalog.registered(kind, ref_number))
+        if kind == "book":
+            people = person_name(rng)
+        else:
+            actor_ids = rng.sample(range(1, actors + 1), min(actors, rng.randint(2, 5)))
+            people = ", ".join(unique_person_name(actor_id - 1) for actor_id in actor_ids)
+            for position, actor_id in enumerate(actor_ids):
+                cast.add(f"{ref_number}\t{actor_id}\t{position}\n")
+        yield copy_line((ref_number, titles(), people, total, available, registered, genre_id))
+
+
+def copy_lines(catalog: Catalog):
+    for kind in ("book", "film"):
+        for i, total in enumerate(catalog.total[kind]):
+            registered = timestamp(catalog.registered(kind, i + 1))
+            first = catalog.first_copy[kind][i]
+            for n in range(total):
+                copy_id = first + n
+                yield copy_line((copy_id, BARCODE.format(copy_id), i + 1 if kind == "book" else None,
+                                 i + 1 if kind == "film" else None, n < catalog.lent[kind][i], registered))
+
+
+# Índices secundarios y claves foráneas de las tablas que se cargan. Los índices de las claves primarias y de las restricciones
+# UNIQUE se quedan (no se pueden quitar sin quitar la restricción)
+def constraints_and_indexes(cursor):
+    cursor.execute("SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                   "WHERE contype = 'f' AND conrelid = ANY(%s::regclass[]) ORDER BY 1, 2", (TABLES,))
+    foreign_keys = cursor.fetchall()
+    cursor.execute("SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index "
+                   "WHERE indrelid = ANY(%s::regclass[]) AND NOT indisprimary "
+                   "AND indexrelid NOT IN (SELECT conindid FROM pg_constraint WHERE contype IN ('p', 'u', 'x')) ORDER BY 1", (TABLES,))
+    return foreign_keys, cursor.fetchall()
+
+
+def table_counts(cursor):
+    counts = {}
+    for table in TABLES:
+        cursor.execute(f"SELECT count(*) FROM {table}")
+        counts[table] = cursor.fetchone()[0]
+    return counts
+
+
+def create_database():
+    admin = create_engine(engine.url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    with admin.connect() as conn:
+        if not conn.scalar(text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": DB_NAME}):
+            conn.exec_driver_sql(f'CREATE DATABASE "{DB_NAME}"')
+            print(f"Creada la BDD {DB_NAME}")
+    admin.dispose()
+    subprocess.run([sys.executable, "-m", "alembic", "upgrade", "head"], cwd=PROJECT_DIR, check=True)
+
+
+# Genera y carga los datos. Devuelve lo que ha cargado de cada tabla y cuánto ha tardado cada fase
+def seed_database(users: int, books: int, films: int, loans: int, open_fraction: float = OPEN_FRACTION, seed: int = 1,
+                  reset: bool = False, actors: int = None, log=print):
+    if users < 1 or books + films < 1:
+        raise ValueError("Hace falta por lo menos un usuario y un título")
+    actors = actors or min(max(10, films // 4), len(FIRST_NAMES) * len(SURNAMES) ** 2)
+    open_loans = int(loans * open_fraction)
+    timings = {}
+    start = time.perf_counter()
+    hashed_password = hash_password(SEED_PASSWORD, 10)
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        existing = table_counts(cursor)
+        if any(existing.values()) and not reset:
+            raise SystemExit(f"La BDD {DB_NAME} ya tiene datos ({existing}), se borran con --reset")
+        cursor.execute("SET LOCAL synchronous_commit = off")
+        cursor.execute("SET LOCAL maintenance_work_mem = '256MB'")
+        cursor.execute(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY CASCADE")
+        foreign_keys, indexes = constraints_and_indexes(cursor)
+        for table, name, _ in foreign_keys:
+            cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+        for name, _ in indexes:
+            cursor.execute(f"DROP INDEX {name}")
+        for table, triggers in DISABLED_TRIGGERS.items():
+            for trigger in triggers:
+                cursor.execute(f"ALTER TABLE {table} DISABLE TRIGGER {trigger}")
+
+        def timed(phase: str, load):
+            phase_start = time.perf_counter()
+            rows = load()
+            timings[phase] = round(time.perf_counter() - phase_start, 2)
+            log(f"  {phase:<24}{rows:>12} filas {timings[phase]:>9.2f} s")
+            return rows
+
+        counts = {}
+        catalog = Catalog(random.Random(f"{seed}:catalogo"), books, films)
+        counts["genero"] = timed("genero", lambda: copy_rows(cursor, "genero", ["genre_id", "genre_name"], map(copy_line, enumerate(GENRES, 1))))
+        counts["users"] = timed("users", lambda: copy_rows(
+            cursor, "users", ["user_id", "full_name", "date_added", "hashed_password", "contact_mail", "age"],
+            user_lines(random.Random(f"{seed}:usuarios"), users, hashed_password)))
+        counts["actors"] = timed("actors", lambda: copy_rows(
+            cursor, "actors", ["actor_id", "full_name"], (copy_line((k + 1, unique_person_name(k))) for k in range(actors))))
+        items = Spool("loan_items", ["loan_item_id", "loan_id", "book_ref_number", "film_ref_number", "copy_id", "return_date"])
+        counts["prestamo"] = timed("prestamo", lambda: copy_rows(
+            cursor, "prestamo", ["loan_id", "loan_date", "user_id", "book_ref_number", "film_ref_number", "return_date"],
+            loan_lines(random.Random(f"{seed}:prestamos"), catalog, users, loans, open_loans, items)))
+        counts["loan_items"] = timed("loan_items", lambda: items.copy(cursor))
+        cast = Spool("film_actor", ["film_ref_number", "actor_id", "position"])
+        for kind, table, people, association, column in (("book", "books", "author", "book_genre_association", "book_ref_number"),
+                                                         ("film", "films", "actors", "film_genre_association", "film_ref_number")):
+            genres = Spool(association, [column, "genre_id"])
+            counts[table] = timed(table, lambda: copy_rows(
+                cursor, table, ["ref_number", "name", people, "total_copies", "available_copies", "date_registered", "genre_id"],
+                title_lines(random.Random(f"{seed}:{table}"), catalog, kind, len(GENRES), actors, genres, cast)))
+            counts[association] = timed(association, lambda: genres.copy(cursor))
+        counts["film_actor"] = timed("film_actor", lambda: cast.copy(cursor))
+        counts["copies"] = timed("copies", lambda: copy_rows(
+            cursor, "copies", ["copy_id", "barcode", "book_ref_number", "film_ref_number", "on_loan", "date_added"],
+            copy_lines(catalog)))
+
+        def rebuild():
+            for _, definition in indexes:
+                cursor.execute(definition)
+            for table, name, definition in foreign_keys:
+                cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}')
+            return len(indexes) + len(foreign_keys)
+        timed("índices y claves", rebuild)
+        for table, triggers in DISABLED_TRIGGERS.items():
+            for trigger in triggers:
+                cursor.execute(f"ALTER TABLE {table} ENABLE TRIGGER {trigger}")
+        # Las secuencias siguen después de los ids cargados, para que las altas desde la API no choquen con ellos
+        for table, column in (("genero", "genre_id"), ("users", "user_id"), ("actors", "actor_id"), ("prestamo", "loan_id"),
+                              ("loan_items", "loan_item_id"), ("books", "ref_number"), ("films", "ref_number"), ("copies", "copy_id")):
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{column}'), coalesce(max({column}), 0) + 1, false) FROM {table}")
+        timed("commit", lambda: raw.commit() or 0)
+    except BaseException:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    # VACUUM no puede ir dentro de una transacción. Deja las estadísticas del planificador y el mapa de visibilidad (para los
+    # index-only scans) como estarían en una BDD que lleva tiempo funcionando
+    def analyze():
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for table in TABLES:
+                conn.exec_driver_sql(f"VACUUM ANALYZE {table}")
+        return 0
+    timed("vacuum analyze", analyze)
+    timings["total"] = round(time.perf_counter() - start, 2)
+    return {"seed": seed, "sizes": {"users": users, "books": books, "films": films, "loans": loans, "open_loans": open_loans,
+                                    "actors": actors}, "rows": counts, "timings_s": timings}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga datos deterministas a escala con COPY (borra los de la BDD de DB_NAME)")
+    parser.add_argument("--scale", type=float, default=0.01, help="fracción de la escala completa (1 = 10M de préstamos y 1M de títulos)")
+    parser.add_argument("--users", type=int, help="usuarios (por defecto según --scale)")
+    parser.add_argument("--books", type=int, help="libros (por defecto según --scale)")
+    parser.add_argument("--films", type=int, help="películas (por defecto según --scale)")
+    parser.add_argument("--loans", type=int, help="préstamos (por defecto según --scale)")
+    parser.add_argument("--open-fraction", type=float, default=OPEN_FRACTION, help="fracción de préstamos sin devolver")
+    parser.add_argument("--seed", type=int, default=1, help="semilla, los mismos tamaños y semilla dan los mismos datos")
+    parser.add_argument("--create", action="store_true", help="crear la BDD de DB_NAME si no existe y aplicar las migraciones")
+    parser.add_argument("--reset", action="store_true", help="borrar los datos que ya tenga la BDD")
+    args = parser.parse_args()
+
+    if args.create:
+        create_database()
+    sizes = scaled_sizes(args.scale, users=args.users, books=args.books, films=args.films, loans=args.loans)
+    print(f"Cargando en {DB_NAME}: {sizes['users']} usuarios, {sizes['books']} libros, {sizes['films']} películas y "
+          f"{sizes['loans']} préstamos (semilla {args.seed})")
+    result = seed_database(**sizes, open_fraction=args.open_fraction, seed=args.seed, reset=args.reset)
+    print(f"Cargado en {result['timings_s']['total']:.1f} s. Todos los usuarios tienen la contraseña {SEED_PASSWORD}")
+
+
+if __name__ == "__main__":
+    main()
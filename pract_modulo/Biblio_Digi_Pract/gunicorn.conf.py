@@ -0,0 +1,65 @@
+# Perfil de producción: gunicorn gestiona varios workers de uvicorn (event loop uvloop y parser HTTP httptools).
+#   gunicorn -c gunicorn.conf.py source_code.main:app
+# Todo se puede cambiar con variables de entorno, sin reconstruir la imagen
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+cpus = multiprocessing.cpu_count()
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# La API es asíncrona, así que un worker por CPU basta para tenerla ocupada; más workers solo añaden memoria y conexiones a la BDD
+workers = int(os.getenv("WEB_CONCURRENCY", cpus))
+worker_class = "uvicorn_worker.UvicornWorker"  # con loop y http en "auto" usa uvloop y httptools si están instalados
+
+# La app se importa una sola vez en el proceso maestro y los workers se crean con fork, así comparten en copia en escritura el
+# código ya importado (FastAPI, SQLAlchemy, pydantic...) y cada worker arranca sin volver a importar nada. La BDD no se toca al
+# importar (las conexiones se abren en el lifespan de cada worker), así que ningún worker hereda conexiones del maestro
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("1", "true", "yes")
+
+# Reciclado de workers: cada worker se reinicia después de max_requests peticiones (más un desfase aleatorio para que no se
+# reinicien todos a la vez), terminando antes las peticiones que tiene en curso durante como mucho graceful_timeout segundos
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", max_requests // 10))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG")  # sin log de accesos por defecto, "-" para sacarlo por la salida estándar
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# Cada worker tiene su propio pool de procesos de cifrado. Si no se indica otra cosa se reparten las CPUs entre los workers en
+# lugar de levantar un proceso de bcrypt por CPU en cada worker. Se fija aquí porque hashing.py lee la variable al importarse
+os.environ.setdefault("HASH_WORKERS", str(max(1, cpus // workers)))
+
+# Métricas de Prometheus de todos los workers (ver metrics.py): cada worker escribe las suyas en ficheros de este directorio y
+# /metrics las suma. Se fija antes de importar la app porque prometheus_client lo lee al importarse, y se vacía al arrancar para
+# no sumar las de una ejecución anterior
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "biblioteca_metrics"))
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+# Los objetos que ya existen en el maestro se sacan del recolector de basura antes del fork: si no, la primera recolección de
+# cada worker tocaría todas sus páginas y dejarían de estar compartidas
+def when_ready(server):
+    gc.freeze()
+
+
+# Por si algo ha abierto conexiones en el maestro, los workers empiezan con el pool vacío sin cerrar las conexiones heredadas
+# (que siguen siendo del maestro)
+def post_fork(server, worker):
+    from source_code.database import engine, async_engine
+    engine.dispose(close=False)
+    if async_engine is not None:
+        async_engine.sync_engine.dispose(close=False)
+
+
+# Los workers que terminan (reciclados o caídos) dejan de contar en las peticiones en curso y sus contadores e histogramas se
+# pasan a los ficheros de archivo, así el directorio de métricas no crece con cada reciclado (ver metrics.py)
+def child_exit(server, worker):
+    from source_code.metrics import archive_process_metrics
+    archive_process_metrics(worker.pid, os.environ["PROMETHEUS_MULTIPROC_DIR"])
@@ -0,0 +1,44 @@
+from logging.config import fileConfig
+from alembic import context
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+from source_code.database import SQLALCHEMY_DATABASE_URL, Base
+import source_code.models  # registra todas las tablas en Base.metadata
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+
+# Los índices de trigramas son índices sobre expresiones que solo se crean si el servidor tiene pg_trgm (ver 0001), no están en
+# los modelos y alembic check no debe proponer borrarlos
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == "index" and reflected and compare_to is None and name.endswith("_trgm"):
+        return False
+    return True
+
+
+def run_migrations_offline():
+    context.configure(url=SQLALCHEMY_DATABASE_URL, target_metadata=target_metadata, literal_binds=True,
+                      include_object=include_object)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+# Todas las migraciones pendientes van en una transacción con un cerrojo, así si se lanzan a la vez desde varios contenedores
+# solo una las aplica y las demás se encuentran el esquema ya actualizado
+def run_migrations_online():
+    connectable = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=NullPool)
+    with connectable.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object)
+        with context.begin_transaction():
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('biblioteca_schema'))"))
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,288 @@
+"""Esquema inicial
+
+Esquema de la API tal y como lo dejaba create_all más los triggers, la búsqueda de texto y los ejemplares. Todo se crea solo si
+no existe, así que sirve igual para una BDD vacía que para las que se crearon antes de Alembic (al arrancar la API): en esas
+además se aplican las migraciones de datos que antes hacía schema.py (reparto, loan_items y ejemplares) y se quedan marcadas
+con esta versión.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+import logging
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+# Copia de la constante de source_code/schema.py. Las migraciones no importan código de la API para que no cambien cuando
+# cambie la API
+SEARCH_CONFIG = "biblioteca_es"
+
+SEARCH_TRIGGERS = {
+    "books": ("name, author", "setweight(to_tsvector('{config}', coalesce(NEW.name, '')), 'A') || "
+                              "setweight(to_tsvector('{config}', coalesce(NEW.author, '')), 'B')"),
+    "films": ("name, actors", "setweight(to_tsvector('{config}', coalesce(NEW.name, '')), 'A') || "
+                              "setweight(to_tsvector('{config}', coalesce(NEW.actors, '')), 'B')"),
+}
+
+TRIGRAM_INDEXES = {
+    "ix_books_name_trgm": ("books", "name"),
+    "ix_books_author_trgm": ("books", "author"),
+    "ix_films_name_trgm": ("films", "name"),
+}
+
+COPY_TRIGGERS = {"books": "book_ref_number", "films": "film_ref_number"}
+
+ACTORS_MIGRATION = [
+    """INSERT INTO actors (full_name)
+       SELECT DISTINCT btrim(a.name) FROM films f, unnest(string_to_array(f.actors, ',')) AS a(name)
+       WHERE btrim(a.name) <> '' AND NOT EXISTS (SELECT 1 FROM film_actor fa WHERE fa.film_ref_number = f.ref_number)
+       ON CONFLICT (full_name) DO NOTHING""",
+    """INSERT INTO film_actor (film_ref_number, actor_id, position)
+       SELECT f.ref_number, ac.actor_id, min(a.position) - 1
+       FROM films f, unnest(string_to_array(f.actors, ',')) WITH ORDINALITY AS a(name, position)
+       JOIN actors ac ON ac.full_name = btrim(a.name)
+       WHERE NOT EXISTS (SELECT 1 FROM film_actor fa WHERE fa.film_ref_number = f.ref_number)
+       GROUP BY f.ref_number, ac.actor_id
+       ON CONFLICT DO NOTHING""",
+]
+
+LOAN_ITEMS_MIGRATION = """
+    INSERT INTO loan_items (loan_id, book_ref_number, film_ref_number, return_date)
+    SELECT p.loan_id, p.book_ref_number, NULL, p.return_date FROM prestamo p
+    WHERE p.book_ref_number IS NOT NULL AND NOT EXISTS (SELECT 1 FROM loan_items li WHERE li.loan_id = p.loan_id)
+    UNION ALL
+    SELECT p.loan_id, NULL, p.film_ref_number, p.return_date FROM prestamo p
+    WHERE p.film_ref_number IS NOT NULL AND NOT EXISTS (SELECT 1 FROM loan_items li WHERE li.loan_id = p.loan_id)"""
+
+COPIES_MIGRATION = [
+    "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS total_copies integer NOT NULL DEFAULT 1, "
+    "ADD COLUMN IF NOT EXISTS available_copies integer NOT NULL DEFAULT 1",
+    "UPDATE {table} SET available_copies = CASE WHEN available THEN 1 ELSE 0 END",
+    "ALTER TABLE {table} DROP COLUMN available, "
+    "ADD COLUMN available boolean GENERATED ALWAYS AS (available_copies > 0) STORED, "
+    "ADD CONSTRAINT ck_{table}_copies CHECK (available_copies >= 0 AND available_copies <= total_copies)",
+    "INSERT INTO copies ({column}, on_loan) SELECT ref_number, available_copies = 0 FROM {table}",
+    "UPDATE loan_items li SET copy_id = c.copy_id FROM copies c "
+    "WHERE c.{column} = li.{column} AND li.return_date IS NULL AND li.copy_id IS NULL",
+]
+
+
+def timestamp(name, **kw):
+    return sa.Column(name, sa.DateTime(timezone=True), **kw)
+
+
+def create_tables():
+    op.create_table("users",
+                    sa.Column("user_id", sa.Integer, primary_key=True),
+                    sa.Column("full_name", sa.String, nullable=False),
+                    timestamp("date_added", server_default=sa.func.now()),
+                    sa.Column("hashed_password", sa.String, nullable=False),
+                    sa.Column("contact_mail", sa.String, nullable=False),
+                    sa.Column("age", sa.Integer, nullable=True),
+                    if_not_exists=True)
+    op.create_table("genero",
+                    sa.Column("genre_id", sa.Integer, primary_key=True),
+                    sa.Column("genre_name", sa.String, nullable=False),
+                    if_not_exists=True)
+    for table, text_column in (("books", "author"), ("films", "actors")):
+        op.create_table(table,
+                        sa.Column("ref_number", sa.Integer, primary_key=True),
+                        sa.Column("name", sa.String),
+                        sa.Column(text_column, sa.String),
+                        sa.Column("total_copies", sa.Integer, nullable=False, server_default="1"),
+                        sa.Column("available_copies", sa.Integer, nullable=False, server_default="1"),
+                        sa.Column("available", sa.Boolean, sa.Computed("available_copies > 0", persisted=True)),
+                        timestamp("date_registered", server_default=sa.func.now()),
+                        sa.Column("genre_id", sa.Integer, sa.ForeignKey("genero.genre_id"), nullable=False),
+                        sa.Column("search_vector", TSVECTOR, nullable=True),
+                        sa.CheckConstraint("available_copies >= 0 AND available_copies <= total_copies", name=f"ck_{table}_copies"),
+                        if_not_exists=True)
+    op.create_table("actors",
+                    sa.Column("actor_id", sa.Integer, primary_key=True),
+                    sa.Column("full_name", sa.String, nullable=False),
+                    if_not_exists=True)
+    op.create_table("film_actor",
+                    sa.Column("film_ref_number", sa.Integer, sa.ForeignKey("films.ref_number", ondelete="CASCADE"), primary_key=True),
+                    sa.Column("actor_id", sa.Integer, sa.ForeignKey("actors.actor_id", ondelete="CASCADE"), primary_key=True),
+                    sa.Column("position", sa.Integer, nullable=False, server_default="0"),
+                    if_not_exists=True)
+    op.create_table("prestamo",
+                    sa.Column("loan_id", sa.Integer, primary_key=True),
+                    timestamp("loan_date", server_default=sa.func.now()),
+                    sa.Column("user_id", sa.Integer, sa.ForeignKey("users.user_id"), nullable=False),
+                    sa.Column("book_ref_number", sa.Integer, sa.ForeignKey("books.ref_number"), nullable=True),
+                    sa.Column("film_ref_number", sa.Integer, sa.ForeignKey("films.ref_number"), nullable=True),
+                    timestamp("return_date", nullable=True),
+                    if_not_exists=True)
+    op.create_table("copies",
+                    sa.Column("copy_id", sa.Integer, primary_key=True),
+                    sa.Column("barcode", sa.String, unique=True, nullable=False),
+                    sa.Column("book_ref_number", sa.Integer, sa.ForeignKey("books.ref_number", ondelete="CASCADE"), nullable=True),
+                    sa.Column("film_ref_number", sa.Integer, sa.ForeignKey("films.ref_number", ondelete="CASCADE"), nullable=True),
+                    sa.Column("on_loan", sa.Boolean, nullable=False, server_default="false"),
+                    timestamp("date_added", server_default=sa.func.now()),
+                    sa.CheckConstraint("num_nonnulls(book_ref_number, film_ref_number) = 1", name="ck_copies_one_title"),
+                    if_not_exists=True)
+    op.create_table("loan_items",
+                    sa.Column("loan_item_id", sa.Integer, primary_key=True),
+                    sa.Column("loan_id", sa.Integer, sa.ForeignKey("prestamo.loan_id", ondelete="CASCADE"), nullable=False),
+                    sa.Column("book_ref_number", sa.Integer, sa.ForeignKey("books.ref_number", ondelete="SET NULL"), nullable=True),
+                    sa.Column("film_ref_number", sa.Integer, sa.ForeignKey("films.ref_number", ondelete="SET NULL"), nullable=True),
+                    sa.Column("copy_id", sa.Integer, sa.ForeignKey("copies.copy_id", ondelete="SET NULL"), nullable=True),
+                    timestamp("return_date", nullable=True),
+                    sa.CheckConstraint("num_nonnulls(book_ref_number, film_ref_number) <= 1", name="ck_loan_items_one_item"),
+                    if_not_exists=True)
+
+
+# (nombre, tabla, columnas, opciones)
+INDEXES = [
+    ("ix_users_user_id", "users", ["user_id"], {}),
+    ("ix_users_full_name", "users", ["full_name"], {}),
+    ("ix_users_contact_mail", "users", ["contact_mail"], {"unique": True}),
+    ("ix_users_age", "users", ["age"], {}),
+    ("ix_users_full_name_user_id", "users", ["full_name", "user_id"], {}),
+    ("ix_genero_genre_id", "genero", ["genre_id"], {}),
+    ("ix_genero_genre_name", "genero", ["genre_name"], {"unique": True}),
+    ("ix_books_ref_number", "books", ["ref_number"], {}),
+    ("ix_books_name", "books", ["name"], {"unique": True}),
+    ("ix_books_author", "books", ["author"], {}),
+    ("ix_books_date_registered", "books", ["date_registered"], {}),
+    ("ix_books_genre_id_ref_number", "books", ["genre_id", "ref_number"], {}),
+    ("ix_books_free_genre_id_ref_number", "books", ["genre_id", "ref_number"], {"postgresql_where": sa.text("available_copies > 0")}),
+    ("ix_books_search_vector", "books", ["search_vector"], {"postgresql_using": "gin"}),
+    ("ix_films_ref_number", "films", ["ref_number"], {}),
+    ("ix_films_name", "films", ["name"], {"unique": True}),
+    ("ix_films_date_registered", "films", ["date_registered"], {}),
+    ("ix_films_genre_id_ref_number", "films", ["genre_id", "ref_number"], {}),
+    ("ix_films_free_genre_id_ref_number", "films", ["genre_id", "ref_number"], {"postgresql_where": sa.text("available_copies > 0")}),
+    ("ix_films_search_vector", "films", ["search_vector"], {"postgresql_using": "gin"}),
+    ("ix_actors_actor_id", "actors", ["actor_id"], {}),
+    ("ix_actors_full_name", "actors", ["full_name"], {"unique": True}),
+    ("ix_film_actor_actor_id_film_ref_number", "film_actor", ["actor_id", "film_ref_number"], {}),
+    ("ix_prestamo_loan_id", "prestamo", ["loan_id"], {}),
+    ("ix_prestamo_loan_date", "prestamo", ["loan_date"], {}),
+    ("ix_prestamo_user_id_loan_id", "prestamo", ["user_id", "loan_id"], {}),
+    ("ix_prestamo_open_user_id", "prestamo", ["user_id"], {"postgresql_where": sa.text("return_date IS NULL")}),
+    ("ix_copies_book_ref_number_copy_id", "copies", ["book_ref_number", "copy_id"], {}),
+    ("ix_copies_film_ref_number_copy_id", "copies", ["film_ref_number", "copy_id"], {}),
+    ("ix_copies_free_book_ref_number", "copies", ["book_ref_number", "copy_id"], {"postgresql_where": sa.text("NOT on_loan")}),
+    ("ix_copies_free_film_ref_number", "copies", ["film_ref_number", "copy_id"], {"postgresql_where": sa.text("NOT on_loan")}),
+    ("ix_loan_items_loan_id", "loan_items", ["loan_id"], {}),
+    ("ix_loan_items_open_book_ref_number", "loan_items", ["book_ref_number"], {"postgresql_where": sa.text("return_date IS NULL")}),
+    ("ix_loan_items_open_film_ref_number", "loan_items", ["film_ref_number"], {"postgresql_where": sa.text("return_date IS NULL")}),
+]
+
+# Índices de versiones anteriores que ya no usa ninguna consulta (los préstamos abiertos de cada título están ahora en loan_items)
+OBSOLETE_INDEXES = ["ix_prestamo_open_book_ref_number", "ix_prestamo_open_film_ref_number"]
+
+
+# Las extensiones se instalan solo si el servidor las tiene; la API mira al arrancar cuáles hay (ver schema.py)
+def create_search_config(conn):
+    available = set(conn.execute(sa.text("SELECT name FROM pg_available_extensions WHERE name IN ('unaccent', 'pg_trgm')")).scalars())
+    for name in ("unaccent", "pg_trgm"):
+        if name in available:
+            op.execute(f"CREATE EXTENSION IF NOT EXISTS {name}")
+        else:
+            logger.warning(f"La extensión {name} no está disponible en el servidor, la búsqueda funcionará sin ella")
+    if not conn.scalar(sa.text("SELECT 1 FROM pg_ts_config WHERE cfgname = :name"), {"name": SEARCH_CONFIG}):
+        op.execute(f"CREATE TEXT SEARCH CONFIGURATION {SEARCH_CONFIG} (COPY = pg_catalog.spanish)")
+    if "unaccent" in available:
+        op.execute(f"ALTER TEXT SEARCH CONFIGURATION {SEARCH_CONFIG} ALTER MAPPING FOR hword, hword_part, word WITH unaccent, spanish_stem")
+    # unaccent() no es IMMUTABLE y no se puede usar en un índice, así que lo envolvemos indicando el diccionario explícitamente
+    body = "SELECT public.unaccent('public.unaccent'::regdictionary, $1)" if "unaccent" in available else "SELECT $1"
+    op.execute(f"CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT AS $$ {body} $$")
+    return "pg_trgm" in available
+
+
+def create_search_triggers(conn, trigram):
+    for table, (columns, expression) in SEARCH_TRIGGERS.items():
+        expression = expression.format(config=SEARCH_CONFIG)
+        op.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector")
+        op.execute(f"CREATE OR REPLACE FUNCTION {table}_search_vector_update() RETURNS trigger LANGUAGE plpgsql AS $$ "
+                   f"BEGIN NEW.search_vector := {expression}; RETURN NEW; END $$")
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_search_vector ON {table}")
+        op.execute(f"CREATE TRIGGER {table}_search_vector BEFORE INSERT OR UPDATE OF {columns} ON {table} "
+                   f"FOR EACH ROW EXECUTE FUNCTION {table}_search_vector_update()")
+        # Las filas que ya existían antes del trigger se rellenan una sola vez con la misma expresión. Un UPDATE que solo cambia
+        # search_vector no dispara el trigger, que solo salta al cambiar las columnas de las que sale el vector
+        filled = conn.execute(sa.text(f"UPDATE {table} SET search_vector = {expression.replace('NEW.', '')} "
+                                      f"WHERE search_vector IS NULL")).rowcount
+        if filled:
+            logger.info(f"Vector de búsqueda calculado para {filled} filas de {table}")
+    if trigram:
+        for index_name, (table, column) in TRIGRAM_INDEXES.items():
+            op.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} USING gin (f_unaccent(lower({column})) gin_trgm_ops)")
+
+
+def create_copy_triggers():
+    op.execute("CREATE OR REPLACE FUNCTION copies_barcode() RETURNS trigger LANGUAGE plpgsql AS $$ "
+               "BEGIN IF NEW.barcode IS NULL THEN NEW.barcode := 'EJ' || lpad(NEW.copy_id::text, 8, '0'); END IF; RETURN NEW; END $$")
+    op.execute("DROP TRIGGER IF EXISTS copies_barcode ON copies")
+    op.execute("CREATE TRIGGER copies_barcode BEFORE INSERT ON copies FOR EACH ROW EXECUTE FUNCTION copies_barcode()")
+    for table, column in COPY_TRIGGERS.items():
+        op.execute(f"CREATE OR REPLACE FUNCTION {table}_initial_copies() RETURNS trigger LANGUAGE plpgsql AS $$ "
+                   f"BEGIN INSERT INTO copies ({column}) SELECT NEW.ref_number FROM generate_series(1, NEW.total_copies); "
+                   f"RETURN NULL; END $$")
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_initial_copies ON {table}")
+        op.execute(f"CREATE TRIGGER {table}_initial_copies AFTER INSERT ON {table} FOR EACH ROW EXECUTE FUNCTION {table}_initial_copies()")
+
+
+# Migraciones de datos de las BDD anteriores a Alembic, en una BDD nueva no hacen nada. Los préstamos se pasan a loan_items antes
+# de crear los ejemplares (para asignar un ejemplar a los que siguen abiertos) y los índices parciales de libros y películas
+# necesitan los contadores, así que los ejemplares van antes de los índices y el reparto, que usa el índice único de actors, después.
+# Los ejemplares se crean sin código de barras, así que el trigger copies_barcode tiene que existir antes
+def migrate_loans_and_copies(conn):
+    migrated = conn.execute(sa.text(LOAN_ITEMS_MIGRATION)).rowcount
+    if migrated:
+        logger.info(f"Artículos de los préstamos migrados a loan_items ({migrated} filas)")
+    op.execute("ALTER TABLE loan_items ADD COLUMN IF NOT EXISTS copy_id integer REFERENCES copies (copy_id) ON DELETE SET NULL")
+    for table, column in COPY_TRIGGERS.items():
+        generated = conn.scalar(sa.text("SELECT is_generated FROM information_schema.columns "
+                                        "WHERE table_schema = current_schema() AND table_name = :table AND column_name = 'available'"),
+                                {"table": table})
+        if generated != "NEVER":
+            continue
+        for statement in COPIES_MIGRATION:
+            op.execute(statement.format(table=table, column=column))
+        logger.info(f"Creados los ejemplares de {table} y sus contadores")
+
+
+def migrate_actors(conn):
+    for statement in ACTORS_MIGRATION:
+        migrated = conn.execute(sa.text(statement)).rowcount
+    if migrated:
+        logger.info(f"Reparto de películas migrado a film_actor ({migrated} filas)")
+
+
+def upgrade():
+    conn = op.get_bind()
+    trigram = create_search_config(conn)
+    create_tables()
+    # En las BDD anteriores a Alembic las tablas ya existen sin search_vector ni triggers: la columna la necesita el índice GIN de
+    # INDEXES y el trigger de los códigos de barras los ejemplares que crea migrate_loans_and_copies
+    create_search_triggers(conn, trigram)
+    create_copy_triggers()
+    migrate_loans_and_copies(conn)
+    for name, table, columns, options in INDEXES:
+        op.create_index(name, table, columns, if_not_exists=True, **options)
+    migrate_actors(conn)
+    for name in OBSOLETE_INDEXES:
+        op.drop_index(name, table_name="prestamo", if_exists=True)
+
+
+def downgrade():
+    for table in ("loan_items", "copies", "prestamo", "film_actor", "actors", "films", "books", "genero", "users"):
+        op.drop_table(table)
+    for function in ("copies_barcode()", "books_initial_copies()", "films_initial_copies()",
+                     "books_search_vector_update()", "films_search_vector_update()", "f_unaccent(text)"):
+        op.execute(f"DROP FUNCTION IF EXISTS {function}")
+    op.execute(f"DROP TEXT SEARCH CONFIGURATION IF EXISTS {SEARCH_CONFIG}")
@@ -0,0 +1,45 @@
+"""Géneros N:M de libros y películas
+
+Las tablas de asociación del diagrama (un libro o una película puede tener varios géneros). genre_id sigue siendo el género
+principal y un trigger lo mantiene también en la tabla de asociación, así que las altas de la API y de la carga masiva no
+cambian. Los títulos que ya existían se rellenan con su género principal.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+# tabla de títulos -> (tabla de asociación, columna del título)
+GENRE_ASSOCIATIONS = {
+    "books": ("book_genre_association", "book_ref_number"),
+    "films": ("film_genre_association", "film_ref_number"),
+}
+
+
+def upgrade():
+    for table, (association, column) in GENRE_ASSOCIATIONS.items():
+        op.create_table(association,
+                        sa.Column(column, sa.Integer, sa.ForeignKey(f"{table}.ref_number", ondelete="CASCADE"), primary_key=True),
+                        sa.Column("genre_id", sa.Integer, sa.ForeignKey("genero.genre_id", ondelete="CASCADE"), primary_key=True))
+        op.create_index(f"ix_{association}_genre_id_{column}", association, ["genre_id", column])
+        op.execute(f"CREATE OR REPLACE FUNCTION {table}_main_genre() RETURNS trigger LANGUAGE plpgsql AS $$ "
+                   f"BEGIN INSERT INTO {association} ({column}, genre_id) VALUES (NEW.ref_number, NEW.genre_id) "
+                   f"ON CONFLICT DO NOTHING; RETURN NULL; END $$")
+        op.execute(f"CREATE TRIGGER {table}_main_genre AFTER INSERT OR UPDATE OF genre_id ON {table} "
+                   f"FOR EACH ROW EXECUTE FUNCTION {table}_main_genre()")
+        op.execute(f"INSERT INTO {association} ({column}, genre_id) SELECT ref_number, genre_id FROM {table} ON CONFLICT DO NOTHING")
+
+
+def downgrade():
+    for table, (association, column) in GENRE_ASSOCIATIONS.items():
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_main_genre ON {table}")
+        op.execute(f"DROP FUNCTION IF EXISTS {table}_main_genre()")
+        op.drop_table(association)
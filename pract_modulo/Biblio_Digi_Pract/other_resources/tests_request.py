@@ -1,348 +1,318 @@
-import requests
+# Generador de carga para la API. Antes este fichero era una lista de peticiones de prueba con requests que se iban descomentando
+# a mano (alta de usuarios, géneros, libros y películas, préstamos, devoluciones...); ahora esas mismas peticiones están agrupadas
+# en escenarios que se lanzan con muchos clientes a la vez y se miden:
+#
+#   registration   ráfaga de altas de usuarios (POST /Usuarios/, cada una paga un cifrado de bcrypt)
+#   catalog        navegación por el catálogo: listado de libros y su página siguiente, un libro, una búsqueda, películas y géneros
+#   checkout       ciclo de préstamo y devolución de un libro (POST /Realizar_un_prestamo/ y PATCH /Devolver_prestamo/)
+#   mixed          mezcla de los anteriores con los pesos de MIXED_WEIGHTS
+#
+# Cada escenario es un recorrido de un usuario con varias peticiones. Sin --rate los clientes (--concurrency) encadenan un recorrido
+# tras otro lo más rápido que pueden (carga cerrada). Con --rate los recorridos llegan a ese ritmo por segundo (llegadas de Poisson)
+# con como mucho --concurrency en curso, y su latencia se mide desde la hora a la que tenían que empezar, así que la espera cuando
+# la API no da abasto también cuenta. De cada petición salen p50/p95/p99/max, los errores por código o excepción y, con --output,
+# un JSON con las claves ordenadas para poder compararlo con el de otra ejecución (diff o --compare).
+#
+# Antes de medir se crean los datos que necesita el escenario (género, libros y películas con ejemplares, usuarios), con nombres
+# propios de la ejecución para no chocar con otras. Se ejecuta desde la carpeta del proyecto con la API levantada:
+#   python -m other_resources.tests_request --scenario mixed --duration 30 --concurrency 32
+#   python -m other_resources.tests_request --scenario catalog --rate 50 --duration 60 --output resultados/catalogo.json
+#   python -m other_resources.tests_request --start-server --scenario checkout --duration 20
+#   python -m other_resources.tests_request --compare resultados/antes.json resultados/despues.json
+from benchmarks.bench_server import launch, wait_ready, PROFILES
+from collections import Counter
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import random
 import json
-
-# # Añdimos unos cuantos usuarios 
-# url = "http://127.0.0.1:8000/Usuarios/"
-
-# user1 = {
-#     "full_name": "Ana Garcia Herrero",
-#     "contact_mail": "ana.garcia@example.com",
-#     "age": 24,
-#     "hashed_password": "ILOVEFLOWERS"
-# }
-
-# user2 = {
-#     "full_name": "Juan Perez Arriaga",
-#     "contact_mail": "juan.perez@example.com",
-#     "age": 55,
-#     "hashed_password": "JuanintheBest"
-# }
-
-# user3 = {
-#     "full_name": "Fernando Alonso Torres",
-#     "contact_mail": "fenandito@example.com",
-#     "age": 33,
-#     "hashed_password": "Elnano33"
-# }
-
-# users = [user1, user2, user3]
-
-# for u in users:
-#     response = requests.post(url, json=u)
-#     print(f"Código de respuesta: {response.status_code}")
-#     print(f"Respuesta: {response.json()}")
-    
-# # Prueba del método get de usuarios
-
-# name = "Fernando Alonso Torres"
-# url = f"http://127.0.0.1:8000/Usuarios/{name}"
-
-# response = requests.get(url)
-# print(f"Código de respuesta: {response.status_code}")
-# print(f"Respuesta: {response.json()}")
-
-
-# # Añadimos unos cuantos géneros
-
-# url = f"http://127.0.0.1:8000/Generos/"
-
-# genre_data1 = {
-#     "genre_name":"Accion",
-# }
-
-# genre_data2 = {
-#     "genre_name":"Suspense",
-# }
-
-# genre_data3 = {
-#     "genre_name":"Terror",
-# }
-
-# genres = [genre_data1, genre_data2, genre_data3]
-
-# for g in genres:
-#     response = requests.post(url, json=g)
-#     print(f"Código de respuesta: {response.status_code}")
-#     print(f"Respuesta: {response.json()}")
-    
-    
-    
-# # Añadimos unos cuantos items a la biblioteca:
-# # Añadimos unos libros:
-# url_books = "http://127.0.0.1:8000/Libros/"
-# book_data1 = {
-#     "name": "Asesinato en el Orient Express",
-#     "author": "Agatha Chrsitie Clarissa" 
-# }
-
-# book_data2 = {
-#     "name": "Geronimo Stilton",
-#     "author": "Elisabetta Dami Dami" 
-# }
-
-# book_data3 = {
-#     "name": "Harry Potter y la piedra filosofal",
-#     "author": "Joanne Kathleen Rowling" 
-# }
-
-# books_to_create = [book_data1, book_data2, book_data3]
-
-# genres_for_books = ["Misterio", "Infantil", "Fantasia"]
-
-
-# for i, book_data in enumerate(books_to_create):
-#     genre = genres_for_books[i]
-    
-    
-#     full_url = f"{url_books}?genre_name={genre}"
-    
-#     response = requests.post(full_url, json=book_data)
-    
-#     print(f"--- Creando Libro: '{book_data['name']}' (Género: {genre}) ---")
-#     print(f"Código de respuesta: {response.status_code}")
-#     print(f"Respuesta: {json.dumps(response.json(), indent=2, ensure_ascii=False)}") 
-    
-
-# # Añadimos una cuantas películas:
-
-
-# url_films = "http://127.0.0.1:8000/Peliculas/"
-
-
-# film_data1 = {
-#     "name": "Interestellar",
-#     "actors": "Matthew McConaughey, Anne Hathaway, Jessica Chastain"
-# }
-
-# film_data2 = {
-#     "name": "El Señor de los Anillos: La Comunidad del Anillo",
-#     "actors": "Elijah Wood, Ian McKellen, Viggo Mortensen"
-# }
-
-# film_data3 = {
-#     "name": "Origen", 
-#     "actors": "Leonardo DiCaprio, Joseph Gordon-Levitt, Elliot Page"
-# }
-
-
-# films_to_create = [film_data1, film_data2, film_data3]
-
-
-# genres_for_films = ["Ciencia Ficcion", "Fantasia", "Ciencia Ficcion"]
-
-
-# for i, film_data in enumerate(films_to_create):
-#     genre = genres_for_films[i]
-    
-    
-#     full_url = f"{url_films}?genre_name={genre}"
-    
-#     response = requests.post(full_url, json=film_data)
-    
-#     print(f"--- Creando Película: '{film_data['name']}' (Género: {genre}) ---")
-#     print(f"Código de respuesta: {response.status_code}")
-#     print(f"Respuesta: {json.dumps(response.json(), indent=2, ensure_ascii=False)}")
-
-
-
-# Realizamos un préstamo de un libro solo
-
-# url_loan = "http://127.0.0.1:8000/Realizar_un_prestamo/"
-
-# user_data = {
-#     "full_name": "Juan Perez Arriaga",
-#     "contact_mail": "juan.perez@example.com",
-#     "hashed_password": "JuanintheBest"
-# }
-
-# book_data = {
-#     "name": "Harry Potter y la piedra filosofal", 
-#     "author": "J. K. Rowling"
-# }
-
-# response = requests.post(
-#     url_loan,
-#     json={
-#         "user": user_data,
-#         "book": book_data,
-#         "film": None 
-#     }
-# )
-
-# print(f"--- Préstamo de Libro ---")
-# print(f"Código de respuesta: {response.status_code}")
-# print(f"Respuesta: {json.dumps(response.json(), indent=2)}")
-
-
-
-# # Test: Solo préstamo de la película
-
-# url_loan = "http://127.0.0.1:8000/Realizar_un_prestamo/"
-# user_data = {
-#     "full_name": "Ana Garcia Herrero",
-#     "contact_mail": "ana.garcia@example.com",
-#     "hashed_password": "ILOVEFLOWERS"
-# }
-
-# film_data = {
-#     "name": "Die Hard", 
-#     "actors": "Bruce Willis, Alan Rickman, Bonnie Bedelia"
-# }
-# response = requests.post(
-#     url_loan,
-#     json={
-#         "user": user_data,
-#         "book": None,
-#         "film": film_data
-#     }
-# )
-# print(f"\n--- Préstamo de Película ---")
-# print(f"Código de respuesta: {response.status_code}")
-# print(f"Respuesta: {json.dumps(response.json(), indent=2)}")
-
-
-
-
-# url_loan = "http://127.0.0.1:8000/Realizar_un_prestamo/"
-# user_data = {
-#     "full_name": "Juan Perez Arriaga",
-#     "contact_mail": "juan.perez@example.com",
-#     "hashed_password": "JuanintheBest"
-# }
-# book_data = {
-#     "name": "El Hobbit",
-#     "author": "J.R. R. Tolkien"
-# }
-
-# film_data = {
-#     "name": "Inception",
-#     "actors": "Leonardo DiCaprio, Joseph Gordon-Levitt"
-# }
-# response = requests.post(
-#     url_loan,
-#     json={
-#         "user": user_data,
-#         "book": book_data,
-#         "film": film_data
-#     }
-# )
-
-# print(f"\n--- Préstamo de Libro y Película (fallara porque no existen algunos de los item pedidos) ---")
-# print(f"Código de respuesta: {response.status_code}")
-# print(f"Respuesta: {json.dumps(response.json(), indent=2)}")
-
-
-# # Intentar prestar nada (va salir como Bad Request)
-# response_none = requests.post(
-#     url_loan,
-#     json={
-#         "user": user_data,
-#         "book": None,
-#         "film": None
-#     }
-# )
-
-# print(f"\n--- Préstamo de Nada (debería fallar) ---")
-# print(f"Código de respuesta: {response_none.status_code}")
-# print(f"Respuesta: {json.dumps(response_none.json(), indent=2)}")
-
-
-# Devolución de préstamos
-# url_return = "http://127.0.0.1:8000/Devolver_prestamo/"
-
-
-# user_data_existing = {
-#     "full_name": "Juan Perez Arriaga",
-#     "contact_mail": "juan.perez@example.com",
-#     "hashed_password": "JuanintheBest"
-# }
-# loan_data_empty = {
-#     "user_id": 2,
-#     "book_ref_number": None, 
-#     "film_ref_number": None  
-# }
-
-
-# response = requests.patch(
-#     url_return,
-#     json=loan_data_empty
-# )
-
-# print(f"\n--- Intentando Devolver Préstamo SIN Libro ni Película ---")
-# print(f"Código de respuesta: {response.status_code}")
-# print(f"Respuesta: {json.dumps(response.json(), indent=2, ensure_ascii=False)}")
-
-
-# # Test: Devolver un préstamo
-
-
-# URL_BASE = "http://127.0.0.1:8000"
-# URL_DEVOLVER = f"{URL_BASE}/Devolver_prestamo"
-
-
-# user_id_del_prestamo = 2
-
-# book_ref_number_del_libro_prestado = 3 
-# film_ref_number_del_prestamo = None
-
-# payload_devolucion = {
-#     "user_id": user_id_del_prestamo,
-#     "book_ref_number": book_ref_number_del_libro_prestado,
-#     "film_ref_number": film_ref_number_del_prestamo
-# }
-# response = requests.patch(
-#     URL_DEVOLVER,
-#     json=payload_devolucion
-# )
-
-# print(f"--- Devolución de Préstamo (Libro: Harry Potter) ---")
-# print(f"Código de respuesta: {response.status_code}")
-# print(f"Respuesta: {json.dumps(response.json(), indent=2, ensure_ascii=False)}")
-
-
-
-# # Test: Modificar los valores de un usuario:
-
-
-
-# URL_BASE = "http://127.0.0.1:8000"
-
-
-# create_url = f"{URL_BASE}/Usuarios/"
-# user_data_create = {
-#         "full_name": "Usuario Patch Simple",
-#         "contact_mail": "patch.simple@example.com",
-#         "hashed_password": "PasswordSimple123!",
-#         "age": 29
-#     }
-# response = requests.post(create_url, json=user_data_create)
-# print(f"Código de respuesta: {response.status_code}")
-# print(f"Respuesta: {json.dumps(response.json(), indent=2, ensure_ascii=False)}")
-
-
-# user_data_modified = {
-#         "full_name": "Mi Usuario Simple",
-#         "age": 27
-#     }
-
-# url = f"{URL_BASE}/Usuarios/4/Perfil_de_usuario/"
-
-# response = requests.patch(url, json=user_data_modified)
-# print(f"Código de respuesta: {response.status_code}")
-# print(f"Respuesta: {json.dumps(response.json(), indent=2, ensure_ascii=False)}")
-
-
-
-
-
-# # Test: Borrar un libro:
+import time
+import os
+import httpx
 
 URL_BASE = "http://127.0.0.1:8000"
 
-BOOK_REF_TO_DELETE = 1 
-URL_DELETE_BOOK = f"{URL_BASE}/Libros/{BOOK_REF_TO_DELETE}/"
-
-print(f"--- Intentando borrar el libro con referencia: {BOOK_REF_TO_DELETE} ---")
-print(f"URL de la petición: {URL_DELETE_BOOK}")
-response = requests.delete(URL_DELETE_BOOK)
-print(f"Código de respuesta: {response.status_code}")
\ No newline at end of file
+MIXED_WEIGHTS = {"catalog": 70, "checkout": 20, "registration": 10}
+SEARCH_WORDS = ["carga", "libro", "pelicula", "harry", "anillo", "origen", "misterio"]
+
+
+def percentiles(values: list):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None, "mean": None}
+    values = sorted(values)
+    n = len(values)
+    rank = lambda p: values[min(n - 1, int(round(p * (n - 1))))]
+    return {"p50": round(rank(0.50) * 1000, 2), "p95": round(rank(0.95) * 1000, 2), "p99": round(rank(0.99) * 1000, 2),
+            "max": round(values[-1] * 1000, 2), "mean": round(sum(values) / n * 1000, 2)}
+
+
+# Latencias y resultados de cada petición, agrupadas por método y plantilla de la ruta ("GET /Libros/{name}") y no por la ruta real
+class Recorder:
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+        self.journeys = {}
+
+    async def call(self, client, name: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+            self.errors.setdefault(name, Counter())[type(e).__name__] += 1
+            return None
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+        self.statuses.setdefault(name, Counter())[str(response.status_code)] += 1
+        if response.status_code >= 400:
+            self.errors.setdefault(name, Counter())[str(response.status_code)] += 1
+        return response
+
+    def journey(self, scenario: str, elapsed: float):
+        self.journeys.setdefault(scenario, []).append(elapsed)
+
+    def results(self, elapsed: float):
+        requests = {}
+        for name, latencies in self.latencies.items():
+            errors = self.errors.get(name, Counter())
+            requests[name] = {"count": len(latencies), "per_s": round(len(latencies) / elapsed, 2), "errors": dict(errors),
+                              "statuses": dict(self.statuses.get(name, Counter())), "latency_ms": percentiles(latencies)}
+        journeys = {name: {"count": len(latencies), "per_s": round(len(latencies) / elapsed, 2), "latency_ms": percentiles(latencies)}
+                    for name, latencies in self.journeys.items()}
+        by_type = Counter()
+        for name, errors in self.errors.items():
+            for kind, count in errors.items():
+                by_type[f"{name} {kind}"] += count
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {"requests": requests, "journeys": journeys,
+                "totals": {"requests": total, "per_s": round(total / elapsed, 2), "errors": sum(by_type.values()),
+                           "latency_ms": percentiles([l for latencies in self.latencies.values() for l in latencies])},
+                "errors": dict(by_type)}
+
+
+# Datos que usan los escenarios: se crean antes de medir y con el id de la ejecución en el nombre
+async def prepare(client, args, run_id: str, scenario: str):
+    fixture = {"books": [], "films": [], "users": asyncio.Queue()}
+    genre = f"Carga{run_id}"
+    needs_catalog = scenario in ("catalog", "checkout", "mixed")
+    for i in range(args.titles if needs_catalog else 0):
+        book = {"name": f"Libro de carga {run_id} {i}", "author": "Autora Carga Prueba"}
+        film = {"name": f"Pelicula de carga {run_id} {i}", "actors": "Actriz de Carga, Actor de Prueba"}
+        for kind, path, item in (("books", "/Libros/", book), ("films", "/Peliculas/", film)):
+            response = await client.post(path, params={"genre_name": genre}, json=item)
+            if response.status_code != 201:
+                raise RuntimeError(f"No se ha podido crear {item['name']}: {response.status_code} {response.text[:200]}")
+            if kind == "books" and args.copies > 1:
+                await client.post(f"/Libros/{item['name']}/Ejemplares", json={"copies": args.copies - 1})
+            fixture[kind].append({**item, "ref_number": response.json()["ref_number"]})
+
+    # Cada cliente coge un usuario de la cola para todo su recorrido de préstamo, así dos recorridos a la vez nunca devuelven
+    # el préstamo del otro. Los usuarios se crean a la vez porque cada alta tarda lo que un cifrado de bcrypt
+    async def create_user(i: int):
+        user = {"full_name": f"Usuaria Carga Prueba{i}", "contact_mail": f"carga{run_id}.{i}@example.com",
+                "hashed_password": "CargaPrueba123", "age": 30}
+        response = await client.post("/Usuarios/", json=user)
+        if response.status_code != 201:
+            raise RuntimeError(f"No se ha podido crear el usuario {user['contact_mail']}: {response.status_code} {response.text[:200]}")
+        await fixture["users"].put({**user, "user_id": response.json()["user_id"]})
+
+    if scenario in ("checkout", "mixed"):
+        await asyncio.gather(*(create_user(i) for i in range(args.users or args.concurrency)))
+    return fixture
+
+
+async def registration(client, recorder: Recorder, fixture, rng: random.Random):
+    n = f"{time.time_ns():x}{rng.getrandbits(24):06x}"
+    await recorder.call(client, "POST /Usuarios/", "POST", "/Usuarios/",
+                        json={"full_name": "Usuario Alta Prueba", "contact_mail": f"alta.{n}@example.com",
+                              "hashed_password": "AltaPrueba123", "age": rng.randint(18, 80)})
+
+
+async def catalog(client, recorder: Recorder, fixture, rng: random.Random):
+    response = await recorder.call(client, "GET /Libros/", "GET", "/Libros/", params={"limit": 20})
+    if response is not None and response.status_code == 200 and response.json().get("next_cursor"):
+        await recorder.call(client, "GET /Libros/ (siguiente)", "GET", "/Libros/",
+                            params={"limit": 20, "cursor": response.json()["next_cursor"]})
+    if fixture["books"]:
+        await recorder.call(client, "GET /Libros/{name}", "GET", f"/Libros/{rng.choice(fixture['books'])['name']}")
+    await recorder.call(client, "GET /Buscar", "GET", "/Buscar", params={"q": rng.choice(SEARCH_WORDS), "limit": 20})
+    await recorder.call(client, "GET /Peliculas/", "GET", "/Peliculas/", params={"limit": 20})
+    await recorder.call(client, "GET /Generos/", "GET", "/Generos/")
+
+
+async def checkout(client, recorder: Recorder, fixture, rng: random.Random):
+    user = await fixture["users"].get()
+    try:
+        book = rng.choice(fixture["books"])
+        response = await recorder.call(client, "POST /Realizar_un_prestamo/", "POST", "/Realizar_un_prestamo/",
+                                       json={"user": {k: user[k] for k in ("full_name", "contact_mail", "hashed_password")},
+                                             "book": {"name": book["name"], "author": book["author"]}})
+        if response is not None and response.status_code == 201:
+            await recorder.call(client, "PATCH /Devolver_prestamo/", "PATCH", "/Devolver_prestamo/",
+                                json={"user_id": user["user_id"], "book_ref_number": book["ref_number"], "film_ref_number": None})
+    finally:
+        fixture["users"].put_nowait(user)
+
+
+async def mixed(client, recorder: Recorder, fixture, rng: random.Random):
+    name = rng.choices(list(MIXED_WEIGHTS), weights=list(MIXED_WEIGHTS.values()))[0]
+    await SCENARIOS[name](client, recorder, fixture, rng)
+
+
+SCENARIOS = {"registration": registration, "catalog": catalog, "checkout": checkout, "mixed": mixed}
+
+
+# Carga cerrada: cada cliente empieza un recorrido en cuanto acaba el anterior
+async def closed_load(client, recorder: Recorder, fixture, scenario: str, concurrency: int, duration: float, seed: int):
+    deadline = time.perf_counter() + duration
+
+    async def user(rng: random.Random):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await SCENARIOS[scenario](client, recorder, fixture, rng)
+            recorder.journey(scenario, time.perf_counter() - start)
+
+    await asyncio.gather(*(user(random.Random(seed + i)) for i in range(concurrency)))
+    return 0
+
+
+# Carga abierta: los recorridos llegan a un ritmo fijo aunque la API vaya lenta. Los que no caben esperan un hueco y los que se
+# acumulan por encima de 10 veces la concurrencia se descartan (la API no da abasto) y se cuentan aparte
+async def open_load(client, recorder: Recorder, fixture, scenario: str, concurrency: int, duration: float, rate: float, seed: int):
+    rng = random.Random(seed)
+    slots = asyncio.Semaphore(concurrency)
+    tasks, dropped = set(), 0
+
+    async def arrival(scheduled: float):
+        async with slots:
+            await SCENARIOS[scenario](client, recorder, fixture, rng)
+        recorder.journey(scenario, time.perf_counter() - scheduled)
+
+    start = time.perf_counter()
+    scheduled = start
+    while True:
+        scheduled += rng.expovariate(rate)
+        if scheduled - start >= duration:
+            break
+        await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+        if len(tasks) >= concurrency * 10:
+            dropped += 1
+            continue
+        task = asyncio.create_task(arrival(scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return dropped
+
+
+async def run(args):
+    server = launch(args.server_profile, args.port) if args.start_server else None
+    url = f"http://127.0.0.1:{args.port}" if server is not None else args.url
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    run_id = f"{int(time.time()) % 1000000:06d}{random.getrandbits(16):04x}"
+    try:
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout) as client:
+            if server is not None:
+                await wait_ready(client, server)
+            fixture = await prepare(client, args, run_id, args.scenario)
+
+            async def load(recorder: Recorder, duration: float):
+                if args.rate:
+                    return await open_load(client, recorder, fixture, args.scenario, args.concurrency, duration, args.rate, args.seed)
+                return await closed_load(client, recorder, fixture, args.scenario, args.concurrency, duration, args.seed)
+
+            if args.warmup > 0:
+                await load(Recorder(), args.warmup)
+            recorder = Recorder()
+            started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            start = time.perf_counter()
+            dropped = await load(recorder, args.duration)
+            elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            server.log.close()
+
+    config = {"scenario": args.scenario, "mode": "open" if args.rate else "closed", "concurrency": args.concurrency,
+              "rate": args.rate, "duration_s": args.duration, "warmup_s": args.warmup, "seed": args.seed, "url": url,
+              "server_profile": args.server_profile if server is not None else None, "titles": args.titles, "copies": args.copies}
+    return {"config": config, "run_id": run_id, "started_at": started_at, "elapsed_s": round(elapsed, 2), "dropped": dropped,
+            **recorder.results(elapsed)}
+
+
+def print_results(results: dict):
+    config = results["config"]
+    print(f"Escenario {config['scenario']} ({'llegadas a ' + str(config['rate']) + '/s' if config['rate'] else 'carga cerrada'}, "
+          f"{config['concurrency']} a la vez) durante {results['elapsed_s']} s")
+    print(f"{'petición':<34}{'total':>8}{'pet./s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}  errores")
+    rows = [(name, stats) for name, stats in sorted(results["requests"].items())]
+    rows += [(f"recorrido {name}", {**stats, "errors": {}}) for name, stats in sorted(results["journeys"].items())]
+    for name, stats in rows:
+        latency = stats["latency_ms"]
+        errors = ", ".join(f"{kind}: {count}" for kind, count in sorted(stats["errors"].items())) or "-"
+        print(f"{name:<34}{stats['count']:>8}{stats['per_s']:>9.1f}{latency['p50']:>9.1f}{latency['p95']:>9.1f}{latency['p99']:>9.1f}"
+              f"{latency['max']:>9.1f}  {errors}")
+    if results["dropped"]:
+        print(f"Recorridos descartados porque la API no daba abasto: {results['dropped']}")
+
+
+# Diferencias entre dos ficheros de resultados, petición a petición
+def compare(before_path: str, after_path: str):
+    with open(before_path, encoding="utf-8") as f:
+        before = json.load(f)
+    with open(after_path, encoding="utf-8") as f:
+        after = json.load(f)
+    rows = lambda results: {**results["requests"], **{f"recorrido {name}": stats for name, stats in results["journeys"].items()}}
+    before, after = rows(before), rows(after)
+    delta = lambda old, new: f"{new:>9.1f} ({(new - old) / old * 100:+.0f}%)" if old else f"{new:>9.1f}       "
+    print(f"{'petición':<34}{'pet./s':>17}{'p50 ms':>17}{'p95 ms':>17}{'p99 ms':>17}{'errores':>10}")
+    for name in sorted(set(before) | set(after)):
+        old, new = before.get(name), after.get(name)
+        if old is None or new is None:
+            print(f"{name:<34}solo en {'el segundo' if old is None else 'el primero'}")
+            continue
+        errors = sum(new.get("errors", {}).values()) - sum(old.get("errors", {}).values())
+        print(f"{name:<34}{delta(old['per_s'], new['per_s']):>17}"
+              + "".join(f"{delta(old['latency_ms'][p], new['latency_ms'][p]):>17}" for p in ("p50", "p95", "p99"))
+              + f"{errors:>+10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de carga con escenarios para la API de la biblioteca")
+    parser.add_argument("--scenario", choices=list(SCENARIOS), default="mixed")
+    parser.add_argument("--url", default=os.getenv("LOAD_URL", URL_BASE), help="API ya levantada a la que atacar")
+    parser.add_argument("--start-server", action="store_true", help="levantar la API en local para la prueba (ver benchmarks/bench_server.py)")
+    parser.add_argument("--server-profile", choices=list(PROFILES), default="uvicorn-uvloop", help="perfil con el que se levanta")
+    parser.add_argument("--port", type=int, default=int(os.getenv("BENCH_PORT", 8766)), help="puerto con --start-server")
+    parser.add_argument("--concurrency", type=int, default=16, help="clientes (o recorridos en curso con --rate) a la vez")
+    parser.add_argument("--rate", type=float, help="recorridos por segundo (carga abierta); sin indicarlo, carga cerrada")
+    parser.add_argument("--duration", type=float, default=30, help="segundos de medida")
+    parser.add_argument("--warmup", type=float, default=3, help="segundos de carga antes de medir, no cuentan")
+    parser.add_argument("--timeout", type=float, default=30, help="segundos de espera de cada petición")
+    parser.add_argument("--titles", type=int, default=20, help="libros y películas que se crean para los escenarios")
+    parser.add_argument("--copies", type=int, default=20, help="ejemplares de cada libro")
+    parser.add_argument("--users", type=int, help="usuarios para los préstamos, por defecto uno por cliente")
+    parser.add_argument("--seed", type=int, default=1, help="semilla de las elecciones al azar, para repetir la misma carga")
+    parser.add_argument("--output", help="fichero JSON donde guardar los resultados")
+    parser.add_argument("--compare", nargs=2, metavar=("ANTES", "DESPUES"), help="comparar dos ficheros de resultados y salir")
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print(f"Resultados guardados en {args.output}")
+    # Los 5xx y los fallos de conexión hacen que termine con error, los 4xx (sin stock, correo repetido...) son parte de la carga
+    failures = sum(count for kind, count in results["errors"].items() if not kind.rsplit(" ", 1)[1].startswith("4"))
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+from .models import *
+from .cache import genre_cache
+from .stock import STOCK_MAX_COPIES
+from sqlalchemy import select, literal
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from pydantic import ValidationError
+import codecs
+import json
+import csv
+import os
+
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', 1000))  # filas que se validan e insertan en cada transacción
+BULK_MAX_ERRORS = int(os.getenv('BULK_MAX_ERRORS', 1000))  # errores que se devuelven como mucho en la respuesta (se cuentan todos)
+
+
+# Carga masiva del catálogo. El cuerpo de la petición se lee en streaming línea a línea, ya sea NDJSON (un objeto JSON por línea)
+# o CSV con cabecera, y se procesa por lotes: validación con los esquemas Book/Film, alta de todos los géneros del lote en una sola
+# sentencia y un INSERT de varias filas con ON CONFLICT para no abortar el lote entero si algún nombre ya existe.
+# No se usa COPY porque no permite ON CONFLICT ni devolver qué filas se han insertado para informar del error de cada una.
+
+async def iter_lines(request):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+# Devuelve (número de línea, fila como diccionario o None, error). Los campos del CSV no pueden contener saltos de línea
+async def iter_rows(request):
+    is_csv = "csv" in request.headers.get("content-type", "")
+    header = None
+    line_number = 0
+    async for line in iter_lines(request):
+        line_number += 1
+        line = line.rstrip("\r")
+        if not line.strip():
+            continue
+        if is_csv:
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [h.strip() for h in values]
+                continue
+            if len(values) != len(header):
+                yield line_number, None, f"Se esperaban {len(header)} columnas y hay {len(values)}"
+                continue
+            yield line_number, dict(zip(header, values)), None
+        else:
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f"JSON inválido: {e}"
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, "Cada línea debe ser un objeto JSON"
+                continue
+            yield line_number, row, None
+
+
+# Devuelve el mapa nombre -> id de todos los géneros del lote. Los que no están en la caché de géneros se dan de alta si faltan y se
+# resuelven con una única sentencia: el INSERT ... ON CONFLICT DO NOTHING RETURNING devuelve los nuevos y el SELECT los que ya existían.
+# Como en resolve_actors, los que estaba creando a la vez otra transacción no salen en ninguno de los dos y se vuelven a consultar
+async def resolve_genres(db, genre_names):
+    genres = {}
+    missing = []
+    for name in sorted(set(genre_names)):
+        genre_id = genre_cache.get(name)
+        if genre_id is None:
+            missing.append(name)
+        else:
+            genres[name] = genre_id
+    if not missing:
+        return genres
+    inserted = (pg_insert(Genre_DB)
+                .values([{"genre_name": n} for n in missing])
+                .on_conflict_do_nothing(index_elements=["genre_name"])
+                .returning(Genre_DB.genre_id, Genre_DB.genre_name)
+                .cte("inserted"))
+    stmt = select(inserted.c.genre_id, inserted.c.genre_name, literal(True)).union_all(
+        select(Genre_DB.genre_id, Genre_DB.genre_name, literal(False)).where(Genre_DB.genre_name.in_(missing)))
+    created = {}
+    for genre_id, name, is_new in (await db.execute(stmt)).all():
+        genres[name] = genre_id
+        if is_new:
+            created[name] = genre_id
+    pending = [n for n in missing if n not in genres]
+    if pending:
+        stmt = select(Genre_DB.genre_id, Genre_DB.genre_name).where(Genre_DB.genre_name.in_(pending))
+        genres.update({name: genre_id for genre_id, name in (await db.execute(stmt)).all()})
+    if created:
+        await genre_cache.publish(db, created)
+    return genres
+
+
+# Igual para los actores: devuelve el mapa nombre -> id dando de alta los que no existan. Si otra transacción estaba creando el mismo
+# actor a la vez, el ON CONFLICT espera a que termine pero el SELECT no lo ve (su snapshot es anterior), así que se vuelve a consultar
+async def resolve_actors(db, actor_names):
+    names = sorted(set(actor_names))  # siempre en el mismo orden para que dos altas concurrentes no se bloqueen entre sí
+    if not names:
+        return {}
+    inserted = (pg_insert(Actor_DB)
+                .values([{"full_name": n} for n in names])
+                .on_conflict_do_nothing(index_elements=["full_name"])
+                .returning(Actor_DB.actor_id, Actor_DB.full_name)
+                .cte("inserted"))
+    stmt = select(inserted.c.actor_id, inserted.c.full_name).union_all(
+        select(Actor_DB.actor_id, Actor_DB.full_name).where(Actor_DB.full_name.in_(names)))
+    actors = {name: actor_id for actor_id, name in (await db.execute(stmt)).all()}
+    missing = [n for n in names if n not in actors]
+    if missing:
+        stmt = select(Actor_DB.actor_id, Actor_DB.full_name).where(Actor_DB.full_name.in_(missing))
+        actors.update({name: actor_id for actor_id, name in (await db.execute(stmt)).all()})
+    return actors
+
+
+# Da de alta el reparto de varias películas a la vez: casts es el mapa ref_number -> lista de nombres de actores en orden.
+# Son dos sentencias sea cual sea el número de películas, una para los actores y un INSERT de varias filas para film_actor
+async def link_actors(db, casts: dict):
+    actors = await resolve_actors(db, [name for names in casts.values() for name in names])
+    rows = [{"film_ref_number": ref_number, "actor_id": actors[name], "position": position}
+            for ref_number, names in casts.items() for position, name in enumerate(names)]
+    if rows:
+        await db.execute(pg_insert(film_actor_association_table).on_conflict_do_nothing(), rows)
+
+
+# Ejemplares de cada fila (columna copies, opcional). Los ejemplares de cada título los crea un trigger al insertarlo.
+# Devuelve None si el valor no es válido
+def parse_copies(value):
+    if value is None or str(value).strip() == "":
+        return 1
+    try:
+        copies = int(value)
+    except (TypeError, ValueError):
+        return None
+    return copies if 1 <= copies <= STOCK_MAX_COPIES else None
+
+
+class Bulk_Import:
+
+    def __init__(self, db, schema, model, default_genre=None):
+        self.db = db
+        self.schema = schema  # Book o Film
+        self.model = model  # Book_DB o Film_DB
+        self.default_genre = default_genre
+        self.received = 0
+        self.inserted = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line_number, detail, name=None):
+        self.error_count += 1
+        if len(self.errors) < BULK_MAX_ERRORS:
+            self.errors.append({"line": line_number, "name": name, "detail": detail})
+
+    async def run(self, request):
+        batch = []
+        async for line_number, row, error in iter_rows(request):
+            self.received += 1
+            if error:
+                self.add_error(line_number, error)
+                continue
+            batch.append((line_number, row))
+            if len(batch) >= BULK_BATCH_SIZE:
+                await self.import_batch(batch)
+                batch = []
+        if batch:
+            await self.import_batch(batch)
+        return {"received": self.received, "inserted": self.inserted, "error_count": self.error_count, "errors": self.errors}
+
+    async def import_batch(self, batch):
+        valid = {}  # nombre -> (línea, item validado, género, ejemplares)
+        for line_number, row in batch:
+            genre_name = row.get("genre_name") or self.default_genre or ""
+            if not isinstance(genre_name, str):
+                self.add_error(line_number, "genre_name debe ser un texto", row.get("name"))
+                continue
+            genre_name = genre_name.strip()
+            copies = parse_copies(row.get("copies"))
+            try:
+                item = self.schema.model_validate(row)
+            except ValidationError as e:
+                self.add_error(line_number, [f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()], row.get("name"))
+                continue
+            if not genre_name:
+                self.add_error(line_number, "Debe especificarse el género (columna genre_name o parámetro genre_name)", item.name)
+            elif copies is None:
+                self.add_error(line_number, f"copies debe ser un número entero entre 1 y {STOCK_MAX_COPIES}", item.name)
+            elif item.name in valid:
+                self.add_error(line_number, f"Nombre repetido, ya aparece en la línea {valid[item.name][0]}", item.name)
+            else:
+                valid[item.name] = (line_number, item, genre_name, copies)
+        if not valid:
+            return
+        genres = await resolve_genres(self.db, [genre for _, _, genre, _ in valid.values()])
+        rows = [dict(item.model_dump(), genre_id=genres[genre], total_copies=copies, available_copies=copies)
+                for _, item, genre, copies in valid.values()]
+        stmt = (pg_insert(self.model)
+                .on_conflict_do_nothing(index_elements=["name"])
+                .returning(self.model.ref_number, self.model.name))
+        inserted = (await self.db.execute(stmt, rows)).all()
+        if self.model is Film_DB:
+            await link_actors(self.db, {ref_number: split_actors(valid[name][1].actors) for ref_number, name in inserted})
+        await self.db.commit()
+        inserted_names = {name for _, name in inserted}
+        for genre_name, genre_id in genres.items():
+            genre_cache.put(genre_name, genre_id)
+        self.inserted += len(inserted_names)
+        for name, (line_number, _, _, _) in valid.items():
+            if name not in inserted_names:
+                self.add_error(line_number, "Ya existe un registro con este nombre", name)
@@ -0,0 +1,337 @@
+from .database import *
+from .models import *
+from sqlalchemy import select
+from fastapi import HTTPException, Response
+from pydantic import TypeAdapter
+from collections import OrderedDict
+from functools import lru_cache
+from uuid import uuid4
+import hashlib
+import asyncio
+import logging
+import json
+import time
+import os
+
+CACHE_CHANNEL = os.getenv('CACHE_CHANNEL', 'biblioteca_cache')  # canal de PostgreSQL por el que se avisan los workers
+CACHE_RESYNC_SECONDS = float(os.getenv('CACHE_RESYNC_SECONDS', 300))  # recarga completa periódica por si se pierde algún aviso
+CACHE_RETRY_SECONDS = float(os.getenv('CACHE_RETRY_SECONDS', 5))  # espera antes de reintentar la conexión de escucha
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))  # elementos distintos que guarda como mucho la caché de respuestas
+CACHE_TTL_SECONDS = float(os.getenv('CACHE_TTL_SECONDS', 60))  # tiempo que una respuesta se considera fresca
+CACHE_STALE_SECONDS = float(os.getenv('CACHE_STALE_SECONDS', 300))  # tiempo extra en el que se sirve caducada mientras se refresca
+CACHE_LOAD_TIMEOUT = float(os.getenv('CACHE_LOAD_TIMEOUT', 2))  # si la BDD tarda más que esto y hay copia caducada se sirve la copia
+
+logger = logging.getLogger(__name__)
+
+
+# Bus de avisos entre workers basado en LISTEN/NOTIFY de PostgreSQL. Los avisos se publican con pg_notify dentro de la misma
+# transacción que hace el cambio, de forma que PostgreSQL solo los entrega si se llega a hacer commit. Cada worker mantiene
+# una conexión asyncpg escuchando el canal y reparte los mensajes a quien se haya suscrito a su tema
+class Cache_Bus:
+
+    def __init__(self, channel: str = CACHE_CHANNEL):
+        self.channel = channel
+        self.instance_id = uuid4().hex  # para ignorar los avisos que ha publicado este mismo worker
+        self._handlers = {}
+        self._resync = []
+        self._reconnect = []
+        self._task = None
+        self.connected = False
+
+    def subscribe(self, topic: str, handler):
+        self._handlers.setdefault(topic, []).append(handler)
+
+    # Funciones que se llaman al (re)conectar y cada CACHE_RESYNC_SECONDS para recargar lo que se haya podido perder
+    def on_resync(self, callback):
+        self._resync.append(callback)
+
+    # Funciones que se llaman solo al (re)conectar, para cachés que no se pueden recargar enteras y prefieren vaciarse
+    def on_reconnect(self, callback):
+        self._reconnect.append(callback)
+
+    async def publish(self, db, topic: str, **data):
+        payload = json.dumps({"topic": topic, "origin": self.instance_id, **data})
+        await db.execute(select(func.pg_notify(self.channel, payload)))
+
+    async def start(self):
+        try:
+            import asyncpg
+        except ImportError:
+            logger.warning("asyncpg no está instalado, las cachés no se sincronizarán entre workers")
+            return
+        self._task = asyncio.create_task(self._listen(asyncpg))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.get("origin") == self.instance_id:
+            return
+        for handler in self._handlers.get(message.get("topic"), []):
+            handler(message)
+
+    async def _resync_all(self):
+        for callback in self._resync:
+            await callback()
+
+    async def _listen(self, asyncpg):
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(user=DB_USER, password=DB_PASSWORD, host=DB_LISTEN_HOST, port=DB_LISTEN_PORT, database=DB_NAME)
+                await connection.add_listener(self.channel, self._on_notify)
+                self.connected = True
+                # Lo que haya cambiado mientras no estábamos escuchando no nos ha llegado, así que recargamos
+                for callback in self._reconnect:
+                    await callback()
+                await self._resync_all()
+                waited = 0.0
+                while not connection.is_closed():
+                    await asyncio.sleep(1)
+                    waited += 1
+                    if waited >= CACHE_RESYNC_SECONDS:
+                        await self._resync_all()
+                        waited = 0.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Conexión de escucha de cachés perdida (%s), reintentando en %s s", e, CACHE_RETRY_SECONDS)
+            finally:
+                self.connected = False
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+            await asyncio.sleep(CACHE_RETRY_SECONDS)
+
+
+cache_bus = Cache_Bus()
+
+
+# Mapa nombre de género -> id. La tabla genero es muy pequeña y casi no cambia, así que se carga entera al arrancar y evita
+# una consulta en cada alta de libro o película
+class Genre_Cache:
+
+    def __init__(self, bus: Cache_Bus):
+        self.bus = bus
+        self._ids = {}
+        self.hits = 0
+        self.misses = 0
+        bus.subscribe("genre", self._on_message)
+        bus.on_resync(self.warm)
+
+    async def warm(self):
+        async with session_scope() as db:
+            rows = (await db.execute(select(Genre_DB.genre_name, Genre_DB.genre_id))).all()
+        self._ids = {name: genre_id for name, genre_id in rows}
+        logger.info("Caché de géneros cargada con %s géneros", len(self._ids))
+
+    def get(self, genre_name: str):
+        genre_id = self._ids.get(genre_name)
+        if genre_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return genre_id
+
+    def put(self, genre_name: str, genre_id: int):
+        self._ids[genre_name] = genre_id
+
+    # Se llama dentro de la transacción que da de alta los géneros, antes del commit
+    async def publish(self, db, genres: dict):
+        items = list(genres.items())
+        for i in range(0, len(items), 100):  # NOTIFY admite como mucho 8000 bytes por mensaje
+            await self.bus.publish(db, "genre", genres=dict(items[i:i + 100]))
+
+    def _on_message(self, message):
+        self._ids.update(message.get("genres", {}))
+
+    def stats(self):
+        return {"size": len(self._ids), "hits": self.hits, "misses": self.misses, "listening": self.bus.connected}
+
+
+genre_cache = Genre_Cache(cache_bus)
+
+
+# Un TypeAdapter por esquema de respuesta: construirlo cuesta bastante más que usarlo, así que se crea una sola vez
+@lru_cache(maxsize=None)
+def schema_adapter(schema):
+    return TypeAdapter(schema)
+
+
+def serialize_body(schema, data):
+    adapter = schema_adapter(schema)
+    return adapter.dump_json(adapter.validate_python(data, from_attributes=True))
+
+
+class Cache_Entry:
+    __slots__ = ("body", "etag", "stored_at")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        self.stored_at = time.monotonic()
+
+
+# Caché de lectura de las consultas por nombre (libros, películas, actores y géneros). Guarda la respuesta ya serializada a JSON
+# con su ETag en un LRU acotado con caducidad:
+#   * fresca (menos de CACHE_TTL_SECONDS): se sirve directamente
+#   * caducada pero dentro de CACHE_STALE_SECONDS: se sirve y se refresca en segundo plano (stale-while-revalidate)
+#   * si la BDD falla o tarda más de CACHE_LOAD_TIMEOUT y hay copia, se sirve la copia aunque esté caducada
+# Los endpoints de escritura invalidan los elementos que tocan, avisando al resto de workers por el bus.
+# La respuesta se serializa con el esquema del endpoint (schema), así el cuerpo guardado tiene los mismos campos que declara
+# su response_model
+class Response_Cache:
+
+    def __init__(self, bus: Cache_Bus, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS, stale: float = CACHE_STALE_SECONDS):
+        self.bus = bus
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale = stale
+        self._entries = OrderedDict()  # (tipo, nombre) -> {variante: Cache_Entry}
+        self._loading = {}  # (tipo, nombre, variante) -> Future de la carga en curso, para no repetir la misma consulta a la vez
+        # Cada invalidación sube la época; una carga que empezó antes de una invalidación no guarda su resultado porque puede
+        # haber leído el dato antiguo
+        self.epoch = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.load_errors = 0
+        bus.subscribe("response", self._on_message)
+        bus.on_reconnect(self.clear)
+
+    def _lookup(self, key, variant):
+        variants = self._entries.get(key)
+        if variants is None:
+            return None
+        self._entries.move_to_end(key)
+        return variants.get(variant)
+
+    def _store(self, key, variant, entry):
+        self._entries.setdefault(key, {})[variant] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def respond(self, request, kind: str, name: str, variant: str, loader, db, schema):
+        key = (kind, name)
+        entry = self._lookup(key, variant)
+        age = time.monotonic() - entry.stored_at if entry else None
+        if entry and age <= self.ttl:
+            self.hits += 1
+        elif entry and age <= self.ttl + self.stale:
+            self.stale_hits += 1
+            self._load_in_background(key, variant, loader, schema)
+        elif entry:
+            # Demasiado caducada para servirla sin más, pero si la BDD no contesta a tiempo es mejor que un error
+            self.misses += 1
+            try:
+                entry = await asyncio.wait_for(asyncio.shield(self._load_in_background(key, variant, loader, schema)), CACHE_LOAD_TIMEOUT)
+            except HTTPException:
+                raise
+            except Exception as e:
+                self.load_errors += 1
+                logger.warning("No se ha podido refrescar %s (%r), sirviendo la copia caducada", key, e)
+        else:
+            self.misses += 1
+            entry = await self._load(key, variant, loader, db, schema)
+        return self._response(request, entry)
+
+    def _response(self, request, entry):
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or entry.etag in [t.strip() for t in if_none_match.split(",")]):
+            self.not_modified += 1
+            return Response(status_code=304, headers={"ETag": entry.etag})
+        return Response(content=entry.body, media_type="application/json", headers={"ETag": entry.etag})
+
+    async def _fetch(self, key, variant, loader, db, schema):
+        epoch = self.epoch
+        data = await loader(db)
+        body = serialize_body(schema, data)
+        entry = Cache_Entry(body)
+        if epoch == self.epoch:
+            self._store(key, variant, entry)
+        return entry
+
+    # Carga con la sesión de la propia petición. Si ya hay una carga en curso del mismo elemento se espera a su resultado
+    # en lugar de repetir la consulta
+    async def _load(self, key, variant, loader, db, schema):
+        loading_key = (*key, variant)
+        pending = self._loading.get(loading_key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        pending = asyncio.get_running_loop().create_future()
+        self._loading[loading_key] = pending
+        try:
+            entry = await self._fetch(key, variant, loader, db, schema)
+            pending.set_result(entry)
+            return entry
+        except BaseException as e:
+            pending.set_exception(e)
+            pending.exception()  # marca la excepción como recogida aunque nadie más estuviera esperando
+            raise
+        finally:
+            del self._loading[loading_key]
+
+    # Carga en una tarea con su propia sesión, que sigue adelante aunque la petición que la lanzó ya haya contestado
+    def _load_in_background(self, key, variant, loader, schema):
+        loading_key = (*key, variant)
+        pending = self._loading.get(loading_key)
+        if pending is not None:
+            return pending
+
+        async def refresh():
+            try:
+                async with session_scope() as db:
+                    return await self._fetch(key, variant, loader, db, schema)
+            except HTTPException:
+                self.invalidate([key])  # ya no existe
+                raise
+            except Exception as e:
+                self.load_errors += 1
+                logger.warning("Error refrescando %s en segundo plano: %r", key, e)
+                raise
+
+        task = asyncio.create_task(refresh())
+        self._loading[loading_key] = task
+
+        def done(t):
+            self._loading.pop(loading_key, None)
+            if not t.cancelled():
+                t.exception()
+
+        task.add_done_callback(done)
+        return task
+
+    # Se llama dentro de la transacción de escritura, antes del commit, para avisar al resto de workers
+    async def publish_invalidation(self, db, keys):
+        await self.bus.publish(db, "response", keys=[list(k) for k in keys])
+
+    # Se llama después del commit para invalidar en este worker
+    def invalidate(self, keys):
+        self.epoch += 1
+        for key in keys:
+            self._entries.pop(tuple(key), None)
+
+    async def clear(self):
+        self.epoch += 1
+        self._entries.clear()
+
+    def _on_message(self, message):
+        self.invalidate(message.get("keys", []))
+
+    def stats(self):
+        return {"size": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "stale_hits": self.stale_hits,
+                "misses": self.misses, "not_modified": self.not_modified, "load_errors": self.load_errors}
+
+
+response_cache = Response_Cache(cache_bus)
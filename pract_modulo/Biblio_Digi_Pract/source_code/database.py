@@ -1,28 +1,296 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from anyio import to_thread, CapacityLimiter
+from functools import partial
+from contextlib import asynccontextmanager
+from uuid import uuid4
+from .metrics import pool_wait, limiter_wait, instrument_engine
+from .tracing import current_span, trace_engine
+from .slow_queries import slow_query_log
+import asyncio
+import time
 import os
 
-DB_HOST = os.getenv('DB_HOST', 'localhost') 
-DB_PORT = os.getenv('DB_PORT', '5432')     
-DB_USER = os.getenv('DB_USER', 'user_biblioteca') 
-DB_PASSWORD = os.getenv('DB_PASSWORD', 'password_biblioteca') 
-DB_NAME = os.getenv('DB_NAME', 'db_biblioteca') 
+DB_HOST = os.getenv('DB_HOST', 'localhost')
+DB_PORT = os.getenv('DB_PORT', '5432')
+DB_USER = os.getenv('DB_USER', 'user_biblioteca')
+DB_PASSWORD = os.getenv('DB_PASSWORD', 'password_biblioteca')
+DB_NAME = os.getenv('DB_NAME', 'db_biblioteca')
+# Con DB_ASYNC a true (valor por defecto) los endpoints usan un engine asíncrono con asyncpg, si se pone a false se usa
+# el engine síncrono de siempre (psycopg2) ejecutando cada consulta en el threadpool para no bloquear el event loop
+DB_ASYNC = os.getenv('DB_ASYNC', 'true').lower() in ('1', 'true', 'yes')
+
+# Configuración del pool de conexiones. Por defecto son los mismos valores que usa SQLAlchemy (5 conexiones + 10 de overflow)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))  # segundos esperando una conexión libre antes de dar error
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'false').lower() in ('1', 'true', 'yes')  # comprobar la conexión antes de usarla
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', -1))  # segundos de vida de una conexión antes de reabrirla, -1 nunca
+# Si entre la API y PostgreSQL hay un pgbouncer en modo transacción no se pueden reutilizar sentencias preparadas entre
+# transacciones, porque cada una puede ir a una conexión de servidor distinta
+DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'false').lower() in ('1', 'true', 'yes')
+# LISTEN/NOTIFY necesita una conexión de sesión, así que detrás de pgbouncer hay que apuntar directamente a PostgreSQL
+DB_LISTEN_HOST = os.getenv('DB_LISTEN_HOST', DB_HOST)
+DB_LISTEN_PORT = os.getenv('DB_LISTEN_PORT', DB_PORT)
+# Conexiones que se abren al arrancar para que las primeras peticiones no esperen a conectar (como mucho DB_POOL_SIZE)
+DB_POOL_WARM = min(int(os.getenv('DB_POOL_WARM', DB_POOL_SIZE)), DB_POOL_SIZE)
+# Hilos del threadpool de anyio (por defecto 40), nunca menos que las conexiones que puede abrir el pool
+THREADPOOL_SIZE = int(os.getenv('THREADPOOL_SIZE', max(40, DB_POOL_SIZE + DB_MAX_OVERFLOW)))
 
 SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+SQLALCHEMY_ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+
+# Estadísticas del pool de conexiones que se rellenan con los eventos del pool, más el tiempo que se espera por una conexión libre
+class Pool_Stats:
+
+    def __init__(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.limiter_waits = 0
+        self.limiter_wait_total = 0.0
+        self.limiter_wait_max = 0.0
+
+    def record_wait(self, elapsed: float, timed_out: bool = False):
+        self.waits += 1
+        self.wait_total += elapsed
+        self.wait_max = max(self.wait_max, elapsed)
+        pool_wait.observe(elapsed)
+        if timed_out:
+            self.timeouts += 1
+
+    def record_limiter_wait(self, elapsed: float):
+        self.limiter_waits += 1
+        self.limiter_wait_total += elapsed
+        self.limiter_wait_max = max(self.limiter_wait_max, elapsed)
+        limiter_wait.observe(elapsed)
+
+    def listen(self, sync_engine):
+        @event.listens_for(sync_engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            self.connects += 1
+
+        @event.listens_for(sync_engine, "checkout")
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+        @event.listens_for(sync_engine, "checkin")
+        def on_checkin(dbapi_connection, connection_record):
+            self.checkins += 1
+            self.checked_out -= 1
+
+        @event.listens_for(sync_engine, "invalidate")
+        def on_invalidate(dbapi_connection, connection_record, exception):
+            self.invalidations += 1
+
+
+pool_stats = Pool_Stats()
+
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-Local_Session = sessionmaker(bind=engine, autocommit=False, autoflush=False) 
+# El pool de SQLAlchemy no tiene un evento para "antes de pedir conexión", así que medimos la espera envolviendo _do_get
+class Timed_Pool_Mixin:
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_stats.record_wait(time.perf_counter() - start, timed_out)
+
+
+class Timed_Queue_Pool(Timed_Pool_Mixin, QueuePool):
+    pass
+
+
+class Timed_Async_Queue_Pool(Timed_Pool_Mixin, AsyncAdaptedQueuePool):
+    pass
+
+
+pool_options = dict(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                    pool_pre_ping=DB_POOL_PRE_PING, pool_recycle=DB_POOL_RECYCLE)
+
+# asyncpg cachea sentencias preparadas por conexión; detrás de pgbouncer desactivamos esa caché y damos nombres únicos a las
+# sentencias para que no choquen entre clientes que comparten conexión de servidor
+async_connect_args = dict(statement_cache_size=0, prepared_statement_cache_size=0,
+                          prepared_statement_name_func=lambda: f"__asyncpg_{uuid4()}__") if DB_PGBOUNCER else {}
+
+# El engine síncrono siempre existe (create_all, scripts...). Solo se instrumenta el engine que usan los endpoints
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **pool_options, **({} if DB_ASYNC else {"poolclass": Timed_Queue_Pool}))
+Local_Session = sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
 # autocommit es False porque nosotros somos los que queremos confirmar cuando commitear esos cambios
 # bind = engine cada sesion creada que use el engine creado
+# expire_on_commit=False para que después del commit no se vuelvan a leer de la BDD los objetos que se devuelven en la respuesta
+
+# El engine asíncrono solo se crea si está activado el modo async, así no hace falta tener asyncpg instalado en modo síncrono.
+# expire_on_commit=False porque con AsyncSession no se pueden hacer cargas "perezosas" de atributos caducados fuera de un await
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL, poolclass=Timed_Async_Queue_Pool, connect_args=async_connect_args, **pool_options) if DB_ASYNC else None
+Async_Local_Session = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False) if DB_ASYNC else None
+
+# Engine que usan los endpoints, en modo síncrono o asíncrono, sobre el que se registran los eventos del pool
+request_engine = async_engine.sync_engine if DB_ASYNC else engine
+pool_stats.listen(request_engine)
+instrument_engine(request_engine)  # métricas de cada sentencia para /metrics
+trace_engine(request_engine)  # un span por sentencia en las peticiones que se trazan
+slow_query_log.listen(request_engine, async_engine)  # sentencias que pasan de SLOW_QUERY_MS, con su plan
+
+# Cada petición que necesita la BDD reserva un hueco de este limitador durante toda la vida de su sesión, dimensionado al
+# número de conexiones que puede abrir el pool. Así las peticiones que sobran esperan en el event loop en lugar de ocupar un
+# hilo bloqueado dentro del pool (o acabar con un timeout de conexión)
+db_limiter = CapacityLimiter(DB_POOL_SIZE + DB_MAX_OVERFLOW)
+
+
+def configure_threadpool():
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
+
+# Estado en vivo del pool más los contadores acumulados por los eventos
+def get_pool_status():
+    pool = request_engine.pool
+    waits = pool_stats.waits or 1
+    limiter_waits = pool_stats.limiter_waits or 1
+    return {
+        "mode": "async" if DB_ASYNC else "sync",
+        "pgbouncer": DB_PGBOUNCER,
+        "pool_size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_checked_out": pool_stats.max_checked_out,
+        "connects": pool_stats.connects,
+        "checkouts": pool_stats.checkouts,
+        "checkins": pool_stats.checkins,
+        "invalidations": pool_stats.invalidations,
+        "timeouts": pool_stats.timeouts,
+        "wait_avg_ms": round(pool_stats.wait_total / waits * 1000, 3),
+        "wait_max_ms": round(pool_stats.wait_max * 1000, 3),
+        "limiter_tokens": db_limiter.total_tokens,
+        "limiter_borrowed": db_limiter.borrowed_tokens,
+        "limiter_waiting": db_limiter.statistics().tasks_waiting,
+        "limiter_wait_avg_ms": round(pool_stats.limiter_wait_total / limiter_waits * 1000, 3),
+        "limiter_wait_max_ms": round(pool_stats.limiter_wait_max * 1000, 3),
+        "threadpool_size": to_thread.current_default_thread_limiter().total_tokens,
+    }
+
+# Abre a la vez DB_POOL_WARM conexiones y las devuelve al pool. La primera conexión además hace la inicialización del dialecto
+# (versión del servidor, tipos...), que si no le tocaría a la primera petición
+async def warm_pool():
+    if DB_POOL_WARM <= 0:
+        return
+    if DB_ASYNC:
+        connections = await asyncio.gather(*(async_engine.connect() for _ in range(DB_POOL_WARM)))
+        await asyncio.gather(*(conn.close() for conn in connections))
+    else:
+        def open_connections():
+            connections = [engine.connect() for _ in range(DB_POOL_WARM)]
+            for conn in connections:
+                conn.close()
+        await to_thread.run_sync(open_connections)
+
+
 Base = declarative_base()
 # clase base para nuestros modelos, es decir cada clase declarada con Base le indicamos a SQL Alchemy que esa clase en concreto será una tabla de la BBDD
 
+
+# Envoltorio de una Session síncrona con la misma interfaz que AsyncSession. De esta forma los endpoints se escriben una sola vez
+# con await y en modo síncrono cada operación contra la BDD se ejecuta en un hilo del threadpool en lugar de en el event loop
+class Threaded_Session:
+
+    def __init__(self, session):
+        self.sync_session = session
+
+    async def _run(self, fn, *args, **kwargs):
+        return await to_thread.run_sync(partial(fn, *args, **kwargs))
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def execute(self, *args, **kwargs):
+        return await self._run(self.sync_session.execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await self._run(self.sync_session.scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await self._run(self.sync_session.scalars, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await self._run(self.sync_session.get, *args, **kwargs)
+
+    async def delete(self, instance):
+        return await self._run(self.sync_session.delete, instance)
+
+    async def flush(self):
+        return await self._run(self.sync_session.flush)
+
+    async def commit(self):
+        return await self._run(self.sync_session.commit)
+
+    async def rollback(self):
+        return await self._run(self.sync_session.rollback)
+
+    async def refresh(self, instance):
+        return await self._run(self.sync_session.refresh, instance)
+
+    async def close(self):
+        return await self._run(self.sync_session.close)
+
+
+# Abre una sesión del modo configurado (AsyncSession o Threaded_Session) ocupando un hueco del limitador. Se usa tanto en get_db
+# como en las tareas que necesitan la BDD fuera de una petición (arranque, cachés...)
+@asynccontextmanager
+async def session_scope():
+    start = time.perf_counter()
+    async with db_limiter:
+        pool_stats.record_limiter_wait(time.perf_counter() - start)
+        if DB_ASYNC:
+            async with Async_Local_Session() as db:
+                yield db
+        else:
+            db = Threaded_Session(Local_Session())
+            try:
+                yield db
+            finally:
+                await db.close()
+
+
 # Esta función (get_db) servirá como generador de sesiones de nuestra BD además de asegurarse su correcta gestion en los diferentes
-# endpoints que requieran del uso de conexión. Se indica con Depends
-def get_db():
-    db = Local_Session()
+# endpoints que requieran del uso de conexión. Se indica con Depends.
+# Si la petición se traza, la sesión tiene su propio span (espera del limitador incluida) y el handler y las sentencias SQL cuelgan
+# de él. FastAPI puede cerrar la dependencia en otro contexto, por eso se vuelve al span anterior con set() y no con un token
+async def get_db():
+    parent = current_span.get()
+    span = parent.child("db.session") if parent is not None else None
+    if span is not None:
+        current_span.set(span)
     try:
-        yield db
+        async with session_scope() as db:
+            yield db
+    except BaseException as e:
+        if span is not None:
+            span.record_exception(e)
+        raise
     finally:
-        db.close()
\ No newline at end of file
+        if span is not None:
+            current_span.set(parent)
+            span.end()
@@ -0,0 +1,131 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import asyncio
+import logging
+import time
+import os
+from .metrics import hash_duration, hash_queue_wait, hash_rejected
+from .passwords import init_hash_process, timed_hash_password
+from .tracing import start_span
+
+# Parámetros del servicio de cifrado, todos configurables por variables de entorno
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', os.cpu_count() or 1))  # procesos del pool que ejecutan bcrypt
+HASH_MAX_CONCURRENCY = int(os.getenv('HASH_MAX_CONCURRENCY', HASH_WORKERS))  # cifrados ejecutándose a la vez como máximo
+HASH_MAX_QUEUE = int(os.getenv('HASH_MAX_QUEUE', 64))  # peticiones esperando turno antes de empezar a rechazar con 503
+HASH_TARGET_MS = float(os.getenv('HASH_TARGET_MS', 250))  # latencia objetivo de un cifrado para la calibración
+HASH_MIN_ROUNDS = int(os.getenv('HASH_MIN_ROUNDS', 10))  # coste mínimo de bcrypt aunque la máquina sea lenta
+HASH_MAX_ROUNDS = int(os.getenv('HASH_MAX_ROUNDS', 14))
+HASH_ROUNDS = os.getenv('HASH_ROUNDS')  # si se indica se usa ese coste y no se calibra
+
+logger = logging.getLogger(__name__)
+
+
+class Hashing_Busy(Exception):
+    # Se lanza cuando la cola de cifrados está llena, el endpoint lo traduce a un 503
+    pass
+
+
+# Servicio de cifrado de contraseñas: bcrypt se ejecuta en un pool de procesos para no ocupar ni el event loop ni el threadpool,
+# con un límite de cifrados en paralelo y de peticiones en cola, de forma que una avalancha de registros no deje sin recursos
+# a las lecturas del catálogo
+class Hashing_Service:
+
+    def __init__(self, workers: int = HASH_WORKERS, max_concurrency: int = HASH_MAX_CONCURRENCY, max_queue: int = HASH_MAX_QUEUE):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.rounds = int(HASH_ROUNDS) if HASH_ROUNDS else 12
+        self._pool = None
+        self._semaphore = None
+        self.queued = 0
+        self.in_flight = 0
+        self.rejected = 0
+        self.hashed = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+
+    async def start(self):
+        # spawn en lugar de fork para que los procesos hijos no hereden conexiones ni hilos del proceso de la API. Lo que ejecutan
+        # está en passwords.py, que no importa metrics.py, así no escriben ficheros de métricas (ver init_hash_process)
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                         initializer=init_hash_process)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if HASH_ROUNDS:
+            logger.info("Coste de bcrypt fijado por configuración: %s", self.rounds)
+        else:
+            self.rounds = await self.calibrate()
+
+    async def stop(self):
+        if self._pool:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    # Elegimos el mayor coste de bcrypt que se cifra dentro de la latencia objetivo en esta máquina. Cada punto de coste
+    # duplica el tiempo así que basta con medir una vez en el mínimo y extrapolar, comprobando después el coste elegido
+    async def calibrate(self):
+        loop = asyncio.get_running_loop()
+        _, elapsed = await loop.run_in_executor(self._pool, timed_hash_password, "calibracion", HASH_MIN_ROUNDS)
+        rounds = HASH_MIN_ROUNDS
+        while rounds < HASH_MAX_ROUNDS and elapsed * 2 <= HASH_TARGET_MS / 1000:
+            rounds += 1
+            elapsed *= 2
+        if rounds != HASH_MIN_ROUNDS:
+            _, elapsed = await loop.run_in_executor(self._pool, timed_hash_password, "calibracion", rounds)
+        logger.info("Coste de bcrypt calibrado a %s (%.0f ms por cifrado, objetivo %.0f ms)", rounds, elapsed * 1000, HASH_TARGET_MS)
+        return rounds
+
+    # El span cubre la espera en cola y el cifrado en el pool; el tiempo dentro del proceso va como atributo
+    async def hash(self, pwd: str):
+        with start_span("hash_password", attributes={"bcrypt.rounds": self.rounds}) as span:
+            if self._pool is None:
+                await self.start()
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                hash_rejected.inc()
+                raise Hashing_Busy()
+            enqueued = time.perf_counter()
+            self.queued += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.queued -= 1
+            waited = time.perf_counter() - enqueued
+            self.in_flight += 1
+            try:
+                loop = asyncio.get_running_loop()
+                hashed, elapsed = await loop.run_in_executor(self._pool, timed_hash_password, pwd, self.rounds)
+            finally:
+                self.in_flight -= 1
+                self._semaphore.release()
+            self.hashed += 1
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+            self.hash_time_total += elapsed
+            self.hash_time_max = max(self.hash_time_max, elapsed)
+            hash_queue_wait.observe(waited)
+            hash_duration.observe(elapsed)
+            if span is not None:
+                span.attributes.update({"bcrypt.queue_wait_ms": round(waited * 1000, 3), "bcrypt.hash_ms": round(elapsed * 1000, 3)})
+            return hashed
+
+    def stats(self):
+        done = self.hashed or 1
+        return {
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "hashed": self.hashed,
+            "rejected": self.rejected,
+            "queue_wait_avg_ms": round(self.queue_wait_total / done * 1000, 3),
+            "queue_wait_max_ms": round(self.queue_wait_max * 1000, 3),
+            "hash_time_avg_ms": round(self.hash_time_total / done * 1000, 3),
+            "hash_time_max_ms": round(self.hash_time_max * 1000, 3),
+        }
+
+
+hashing_service = Hashing_Service()
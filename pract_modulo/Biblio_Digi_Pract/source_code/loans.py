@@ -0,0 +1,214 @@
+from .models import *
+from fastapi import HTTPException, status
+from sqlalchemy import select, update, insert, literal, true, exists, exc, func, union_all, and_, or_, Integer
+from sqlalchemy.orm import aliased
+import os
+
+LOAN_MAX_ITEMS = int(os.getenv('LOAN_MAX_ITEMS', 50))  # artículos que se pueden pedir como mucho en un mismo préstamo
+
+
+# Préstamo atómico en una sola sentencia, con cualquier número de libros y películas:
+#   1. Se bloquean en orden de referencia los títulos pedidos que tienen algún ejemplar libre (SELECT ... ORDER BY ... FOR UPDATE)
+#      y se resta uno a sus ejemplares libres (UPDATE ... RETURNING). El orden fijo evita interbloqueos entre préstamos que piden
+#      artículos en común
+#   2. Si se ha podido coger alguno se crea la cabecera del préstamo y una fila de loan_items por artículo
+# Si dos peticiones piden a la vez el último ejemplar de un título, la segunda espera al bloqueo de la primera y al volver a evaluar
+# available_copies ya no lo encuentra libre, así que solo una de las dos se lo lleva. Los artículos que no se han podido coger se
+# informan uno a uno. Después, en otra sentencia, se escoge el ejemplar concreto de cada título (ver assign_copies_statement)
+
+def take_items(model, ref_numbers: list, name: str):
+    locked = (select(model.ref_number).where(model.ref_number.in_(ref_numbers), model.available_copies > 0)
+              .order_by(model.ref_number).with_for_update())
+    return (update(model).where(model.ref_number.in_(locked)).values(available_copies=model.available_copies - 1)
+            .returning(model.ref_number, model.name).cte(name))
+
+
+def checkout_statement(user_id: int, book_ref_numbers: list, film_ref_numbers: list):
+    took_books = take_items(Book_DB, book_ref_numbers, "took_books")
+    took_films = take_items(Film_DB, film_ref_numbers, "took_films")
+    header = (select(literal(user_id, Integer), select(func.min(took_books.c.ref_number)).scalar_subquery(),
+                     select(func.min(took_films.c.ref_number)).scalar_subquery())
+              .where(exists(select(took_books.c.ref_number)) | exists(select(took_films.c.ref_number))))
+    loan = (insert(Loan_DB).from_select(["user_id", "book_ref_number", "film_ref_number"], header)
+            .returning(*Loan_DB.__table__.c).cte("loan"))
+    rows = union_all(select(loan.c.loan_id, took_books.c.ref_number, literal(None, Integer)).select_from(loan.join(took_books, true())),
+                     select(loan.c.loan_id, literal(None, Integer), took_films.c.ref_number).select_from(loan.join(took_films, true())))
+    items = (insert(Loan_Item_DB).from_select(["loan_id", "book_ref_number", "film_ref_number"], rows)
+             .returning(Loan_Item_DB.loan_item_id, Loan_Item_DB.book_ref_number, Loan_Item_DB.film_ref_number).cte("items"))
+    return (select(loan, items.c.loan_item_id, items.c.book_ref_number.label("item_book_ref_number"),
+                   items.c.film_ref_number.label("item_film_ref_number"), took_books.c.name.label("book_name"),
+                   took_films.c.name.label("film_name"))
+            .select_from(loan.join(items, true())
+                         .outerjoin(took_books, took_books.c.ref_number==items.c.book_ref_number)
+                         .outerjoin(took_films, took_films.c.ref_number==items.c.film_ref_number))
+            .order_by(items.c.loan_item_id))
+
+
+# Escoge un ejemplar libre de cada título del préstamo, lo marca como prestado y lo apunta en loan_items. Va en una sentencia
+# aparte porque tiene que ver lo que han confirmado los préstamos que tenían bloqueados los mismos títulos: los ejemplares libres
+# que ve son los que cuentan los contadores, y ningún otro préstamo de esos títulos puede cogerlos hasta que este termine
+def pick_copies(item_column, copy_column, loan_id: int):
+    free = (select(Copy_DB.copy_id).where(copy_column==item_column, ~Copy_DB.on_loan)
+            .order_by(Copy_DB.copy_id).limit(1).with_for_update().lateral("free"))
+    return (select(Loan_Item_DB.loan_item_id, free.c.copy_id).select_from(Loan_Item_DB).join(free, true())
+            .where(Loan_Item_DB.loan_id==loan_id, item_column.isnot(None)))
+
+
+def assign_copies_statement(loan_id: int):
+    picked = union_all(pick_copies(Loan_Item_DB.book_ref_number, Copy_DB.book_ref_number, loan_id),
+                       pick_copies(Loan_Item_DB.film_ref_number, Copy_DB.film_ref_number, loan_id)).cte("picked")
+    lent = (update(Copy_DB).where(Copy_DB.copy_id.in_(select(picked.c.copy_id))).values(on_loan=True)
+            .returning(Copy_DB.copy_id, Copy_DB.barcode).cte("lent"))
+    items = Loan_Item_DB.__table__  # UPDATE ... FROM con RETURNING de otras tablas, sobre la tabla y no sobre el modelo del ORM
+    return (update(items).where(items.c.loan_item_id==picked.c.loan_item_id, lent.c.copy_id==picked.c.copy_id)
+            .values(copy_id=picked.c.copy_id).returning(items.c.loan_item_id, lent.c.copy_id, lent.c.barcode))
+
+
+# Motivo por el que no se ha podido coger cada artículo (no existe o está prestado), con una consulta por tipo de artículo
+async def checkout_failures(db, book_ref_numbers: list, film_ref_numbers: list):
+    failed = []
+    for model, ref_numbers, key, item in ((Book_DB, book_ref_numbers, "book_ref_number", "el libro"),
+                                          (Film_DB, film_ref_numbers, "film_ref_number", "la película")):
+        if not ref_numbers:
+            continue
+        existing = set((await db.scalars(select(model.ref_number).where(model.ref_number.in_(ref_numbers)))).all())
+        for ref_number in ref_numbers:
+            if ref_number not in existing:
+                failed.append({key: ref_number, "status": status.HTTP_404_NOT_FOUND, "detail": f"No existe {item} con referencia {ref_number}"})
+            else:
+                failed.append({key: ref_number, "status": status.HTTP_409_CONFLICT, "detail": f"{item.capitalize()} con referencia {ref_number} no tiene ejemplares disponibles"})
+    return failed
+
+
+def failure_exception(failed: list):
+    if len(failed) == 1:
+        return HTTPException(status_code=failed[0]["status"], detail=failed[0]["detail"])
+    return HTTPException(status_code=status.HTTP_409_CONFLICT, detail={"message": "No se ha podido realizar el préstamo", "failed": failed})
+
+
+# Hace el préstamo dentro de la transacción de db sin confirmarla. Devuelve la cabecera del préstamo con sus artículos y los que
+# no se han podido coger, y las claves de caché que hay que invalidar al hacer commit (cambia la disponibilidad de lo prestado).
+# Con all_or_nothing el préstamo solo se hace si se pueden coger todos los artículos, si no se deshace y se devuelve el error
+async def checkout(db, user_id: int, book_ref_numbers: list = (), film_ref_numbers: list = (), all_or_nothing: bool = False):
+    book_ref_numbers = sorted(set(book_ref_numbers))
+    film_ref_numbers = sorted(set(film_ref_numbers))
+    if not book_ref_numbers and not film_ref_numbers:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Un préstamo debe ser por lo menos de un libro o de una película")
+    if len(book_ref_numbers) + len(film_ref_numbers) > LOAN_MAX_ITEMS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Un préstamo puede tener como mucho {LOAN_MAX_ITEMS} artículos")
+    try:
+        rows = (await db.execute(checkout_statement(user_id, book_ref_numbers, film_ref_numbers))).mappings().all()
+    except exc.IntegrityError:
+        await db.rollback()  # el usuario no existe (clave foránea del préstamo)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El usuario que se indica que realiza el préstamo no existe")
+    taken_books = {row["item_book_ref_number"] for row in rows if row["item_book_ref_number"] is not None}
+    taken_films = {row["item_film_ref_number"] for row in rows if row["item_film_ref_number"] is not None}
+    failed = await checkout_failures(db, [r for r in book_ref_numbers if r not in taken_books], [r for r in film_ref_numbers if r not in taken_films])
+    # Si no se ha cogido nada el préstamo ni se ha intentado crear, así que el error son los artículos
+    if not rows or (failed and all_or_nothing):
+        await db.rollback()
+        raise failure_exception(failed)
+    loan = {column.key: rows[0][column.key] for column in Loan_DB.__table__.c}
+    copies = {item_id: (copy_id, barcode) for item_id, copy_id, barcode in (await db.execute(assign_copies_statement(loan["loan_id"]))).all()}
+    loan["items"] = []
+    for row in rows:
+        copy_id, barcode = copies.get(row["loan_item_id"], (None, None))  # sin ejemplar solo si los contadores no cuadran con copies
+        loan["items"].append({"loan_item_id": row["loan_item_id"], "book_ref_number": row["item_book_ref_number"],
+                              "film_ref_number": row["item_film_ref_number"], "copy_id": copy_id, "barcode": barcode, "return_date": None})
+    loan["failed"] = failed
+    changed = [("book", row["book_name"]) for row in rows if row["book_name"]] + [("film", row["film_name"]) for row in rows if row["film_name"]]
+    return loan, changed
+
+
+# Devolución en una sola sentencia: se marcan como devueltos los artículos sin devolver que cumplan los criterios, en la misma
+# sentencia se dejan libres sus ejemplares, se suman a los ejemplares libres de cada título (agrupados, porque un UPDATE ... FROM
+# solo cambia una vez cada fila aunque se devuelvan dos ejemplares del mismo título) y se cierran los préstamos que se quedan sin
+# artículos pendientes.
+# Todas las partes de la sentencia ven la BDD como estaba antes de ejecutarla, por eso al buscar artículos pendientes se excluyen
+# los que se acaban de devolver. Como solo se devuelven artículos pendientes, dos devoluciones a la vez no devuelven nada dos veces
+
+def free_titles(model, ref_column, name: str):
+    returned = select(ref_column.label("ref_number"), func.count().label("copies")).where(ref_column.isnot(None)).group_by(ref_column).subquery()
+    return (update(model).where(model.ref_number==returned.c.ref_number)
+            .values(available_copies=model.available_copies + returned.c.copies)
+            .returning(model.ref_number, model.name).cte(name))
+
+
+def return_statement(*criteria):
+    closed_items = (update(Loan_Item_DB).where(Loan_Item_DB.return_date.is_(None), *criteria).values(return_date=func.now())
+                    .returning(*Loan_Item_DB.__table__.c).cte("closed_items"))
+    freed_copies = (update(Copy_DB).where(Copy_DB.copy_id==closed_items.c.copy_id).values(on_loan=False)
+                    .returning(Copy_DB.copy_id, Copy_DB.barcode).cte("freed_copies"))
+    freed_books = free_titles(Book_DB, closed_items.c.book_ref_number, "freed_books")
+    freed_films = free_titles(Film_DB, closed_items.c.film_ref_number, "freed_films")
+    pending = (select(Loan_Item_DB.loan_item_id)
+               .where(Loan_Item_DB.loan_id==Loan_DB.loan_id, Loan_Item_DB.return_date.is_(None),
+                      Loan_Item_DB.loan_item_id.not_in(select(closed_items.c.loan_item_id))))
+    closed_loans = (update(Loan_DB).where(Loan_DB.loan_id.in_(select(closed_items.c.loan_id)), ~exists(pending))
+                    .values(return_date=func.now()).returning(Loan_DB.loan_id, Loan_DB.return_date).cte("closed_loans"))
+    return (select(Loan_DB.loan_id, Loan_DB.loan_date, Loan_DB.user_id, Loan_DB.book_ref_number, Loan_DB.film_ref_number,
+                   closed_loans.c.return_date, closed_items.c.loan_item_id, closed_items.c.book_ref_number.label("item_book_ref_number"),
+                   closed_items.c.film_ref_number.label("item_film_ref_number"), closed_items.c.copy_id, freed_copies.c.barcode,
+                   closed_items.c.return_date.label("item_return_date"),
+                   freed_books.c.name.label("book_name"), freed_films.c.name.label("film_name"))
+            .select_from(closed_items.join(Loan_DB, Loan_DB.loan_id==closed_items.c.loan_id)
+                         .outerjoin(closed_loans, closed_loans.c.loan_id==closed_items.c.loan_id)
+                         .outerjoin(freed_copies, freed_copies.c.copy_id==closed_items.c.copy_id)
+                         .outerjoin(freed_books, freed_books.c.ref_number==closed_items.c.book_ref_number)
+                         .outerjoin(freed_films, freed_films.c.ref_number==closed_items.c.film_ref_number))
+            .order_by(closed_items.c.loan_id, closed_items.c.loan_item_id))
+
+
+# Devuelve dentro de la transacción de db los artículos pendientes que cumplan los criterios (sobre Loan_Item_DB), sin confirmarla.
+# Devuelve los préstamos afectados, cada uno con los artículos devueltos (return_date del préstamo solo tiene valor si ya no le
+# queda nada pendiente), y las claves de caché que hay que invalidar al hacer commit
+async def return_loans(db, *criteria):
+    loans = {}
+    changed = []
+    for row in (await db.execute(return_statement(*criteria))).mappings().all():
+        loan = loans.setdefault(row["loan_id"], {column.key: row[column.key] for column in Loan_DB.__table__.c} | {"items": []})
+        loan["items"].append({"loan_item_id": row["loan_item_id"], "book_ref_number": row["item_book_ref_number"],
+                              "film_ref_number": row["item_film_ref_number"], "copy_id": row["copy_id"],
+                              "barcode": row["barcode"], "return_date": row["item_return_date"]})
+        if row["book_name"]:
+            changed.append(("book", row["book_name"]))
+        if row["film_name"]:
+            changed.append(("film", row["film_name"]))
+    return list(loans.values()), changed
+
+
+# Criterio para los artículos de los préstamos abiertos de un usuario, que se encuentran por el índice parcial de prestamo
+def user_open_items(user_id: int):
+    return Loan_Item_DB.loan_id.in_(select(Loan_DB.loan_id).where(Loan_DB.user_id==user_id, Loan_DB.return_date.is_(None)))
+
+
+# Criterio para devolver un libro y/o una película de un usuario: los dos tienen que estar sin devolver en el mismo préstamo, como
+# cuando cada préstamo era de un libro y una película. Si hay varios préstamos así se devuelve el más antiguo. La subconsulta va
+# sobre un alias de loan_items para que no se correlacione con el UPDATE de return_statement
+def user_loan_items(user_id: int, book_ref_number: int = None, film_ref_number: int = None):
+    item = aliased(Loan_Item_DB)
+    wanted = []
+    if book_ref_number:
+        wanted.append(item.book_ref_number==book_ref_number)
+    if film_ref_number:
+        wanted.append(item.film_ref_number==film_ref_number)
+    loan_id = (select(item.loan_id)
+               .where(item.loan_id.in_(select(Loan_DB.loan_id).where(Loan_DB.user_id==user_id, Loan_DB.return_date.is_(None))),
+                      item.return_date.is_(None), or_(*wanted))
+               .group_by(item.loan_id).having(func.count()==len(wanted)).order_by(item.loan_id).limit(1).scalar_subquery())
+    returned = [Loan_Item_DB.book_ref_number==book_ref_number] if book_ref_number else []
+    if film_ref_number:
+        returned.append(Loan_Item_DB.film_ref_number==film_ref_number)
+    return and_(Loan_Item_DB.loan_id==loan_id, or_(*returned))
+
+
+# Devolución de un préstamo concreto (todo lo que le quede pendiente). Si no se ha devuelto nada vemos si es porque no existe o
+# porque ya estaba devuelto
+async def return_loan(db, loan_id: int):
+    loans, changed = await return_loans(db, Loan_Item_DB.loan_id==loan_id)
+    if not loans:
+        returned = await db.scalar(select(Loan_DB.return_date.isnot(None)).where(Loan_DB.loan_id==loan_id))
+        if returned is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No existe el prestamo")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="El préstamo ya estaba devuelto")
+    return loans[0], changed
@@ -0,0 +1,183 @@
+from logging.handlers import QueueHandler, QueueListener
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from uuid import uuid4
+import logging
+import atexit
+import queue
+import random
+import json
+import sys
+import zlib
+import os
+import re
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()  # json (una línea JSON por mensaje) o text (el formato de siempre)
+# Muestreo por logger, "nombre=fracción" separados por comas. Por defecto solo se escriben los mensajes de traza de una de cada
+# diez peticiones (recibida, resuelta, pasos intermedios); los avisos y errores se escriben siempre
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'source_code.peticiones=0.1')
+
+# Identificador de la petición en curso. Lo fija Request_Id_Middleware y lo añaden a cada mensaje los filtros del handler, que
+# se ejecutan en el mismo hilo y contexto que la llamada a logger.info
+request_id_var = ContextVar("request_id", default=None)
+
+REQUEST_ID_HEADER = b"x-request-id"
+VALID_REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+# Atributos que tienen todos los LogRecord, el resto son los que se pasan con extra= y salen como campos del JSON
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+
+def parse_sampling(value: str):
+    rates = {}
+    for item in value.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class Request_Id_Filter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+# Se queda con una fracción de los mensajes de un logger. La decisión depende del id de la petición, así que de una petición
+# se escriben todos sus mensajes o ninguno y se puede seguir entera
+class Sampling_Filter(logging.Filter):
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        self.threshold = int(rate * 2 ** 32)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        request_id = request_id_var.get()
+        if request_id is None:
+            return random.random() < self.rate
+        return zlib.crc32(request_id.encode("utf-8")) < self.threshold
+
+
+class Json_Formatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {"ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "pid": record.process, "message": record.getMessage()}
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# El handler de la cola solo prepara el mensaje: junta los argumentos (después pueden cambiar) y la traza de la excepción si la
+# hay. Pasarlo a JSON y escribirlo en stderr lo hace el hilo del QueueListener, así que el event loop nunca espera a la escritura.
+# A diferencia de QueueHandler no copia el registro: es el único handler del logger raíz y nadie más lo va a usar
+class Log_Queue_Handler(QueueHandler):
+
+    def prepare(self, record):
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_exception_formatter = logging.Formatter()
+_queue_handler = None
+_listener = None
+
+
+def build_output_handler():
+    handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "text":
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s"))
+    else:
+        handler.setFormatter(Json_Formatter())
+    return handler
+
+
+def _start_listener():
+    global _listener
+    _listener = QueueListener(_queue_handler.queue, build_output_handler(), respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()  # escribe antes lo que quede en la cola
+
+
+# Los hilos no sobreviven a un fork: los workers de gunicorn (creados con fork desde el maestro con preload) empiezan con una cola
+# nueva y su propio hilo de escritura
+def _after_fork():
+    if _queue_handler is not None:
+        _queue_handler.queue = queue.SimpleQueue()
+        _start_listener()
+
+
+# Sustituye la configuración de logging.basicConfig: el logger raíz solo tiene el handler de la cola y el nivel de LOG_LEVEL.
+# Se puede llamar varias veces, solo configura la primera
+def setup_logging():
+    global _queue_handler
+    if _queue_handler is not None:
+        return
+    _queue_handler = Log_Queue_Handler(queue.SimpleQueue())
+    _queue_handler.addFilter(Request_Id_Filter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, rate in parse_sampling(LOG_SAMPLING).items():
+        if rate < 1.0:
+            logging.getLogger(name).addFilter(Sampling_Filter(rate))
+    _start_listener()
+    atexit.register(_stop_listener)
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+# Middleware ASGI que da un id a cada petición: el de la cabecera X-Request-ID si el cliente o el proxy ya la manda (y es válido),
+# o uno nuevo. Se devuelve en la misma cabecera de la respuesta para poder buscar en los logs los mensajes de esa petición
+class Request_Id_Middleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER:
+                request_id = value.decode("latin-1")
+                break
+        if request_id is None or not VALID_REQUEST_ID.fullmatch(request_id):
+            request_id = uuid4().hex
+        header = (REQUEST_ID_HEADER, request_id.encode("latin-1"))
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), header]
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)
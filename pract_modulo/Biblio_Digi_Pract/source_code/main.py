@@ -1,136 +1,323 @@
 from .database import *
 from .models import *
 from .validators import *
-from fastapi import FastAPI, Body, BackgroundTasks, Depends, HTTPException, status, Query, Path
-from sqlalchemy.orm import Session
+from .hashing import hashing_service, Hashing_Busy
+from .bulk_import import Bulk_Import, link_actors
+from .cache import cache_bus, genre_cache, response_cache
+from .pagination import keyset_page, MAX_PAGE_SIZE, DEFAULT_PAGE_SIZE
+from .schema import check_schema
+from .search import search_catalog, suggest
+from .loans import checkout, return_loans, return_loan, user_open_items, user_loan_items
+from .stock import add_copies, retire_copy, STOCK_MAX_COPIES
+from .logs import setup_logging, Request_Id_Middleware
+from .metrics import Metrics_Middleware, render_metrics, METRICS_PATH, CONTENT_TYPE_LATEST
+from .profiling import Profiling_Middleware
+from .tracing import Tracing_Middleware, Traced_Route, memory_collector
+from .slow_queries import slow_query_log
+from fastapi import FastAPI, Body, BackgroundTasks, Depends, HTTPException, status, Query, Path, Request
+from contextlib import asynccontextmanager
+from sqlalchemy.ext.asyncio import AsyncSession
 import logging
-import bcrypt
-from sqlalchemy import or_, and_, DateTime
+from sqlalchemy import or_, and_, DateTime, Integer, select, exists, literal, false, union_all, exc
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+from datetime import datetime
+from typing import Literal
+import asyncio
+import time
+import os
 
-Base.metadata.create_all(bind=engine)
 
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
+# Los mensajes se escriben en JSON desde un hilo aparte (ver logs.py), los endpoints solo los dejan en una cola. Los mensajes de
+# traza de cada petición (recibida, resuelta...) van a su propio logger para poder muestrearlos con LOG_SAMPLING
+setup_logging()
 logger = logging.getLogger(__name__)
+request_logger = logging.getLogger("source_code.peticiones")
+
+# En modo debug los errores 500 devuelven la traza completa. En la imagen de Docker (perfil de producción) se pone a false
+API_DEBUG = os.getenv('API_DEBUG', 'true').lower() in ('1', 'true', 'yes')
+
+# Tiempos del último arranque por fase, en milisegundos (ver /Estadisticas/arranque)
+startup_stats = {}
+
+
+async def timed_phase(name: str, coro):
+    start = time.perf_counter()
+    result = await coro
+    startup_stats[f"{name}_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+# Arranque y parada de la aplicación. El esquema ya no se crea aquí (lo hacen las migraciones de Alembic antes de arrancar), solo se
+# comprueba que la BDD está en la última versión. Después, a la vez: el servicio de cifrado levanta su pool de procesos y calibra el
+# coste de bcrypt, se abren las conexiones del pool y se cargan las cachés, y por último se empiezan a escuchar los avisos del resto
+# de workers. Así la primera petición no paga ni las conexiones ni la calibración
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start = time.perf_counter()
+    configure_threadpool()
+    startup_stats["schema_version"] = await timed_phase("schema", check_schema())
+    await asyncio.gather(timed_phase("hashing", hashing_service.start()),
+                         timed_phase("pool", warm_pool()),
+                         timed_phase("caches", genre_cache.warm()))
+    await cache_bus.start()
+    startup_stats["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info("API lista en %.0f ms (%s)", startup_stats['total_ms'], startup_stats)
+    yield
+    await cache_bus.stop()
+    await hashing_service.stop()
 
 
 app = FastAPI(
     title="My_Digital_Library",
     description="API para la Gestión de la Biblioteca Digital",
     version="1.0.0", 
-    debug=True  # He añadido esta opción porque en la docu vi que era util para ver el registro de errores o causas de los posibles fallos
+    debug=API_DEBUG,  # He añadido esta opción porque en la docu vi que era util para ver el registro de errores o causas de los posibles fallos
+    lifespan=lifespan,
+    # Cada endpoint declara su esquema de respuesta (response_model, ver validators.py): FastAPI valida lo que devuelve el
+    # endpoint con pydantic y solo salen los campos del esquema. El JSON final lo genera orjson, bastante más rápido que json
+    default_response_class=ORJSONResponse
 )
+# Cada endpoint se ejecuta dentro de un span "handler <función>" de la traza de su petición (ver tracing.py). Tiene que ir antes
+# de declarar los endpoints
+app.router.route_class = Traced_Route
+
+# Trazas de cada petición (cabecera traceparent de W3C) con spans del handler, la sesión de BDD, cada sentencia SQL y bcrypt
+app.add_middleware(Tracing_Middleware)
+# Cada petición lleva un id (cabecera X-Request-ID) que aparece en todos sus mensajes de log
+app.add_middleware(Request_Id_Middleware)
+# Perfilado bajo demanda (cabecera X-Profile-Token firmada o PROFILE_SAMPLE_RATE), apagado por defecto. Ver profiling.py
+app.add_middleware(Profiling_Middleware)
+# Latencias, sentencias SQL y tiempo de BDD de cada petición para /metrics (ver metrics.py)
+app.add_middleware(Metrics_Middleware)
+
+
+# Las escrituras detectan los duplicados con ON CONFLICT, pero cualquier otra restricción única o de integridad que salte en la BDD
+# (por ejemplo dos peticiones a la vez que chocan en otra columna única) se contesta con un 409 en lugar de con un error 500
+@app.exception_handler(exc.IntegrityError)
+async def integrity_error_handler(request: Request, e: exc.IntegrityError):
+    logger.warning("Conflicto de integridad en %s %s: %s", request.method, request.url.path, e.orig)
+    return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"detail": "La operación choca con datos ya existentes en la BDD"})
         
 
-# Funcion para cifrar la contraseña del usuario
-def hash_password(pwd: str):
-    pwd_to_encode = pwd.encode("utf-8")
-    sal = bcrypt.gensalt()
-    encripted_pwd = bcrypt.hashpw(pwd_to_encode, sal)
-    return encripted_pwd.decode("utf-8")
+# Cifra la contraseña en el pool de procesos del servicio de cifrado. Si hay demasiados cifrados en cola se contesta con un 503
+# para que el cliente reintente más tarde en lugar de acumular peticiones que se quedan esperando
+async def cipher_password(pwd: str):
+    try:
+        return await hashing_service.hash(pwd)
+    except Hashing_Busy:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Demasiadas peticiones de cifrado en curso, inténtelo de nuevo en unos segundos", headers={"Retry-After": "1"})
+
+
+# Dependencias que cifran la contraseña del cuerpo de la petición. En los endpoints van antes que get_db, así FastAPI las resuelve
+# primero y el cifrado se hace sin tener ocupado un hueco del limitador ni una conexión del pool (con una transacción abierta)
+async def user_password(user: User):
+    request_logger.info("Cifrando contraseña del usuario...")
+    psswd_str = await cipher_password(user.hashed_password)
+    request_logger.info("Contraseña cifrada!")
+    return psswd_str
+
+
+async def updated_password(user_update: UserUpdate):
+    return await cipher_password(user_update.password) if user_update.password is not None else None
+
+
+# Las escrituras que modifican algo que puede estar en la caché de respuestas avisan al resto de workers dentro de la transacción,
+# hacen commit y solo entonces invalidan en este worker. Las claves son (tipo, nombre), por ejemplo ("book", "El Hobbit")
+async def commit_and_invalidate(db: AsyncSession, keys: list):
+    if keys:
+        await response_cache.publish_invalidation(db, keys)
+    await db.commit()
+    response_cache.invalidate(keys)
+
+
+# Filtros comunes de los listados de libros y películas. Devuelve None si el género pedido no existe (la página estará vacía)
+async def filter_items(db: AsyncSession, stmt, model, genre_name, available, from_date, to_date):
+    if genre_name:
+        genre_id = genre_cache.get(genre_name)
+        if genre_id is None:
+            genre_id = await db.scalar(select(Genre_DB.genre_id).where(Genre_DB.genre_name==genre_name))
+            if genre_id is None:
+                return None
+        stmt = stmt.where(model.genre_id==genre_id)
+    if available is not None:
+        # Sobre available_copies y no sobre available para que los disponibles de un género vayan por el índice parcial
+        stmt = stmt.where(model.available_copies>0 if available else model.available_copies==0)
+    if from_date:
+        stmt = stmt.where(model.date_registered>=from_date)
+    if to_date:
+        stmt = stmt.where(model.date_registered<to_date)
+    return stmt
+
+
+# Alta de un libro o una película en una sola sentencia, género incluido. Si el género está en la caché se usa su id; si no, en la
+# misma sentencia se crea (INSERT ... ON CONFLICT DO NOTHING) o se busca el que ya existía, y así ya lo tenemos de cara a futuras
+# adiciones. El título se inserta con ON CONFLICT DO NOTHING, así que si el nombre ya existe no devuelve ninguna fila en lugar de
+# dar error, y RETURNING devuelve la fila creada sin tener que volver a leerla
+def insert_title_statement(model, values: dict, genre_name: str, genre_id: int = None):
+    columns = model.__table__.c
+    if genre_id is None:
+        new_genre = (pg_insert(Genre_DB).values(genre_name=genre_name).on_conflict_do_nothing(index_elements=["genre_name"])
+                     .returning(Genre_DB.genre_id).cte("new_genre"))
+        genre = union_all(select(new_genre.c.genre_id), select(Genre_DB.genre_id).where(Genre_DB.genre_name==genre_name)).limit(1).subquery("genre")
+        genre_id = genre.c.genre_id
+        created = exists(select(new_genre.c.genre_id))
+    else:
+        genre_id = literal(genre_id, Integer)
+        created = false()
+    rows = select(*[literal(value, columns[key].type) for key, value in values.items()], genre_id)
+    returned = [c for c in columns if c.key != "search_vector"]
+    return (pg_insert(model).from_select([*values, "genre_id"], rows).on_conflict_do_nothing(index_elements=["name"])
+            .returning(*returned, created.label("genre_created")))
+
+
+# Ejecuta el alta y devuelve la fila creada, o un 409 si ya hay un título con ese nombre. Si un género nuevo lo estaba creando a la
+# vez otra petición, esta sentencia no lo ve (su snapshot es anterior) y no inserta nada; solo en ese caso, que no es un nombre
+# repetido, se repite la sentencia. Los géneros nuevos se avisan al resto de workers en la misma transacción
+async def insert_title(db: AsyncSession, model, values: dict, genre_name: str, conflict_detail: str):
+    for _ in range(2):
+        row = (await db.execute(insert_title_statement(model, values, genre_name, genre_cache.get(genre_name)))).mappings().first()
+        if row is not None or await db.scalar(select(exists(select(model.ref_number).where(model.name==values["name"])))):
+            break
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=conflict_detail)
+    item = dict(row)
+    if item.pop("genre_created"):
+        logger.info("El género '%s' no existía, se ha registrado junto con '%s'", genre_name, item['name'])
+        await genre_cache.publish(db, {genre_name: item["genre_id"]})
+    return item
 
 
 # Crear usuarios y registrarlos en la BD
-@app.post("/Usuarios/", status_code=status.HTTP_201_CREATED)
-async def create_user(user: User, db: Session = Depends(get_db)):
-    logger.info("Petición recibida para crear un nuevo usuario con los datos indicados")
-    # Verificamos primero si su nombre o correo ya estan dados ya existen en la BDD.
-    if db.query(UserDB).filter(UserDB.contact_mail==user.contact_mail).first():
+@app.post("/Usuarios/", status_code=status.HTTP_201_CREATED, response_model=UserResponse)
+async def create_user(user: User, psswd_str: str = Depends(user_password), db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para crear un nuevo usuario con los datos indicados")
+    # para la contraseña del usuario la ciframos haciendo uso de la librería bcrypt, fuera del event loop porque es una operación
+    # costosa. Ya viene cifrada por la dependencia user_password, antes de abrir la sesión de la BDD
+    # El correo repetido lo detecta el propio INSERT (ON CONFLICT DO NOTHING no devuelve ninguna fila), sin consultarlo antes, y
+    # RETURNING devuelve el usuario creado con su id y fecha de alta sin tener que volver a leerlo (sin la contraseña cifrada)
+    stmt = (pg_insert(UserDB).values(full_name=user.full_name, contact_mail=user.contact_mail, hashed_password=psswd_str, age=user.age)
+            .on_conflict_do_nothing(index_elements=["contact_mail"])
+            .returning(UserDB.user_id, UserDB.full_name, UserDB.contact_mail, UserDB.age, UserDB.date_added))
+    usr_added = (await db.execute(stmt)).mappings().first()
+    if usr_added is None:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="El usuario o el correo proporcionados ya existen en la base de datos.")
-    logger.info("Cifrando contraseña del usuario...")
-    # para la contraseña del usuario la cifraremos haciendo uso de la librería bcrypt
-    psswd_str = hash_password(user.hashed_password)
-    logger.info("Contraseña cifrada!")
-    usr_toadd = UserDB(full_name=user.full_name, contact_mail=user.contact_mail, hashed_password=psswd_str, age=user.age)
-    db.add(usr_toadd)
-    db.commit()
-    # añadimos al usuario a la base de datos
-    db.refresh(usr_toadd)
-    logger.info(f"Usuario {user.full_name} registrado en la BDD correctamente")
+    await db.commit()
+    logger.info("Usuario %s registrado en la BDD correctamente", user.full_name)
     
-    return usr_toadd
+    return usr_added
+
+
+# Listado de usuarios paginado por cursor, ordenado por id o por nombre. No se devuelve la contraseña cifrada
+# El next_cursor de la respuesta se pasa como cursor en la siguiente petición para obtener la página siguiente
+@app.get("/Usuarios/", status_code=status.HTTP_200_OK, response_model=Page[UserResponse])
+async def list_users(order_by: Literal["user_id", "full_name"] = Query("user_id", description="Columna por la que se ordena"),
+                     cursor: Optional[str] = Query(None, description="Cursor devuelto por la página anterior"),
+                     limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Número de elementos por página"),
+                     db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para listar usuarios")
+    stmt = select(UserDB.user_id, UserDB.full_name, UserDB.contact_mail, UserDB.age, UserDB.date_added)
+    sort_columns = [UserDB.full_name, UserDB.user_id] if order_by == "full_name" else [UserDB.user_id]
+    return await keyset_page(db, stmt, sort_columns, cursor, limit, scalars=False)
 
 
 # Obtener usuarios por el nombre en caso de haber mas de uno con el mismo nombre, que puede ocurrir, devolver la lista de todos
-@app.get("/Usuarios/{name}", status_code=status.HTTP_200_OK)
-def get_user(name: str, db: Session = Depends(get_db)):
-    logger.info("Petición recibida para obtener la información de un usuario")
-    existing = db.query(UserDB).filter(UserDB.full_name==name).all()
+@app.get("/Usuarios/{name}", status_code=status.HTTP_200_OK, response_model=List[UserResponse])
+async def get_user(name: str, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para obtener la información de un usuario")
+    existing = (await db.scalars(select(UserDB).where(UserDB.full_name==name))).all()
     # Aqui indico que coja todos, ya que puede haber un caso en el que existan dos usuarios que comiencen por el mismo nombre pero que no tengan nada que ver
     # y en ese caso entiendo que lo mejor es sacar todos los que se llamen de esa forma y ya decidir con cual te quedas.
     if not(existing):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El usuario no existe en la BDD")
-    logger.info("Petición resuelta")
+    request_logger.info("Petición resuelta")
     return existing
 
 # Modificación parcial de un usuario, se prodría haber hecho un put pero entiendo que si te has equivocado en todo lo borras y creas uno nuevo. 
-@app.patch("/Usuarios/{user_id}/Perfil_de_usuario", status_code=status.HTTP_200_OK)
-def modify_user_fields(user_update: UserUpdate, user_id: int = Path(..., description="ID del usuario a modificar"),  db: Session = Depends(get_db)):
-    logger.info(f"Petición recibida para modificar el usuario con ID: {user_id}")
-    existing_user = db.query(UserDB).filter(UserDB.user_id==user_id).first()
+@app.patch("/Usuarios/{user_id}/Perfil_de_usuario", status_code=status.HTTP_200_OK, response_model=UserResponse)
+async def modify_user_fields(user_update: UserUpdate, user_id: int = Path(..., description="ID del usuario a modificar"),
+                             pwd_ciphered: Optional[str] = Depends(updated_password), db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para modificar el usuario con ID: %s", user_id)
+    existing_user = await db.scalar(select(UserDB).where(UserDB.user_id==user_id))
     if not existing_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Este usuario no esta registrado en la BDD")
     update_data = user_update.model_dump(exclude_unset=True)
-    logger.info(f"Modificando los registros indicados")
-    if "hashed_password" in update_data:
-        # Si se tiene que actualizar la contraseña llamamos a la función de cifrado
-        pwd_ciphered = hash_password(update_data["hashed_password"])
+    request_logger.info("Modificando los registros indicados")
+    # Si se tiene que actualizar la contraseña ya viene cifrada por la dependencia updated_password (antes de la consulta). En
+    # UserUpdate el campo se llama password pero en la tabla se guarda cifrada en hashed_password
+    update_data.pop("password", None)
+    if pwd_ciphered is not None:
         # setattr he visto en un video que es la forma correcta de modificar las variables de un registro, inicialmente intentaba acceder a esas con un .update a traves de consulta o con [],
         # cosa que segun lei no era muy buena practica
         setattr(existing_user, "hashed_password", pwd_ciphered)
     for key, value in update_data.items():
-        if key != "hashed_password":
-            setattr(existing_user, key, value)
-    db.commit()
-    db.refresh(existing_user)
-    logger.info(f"Peticion resuelta")
+        setattr(existing_user, key, value)
+    await db.commit()
+    await db.refresh(existing_user)
+    request_logger.info("Peticion resuelta")
     
     return existing_user
     
         
 # Creacíon y registro de un libro, para este caso pense que si el genero del libro no existia convendria añadirlo para ya tenerlo de cara a futuras adiciones
-@app.post("/Libros/", status_code=status.HTTP_201_CREATED)
-def create_book(book: Book, genre_name: Optional[str] = Query(None, description="Nombre del género a añadir (opcional)"), db: Session = Depends(get_db)):
-    logger.info(f"Recibida petición para añadir a la BDD el libro {book.name}")
-    logger.info("Procesando el genero del libro pasado por parámetro")
-    if genre_name:
-        genre = db.query(Genre_DB).filter(Genre_DB.genre_name==genre_name).first()
-        if genre is None: #Si no existe ese género en la BDD lo incluimos
-            logger.info(f"El género '{genre_name}' no existe. Creando nuevo género.")
-            new_genre = Genre_DB(genre_name=genre_name)
-            db.add(new_genre)
-            db.commit()
-            db.refresh(new_genre)
-            logger.info(f"El género '{genre_name}' se ha registrado correctamente.")
-        else:
-            new_genre = genre
-    else:
+@app.post("/Libros/", status_code=status.HTTP_201_CREATED, response_model=BookResponse)
+async def create_book(book: Book, genre_name: Optional[str] = Query(None, description="Nombre del género a añadir (opcional)"),
+                      copies: int = Query(1, ge=1, le=STOCK_MAX_COPIES, description="Número de ejemplares del libro"), db: AsyncSession = Depends(get_db)):
+    request_logger.info("Recibida petición para añadir a la BDD el libro %s", book.name)
+    request_logger.info("Procesando el genero del libro pasado por parámetro")
+    if not genre_name:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Debe especificarse el género de la nueva película")
-    
-    existing = db.query(Book_DB).filter(Book_DB.name==book.name).first()
-    if existing:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Este libro ya se ha registrado")
-    b = Book_DB(name=book.name, author=book.author)
-    b.genre_id = new_genre.genre_id
-    db.add(b)
-    db.commit()
-    db.refresh(b)
-    logger.info(f"Libro {b.name} registrado en la BDD correctamente")
+    # los ejemplares los crea la BDD. No hace falta invalidar la caché de respuestas porque no guarda los libros que no existen
+    b = await insert_title(db, Book_DB, {"name": book.name, "author": book.author, "total_copies": copies, "available_copies": copies},
+                           genre_name, "Este libro ya se ha registrado")
+    await db.commit()
+    genre_cache.put(genre_name, b["genre_id"])
+    logger.info("Libro %s registrado en la BDD correctamente", b['name'])
     
     return b
 
 
-@app.get("/Libros/{name}", status_code=status.HTTP_200_OK)
-def get_book(name: str, db: Session = Depends(get_db)):
-    logger.info("Petición recibida para obtener la información de un libro")
-    existing = db.query(Book_DB).filter(Book_DB.name==name).first()
-    if not(existing):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El libro no esta registrado en la BDD")
-    logger.info("Petición resuelta")
-    return existing
+# Carga masiva de libros. El cuerpo se envía en streaming como NDJSON (Content-Type: application/x-ndjson) o CSV (text/csv)
+# con las columnas name, author y genre_name (y copies opcional); si una fila no trae género se usa el pasado por parámetro
+@app.post("/Libros/bulk", status_code=status.HTTP_200_OK, response_model=BulkSummary)
+async def bulk_create_books(request: Request, genre_name: Optional[str] = Query(None, description="Género por defecto para las filas que no lo indiquen"), db: AsyncSession = Depends(get_db)):
+    request_logger.info("Recibida petición de carga masiva de libros")
+    summary = await Bulk_Import(db, Book, Book_DB, genre_name).run(request)
+    logger.info("Carga masiva de libros terminada: %s de %s filas insertadas", summary['inserted'], summary['received'])
+    return summary
+
+
+# Listado de libros paginado por cursor, ordenado por referencia o por nombre y con filtros por género, disponibilidad y fecha de registro
+@app.get("/Libros/", status_code=status.HTTP_200_OK, response_model=Page[BookResponse])
+async def list_books(genre_name: Optional[str] = Query(None, description="Solo los libros de este género"),
+                     available: Optional[bool] = Query(None, description="Solo los libros con ejemplares libres (true) o con todos prestados (false)"),
+                     from_date: Optional[datetime] = Query(None, description="Registrados desde esta fecha (incluida)"),
+                     to_date: Optional[datetime] = Query(None, description="Registrados antes de esta fecha"),
+                     order_by: Literal["ref_number", "name"] = Query("ref_number", description="Columna por la que se ordena"),
+                     cursor: Optional[str] = Query(None, description="Cursor devuelto por la página anterior"),
+                     limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Número de elementos por página"),
+                     db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para listar libros")
+    stmt = await filter_items(db, select(Book_DB), Book_DB, genre_name, available, from_date, to_date)
+    if stmt is None:
+        return {"items": [], "next_cursor": None}
+    return await keyset_page(db, stmt, [Book_DB.name] if order_by == "name" else [Book_DB.ref_number], cursor, limit)
+
+
+# Las consultas por nombre pasan por la caché de respuestas, que devuelve el JSON ya serializado con su ETag (o un 304 si el
+# cliente ya lo tiene). La función load solo se ejecuta si no está en caché, y el resultado se serializa con el mismo esquema
+# que declara response_model (que aquí solo sirve para la documentación, porque el endpoint ya devuelve la respuesta hecha)
+@app.get("/Libros/{name}", status_code=status.HTTP_200_OK, response_model=BookResponse)
+async def get_book(name: str, request: Request, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para obtener la información de un libro")
+    async def load(db):
+        existing = await db.scalar(select(Book_DB).where(Book_DB.name==name))
+        if not(existing):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El libro no esta registrado en la BDD")
+        return existing
+    response = await response_cache.respond(request, "book", name, "detail", load, db, BookResponse)
+    request_logger.info("Petición resuelta")
+    return response
 
 
 
@@ -138,180 +325,388 @@ def get_book(name: str, db: Session = Depends(get_db)):
 
 # Esta función la plantee de forma que tu creases una película y despues que a traves de un parámetro pasado por entrada (en este caso lo vi en stackoverflow) se pudiesen adjuntar 4
 # parámetros adicionales como el género de una película a la URL wue apunta ese endpoint
-@app.post("/Peliculas/", status_code=status.HTTP_201_CREATED)
-def create_film(film: Film, genre_name: Optional[str] = Query(None, description="Nombre del género a añadir (opcional)"), db: Session = Depends(get_db)):
-    logger.info(f"Recibida petición para añadir a la BDD la pelicula {film.name}")
-    logger.info("Procesando el genero pasado por parámetro")
-    if genre_name:
-        genre = db.query(Genre_DB).filter(Genre_DB.genre_name==genre_name).first()
-        if genre is None:
-            logger.info(f"El género '{genre_name}' no existe. Creando nuevo género.")
-            new_genre = Genre_DB(genre_name=genre_name)
-            db.add(new_genre)
-            db.commit()
-            db.refresh(new_genre)
-            logger.info(f"El género '{genre_name}' se ha registrado correctamente.")
-        else:
-            new_genre = genre
-    else:
+@app.post("/Peliculas/", status_code=status.HTTP_201_CREATED, response_model=FilmResponse)
+async def create_film(film: Film, genre_name: Optional[str] = Query(None, description="Nombre del género a añadir (opcional)"),
+                      copies: int = Query(1, ge=1, le=STOCK_MAX_COPIES, description="Número de ejemplares de la película"), db: AsyncSession = Depends(get_db)):
+    request_logger.info("Recibida petición para añadir a la BDD la pelicula %s", film.name)
+    request_logger.info("Procesando el genero pasado por parámetro")
+    if not genre_name:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail= "Debe especificarse el género de la nueva película")
-    # Ahora que ya hemos gestionado el tema del género vamos a ver que hacemos con la película
-    
-    existing = db.query(Film_DB).filter(Film_DB.name==film.name).first()
-    if existing:
-        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Esta pelicula ya se encuentra registrada")
-
-    # film.genre_id=new_genre.genre_id 
-    f = Film_DB(name=film.name, actors=film.actors)
-    f.genre_id = new_genre.genre_id
-    db.add(f)
-    db.commit()
-    db.refresh(f)
-    logger.info(f"Pelicula {f.name} registrada en la BDD correctamente")
+    # El género se gestiona en la misma sentencia que da de alta la película, y con su ref_number se da de alta el reparto
+    f = await insert_title(db, Film_DB, {"name": film.name, "actors": film.actors, "total_copies": copies, "available_copies": copies},
+                           genre_name, "Esta pelicula ya se encuentra registrada")
+    await link_actors(db, {f["ref_number"]: split_actors(film.actors)})
+    await db.commit()
+    genre_cache.put(genre_name, f["genre_id"])
+    logger.info("Pelicula %s registrada en la BDD correctamente", f['name'])
     
     return f
 
 
-@app.get("/Peliculas/{name}", status_code=status.HTTP_200_OK)
-def get_film(name: str, db: Session = Depends(get_db)):
-    logger.info("Petición recibida para obtener la información de una pelicula")
-    existing = db.query(Film_DB).filter(Film_DB.name==name).first()
-    if not(existing):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="La pelicula no esta registrada en la BDD")
-    logger.info("Petición resuelta")
-    return existing
+# Carga masiva de películas, igual que la de libros pero con las columnas name, actors y genre_name
+@app.post("/Peliculas/bulk", status_code=status.HTTP_200_OK, response_model=BulkSummary)
+async def bulk_create_films(request: Request, genre_name: Optional[str] = Query(None, description="Género por defecto para las filas que no lo indiquen"), db: AsyncSession = Depends(get_db)):
+    request_logger.info("Recibida petición de carga masiva de películas")
+    summary = await Bulk_Import(db, Film, Film_DB, genre_name).run(request)
+    logger.info("Carga masiva de películas terminada: %s de %s filas insertadas", summary['inserted'], summary['received'])
+    return summary
 
 
-@app.get("/Peliculas/{name}/actors", status_code=status.HTTP_200_OK)
-def get_film_actors(name: str, db: Session = Depends(get_db)):
-    logger.info("Petición recibida para obtener la información de una pelicula")
-    existing = db.query(Film_DB).filter(Film_DB.name==name).first()
-    if not(existing):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="La pelicula no esta registrada en la BDD")
-    logger.info("Petición resuelta")
-    return existing.actors_listing()
+# Listado de películas, con los mismos filtros y ordenaciones que el de libros
+@app.get("/Peliculas/", status_code=status.HTTP_200_OK, response_model=Page[FilmResponse])
+async def list_films(genre_name: Optional[str] = Query(None, description="Solo las películas de este género"),
+                     available: Optional[bool] = Query(None, description="Solo las películas con ejemplares libres (true) o con todos prestados (false)"),
+                     from_date: Optional[datetime] = Query(None, description="Registradas desde esta fecha (incluida)"),
+                     to_date: Optional[datetime] = Query(None, description="Registradas antes de esta fecha"),
+                     order_by: Literal["ref_number", "name"] = Query("ref_number", description="Columna por la que se ordena"),
+                     cursor: Optional[str] = Query(None, description="Cursor devuelto por la página anterior"),
+                     limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Número de elementos por página"),
+                     db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para listar películas")
+    stmt = await filter_items(db, select(Film_DB), Film_DB, genre_name, available, from_date, to_date)
+    if stmt is None:
+        return {"items": [], "next_cursor": None}
+    return await keyset_page(db, stmt, [Film_DB.name] if order_by == "name" else [Film_DB.ref_number], cursor, limit)
+
+
+@app.get("/Peliculas/{name}", status_code=status.HTTP_200_OK, response_model=FilmResponse)
+async def get_film(name: str, request: Request, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para obtener la información de una pelicula")
+    async def load(db):
+        existing = await db.scalar(select(Film_DB).where(Film_DB.name==name))
+        if not(existing):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="La pelicula no esta registrada en la BDD")
+        return existing
+    response = await response_cache.respond(request, "film", name, "detail", load, db, FilmResponse)
+    request_logger.info("Petición resuelta")
+    return response
+
+
+@app.get("/Peliculas/{name}/actors", status_code=status.HTTP_200_OK, response_model=Dict[str, str])
+async def get_film_actors(name: str, request: Request, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para obtener la información de una pelicula")
+    async def load(db):
+        ref_number = await db.scalar(select(Film_DB.ref_number).where(Film_DB.name==name))
+        if not(ref_number):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="La pelicula no esta registrada en la BDD")
+        stmt = (select(Actor_DB.full_name)
+                .join(film_actor_association_table, film_actor_association_table.c.actor_id==Actor_DB.actor_id)
+                .where(film_actor_association_table.c.film_ref_number==ref_number)
+                .order_by(film_actor_association_table.c.position))
+        return casting_listing((await db.scalars(stmt)).all())
+    response = await response_cache.respond(request, "film", name, "actors", load, db, Dict[str, str])
+    request_logger.info("Petición resuelta")
+    return response
+
+
+# Películas en las que aparece un actor, paginadas por cursor. Va por el índice (actor, película) de film_actor
+@app.get("/Actores/{name}/Peliculas", status_code=status.HTTP_200_OK, response_model=Page[FilmResponse])
+async def get_actor_films(name: str,
+                          cursor: Optional[str] = Query(None, description="Cursor devuelto por la página anterior"),
+                          limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Número de elementos por página"),
+                          db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para obtener las películas de un actor")
+    actor_id = await db.scalar(select(Actor_DB.actor_id).where(Actor_DB.full_name==name))
+    if not(actor_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El actor no esta registrado en la BDD")
+    stmt = (select(Film_DB)
+            .join(film_actor_association_table, film_actor_association_table.c.film_ref_number==Film_DB.ref_number)
+            .where(film_actor_association_table.c.actor_id==actor_id))
+    return await keyset_page(db, stmt, [Film_DB.ref_number], cursor, limit)
+
+
+# Ejemplares de un libro o una película, paginados por cursor, y alta de ejemplares nuevos (ver stock.py)
+async def list_copies(db: AsyncSession, model, name: str, cursor: str, limit: int):
+    ref_number = await db.scalar(select(model.ref_number).where(model.name==name))
+    if not(ref_number):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El título no esta registrado en la BDD")
+    copy_column = Copy_DB.book_ref_number if model is Book_DB else Copy_DB.film_ref_number
+    return await keyset_page(db, select(Copy_DB).where(copy_column==ref_number), [Copy_DB.copy_id], cursor, limit)
 
 
-@app.post("/Generos/", status_code=status.HTTP_201_CREATED)
-def create_genre(gen: Genre, db: Session = Depends(get_db)):
-    logger.info(f"Recibida petición para añadir a la BDD la pelicula {gen.genre_name}")
-    existing = db.query(Genre_DB).filter(Genre_DB.genre_name==gen.genre_name).first()
-    if existing:
+@app.get("/Libros/{name}/Ejemplares", status_code=status.HTTP_200_OK, response_model=Page[CopyResponse])
+async def list_book_copies(name: str,
+                           cursor: Optional[str] = Query(None, description="Cursor devuelto por la página anterior"),
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Número de elementos por página"),
+                           db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para listar los ejemplares de un libro")
+    return await list_copies(db, Book_DB, name, cursor, limit)
+
+
+@app.post("/Libros/{name}/Ejemplares", status_code=status.HTTP_201_CREATED, response_model=NewCopiesResponse)
+async def add_book_copies(name: str, copies: Copies, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para añadir %s ejemplares al libro %s", copies.copies, name)
+    if copies.copies > STOCK_MAX_COPIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Se pueden añadir como mucho {STOCK_MAX_COPIES} ejemplares a la vez")
+    title, changed = await add_copies(db, Book_DB, name, copies.copies, copies.barcodes)
+    await commit_and_invalidate(db, changed)
+    return title
+
+
+@app.get("/Peliculas/{name}/Ejemplares", status_code=status.HTTP_200_OK, response_model=Page[CopyResponse])
+async def list_film_copies(name: str,
+                           cursor: Optional[str] = Query(None, description="Cursor devuelto por la página anterior"),
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Número de elementos por página"),
+                           db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para listar los ejemplares de una película")
+    return await list_copies(db, Film_DB, name, cursor, limit)
+
+
+@app.post("/Peliculas/{name}/Ejemplares", status_code=status.HTTP_201_CREATED, response_model=NewCopiesResponse)
+async def add_film_copies(name: str, copies: Copies, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para añadir %s ejemplares a la película %s", copies.copies, name)
+    if copies.copies > STOCK_MAX_COPIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Se pueden añadir como mucho {STOCK_MAX_COPIES} ejemplares a la vez")
+    title, changed = await add_copies(db, Film_DB, name, copies.copies, copies.barcodes)
+    await commit_and_invalidate(db, changed)
+    return title
+
+
+# Baja de un ejemplar (perdido, deteriorado...) por su código de barras. No se puede dar de baja un ejemplar prestado
+@app.delete("/Ejemplares/{barcode}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_copy(barcode: str, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición de baja del ejemplar %s", barcode)
+    changed = await retire_copy(db, barcode)
+    await commit_and_invalidate(db, changed)
+
+
+@app.post("/Generos/", status_code=status.HTTP_201_CREATED, response_model=GenreResponse)
+async def create_genre(gen: Genre, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Recibida petición para añadir a la BDD el género %s", gen.genre_name)
+    stmt = (pg_insert(Genre_DB).values(genre_name=gen.genre_name).on_conflict_do_nothing(index_elements=["genre_name"])
+            .returning(Genre_DB.genre_id, Genre_DB.genre_name))
+    g = (await db.execute(stmt)).mappings().first()
+    if g is None:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Este género ya se encuentra registrado")
-    g = Genre_DB(genre_name=gen.genre_name)
-    db.add(g)
-    db.commit()
-    db.refresh(g)
-    logger.info(f"Género {g.genre_name} registrado en la BDD correctamente")
+    await genre_cache.publish(db, {g["genre_name"]: g["genre_id"]})
+    await db.commit()
+    genre_cache.put(g["genre_name"], g["genre_id"])
+    logger.info("Género %s registrado en la BDD correctamente", g['genre_name'])
     
     return g
 
 
-@app.get("/Generos/{name}", status_code=status.HTTP_200_OK)
-def get_genre(name: str, db: Session = Depends(get_db)):
-    logger.info("Petición recibida para obtener la información de un genero en concreto")
-    existing = db.query(Genre_DB).filter(Genre_DB.genre_name==name).first()
-    if not(existing):
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Este género no esta registrado en la BDD")
-    logger.info("Petición resuelta")
-    return existing
+@app.get("/Generos/", status_code=status.HTTP_200_OK, response_model=Page[GenreResponse])
+async def list_genres(order_by: Literal["genre_id", "genre_name"] = Query("genre_id", description="Columna por la que se ordena"),
+                      cursor: Optional[str] = Query(None, description="Cursor devuelto por la página anterior"),
+                      limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Número de elementos por página"),
+                      db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para listar géneros")
+    sort_columns = [Genre_DB.genre_name] if order_by == "genre_name" else [Genre_DB.genre_id]
+    return await keyset_page(db, select(Genre_DB), sort_columns, cursor, limit)
+
+
+@app.get("/Generos/{name}", status_code=status.HTTP_200_OK, response_model=GenreResponse)
+async def get_genre(name: str, request: Request, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para obtener la información de un genero en concreto")
+    async def load(db):
+        genre_id = genre_cache.get(name)
+        if genre_id is not None:
+            return {"genre_id": genre_id, "genre_name": name}
+        existing = await db.scalar(select(Genre_DB).where(Genre_DB.genre_name==name))
+        if not(existing):
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Este género no esta registrado en la BDD")
+        genre_cache.put(existing.genre_name, existing.genre_id)
+        return existing
+    response = await response_cache.respond(request, "genre", name, "detail", load, db, GenreResponse)
+    request_logger.info("Petición resuelta")
+    return response
 
 
 # Esta funcion permite verificar si es posible realizar un préstamo analizando la disponibilidad de lo que pide el usuario en una solicitud. En caso de alguno de los productos no estar disponibles 
 # devolverá el error 409 de que no se puede acceder a ese recurso
-@app.post("/Realizar_un_prestamo/", status_code=status.HTTP_201_CREATED)
-def loan_articles( user: User, book: Book = None, film: Film = None, db: Session = Depends(get_db)):
-    logger.info("Petición recibida para realizar un préstamo")
+@app.post("/Realizar_un_prestamo/", status_code=status.HTTP_201_CREATED, response_model=CheckoutResponse)
+async def loan_articles( user: User, book: Book = None, film: Film = None, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para realizar un préstamo")
     ref_book = None
     ref_film = None
     if book is None and film is None:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Error, no se puede realizar un préstamo de nada")
-    existing_user = db.query(UserDB).filter(and_(UserDB.full_name==user.full_name, UserDB.contact_mail==user.contact_mail)).first()
-    if existing_user:
-        logger.info("Analisis del libro solicitado")
-        if book:
-            existing_book = db.query(Book_DB).filter(Book_DB.name==book.name).first()
-            if not(existing_book) or not(existing_book.available):
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Error, el recurso con nombre {book.name} no existe o no se encuentra disponible")
-            logger.info("Libro disponible!")
-            existing_book.item_took() # con las funciones de la clase abstaracte decimos que han cogido ese item
-            db.add(existing_book)
-            # db.refresh(existing_book)
-            ref_book = existing_book.ref_number
-        logger.info("Analisis de la película solicitada") 
-        if film:  
-            existing_film = db.query(Film_DB).filter(Film_DB.name==film.name).first()
-            if not(existing_film) or not(existing_film.available):
-                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Error, el recurso con nombre {film.name} no existe o no se encuentra disponible")
-            logger.info("Pelicula disponible!")
-            existing_film.item_took()
-            db.add(existing_film)
-            # db.refresh(existing_film)
-            ref_film = existing_film.ref_number
-        logger.info("Analisis completado. Procediendo a registrar el prestamo")
-    else:
+    existing_user = await db.scalar(select(UserDB.user_id).where(and_(UserDB.full_name==user.full_name, UserDB.contact_mail==user.contact_mail)))
+    if not(existing_user):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="El usuario que se indica que realiza el préstamo no existe")
-    id_user = existing_user.user_id
-    l = Loan_DB(user_id=id_user, book_ref_number=ref_book, film_ref_number=ref_film)
-    db.add(l)
-    db.commit()
-    db.refresh(l)
-    
+    # Aquí solo se traducen los nombres a referencias, la disponibilidad se comprueba y se cambia de forma atómica en checkout
+    if book:
+        ref_book = await db.scalar(select(Book_DB.ref_number).where(Book_DB.name==book.name))
+        if not(ref_book):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Error, el recurso con nombre {book.name} no existe o no se encuentra disponible")
+    if film:
+        ref_film = await db.scalar(select(Film_DB.ref_number).where(Film_DB.name==film.name))
+        if not(ref_film):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Error, el recurso con nombre {film.name} no existe o no se encuentra disponible")
+    request_logger.info("Analisis completado. Procediendo a registrar el prestamo")
+    l, changed = await checkout(db, existing_user, [ref_book] if ref_book else [], [ref_film] if ref_film else [], all_or_nothing=True)
+    await commit_and_invalidate(db, changed)
+    return l
+
+
+# Préstamo por identificadores: una sola sentencia que comprueba la disponibilidad, marca lo prestado y registra el préstamo,
+# de forma que con muchas peticiones a la vez por el mismo artículo solo una lo consigue y el resto recibe un 409
+@app.post("/Prestamos/", status_code=status.HTTP_201_CREATED, response_model=CheckoutResponse)
+async def create_loan(loan: Loan, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para realizar un préstamo")
+    l, changed = await checkout(db, loan.user_id, [loan.book_ref_number] if loan.book_ref_number else [],
+                                [loan.film_ref_number] if loan.film_ref_number else [], all_or_nothing=True)
+    await commit_and_invalidate(db, changed)
+    logger.info("Préstamo %s registrado", l['loan_id'])
     return l
 
+
+# Préstamo de varios artículos a la vez en una sola transacción (ver loans.py). Por defecto se presta lo que esté disponible y en
+# failed se indica uno a uno lo que no se ha podido prestar y por qué; con all_or_nothing o se prestan todos o ninguno
+@app.post("/Prestamos/Lote", status_code=status.HTTP_201_CREATED, response_model=CheckoutResponse)
+async def create_batch_loan(loan: LoanBatch, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para realizar un préstamo de %s artículos", len(loan.book_ref_numbers) + len(loan.film_ref_numbers))
+    l, changed = await checkout(db, loan.user_id, loan.book_ref_numbers, loan.film_ref_numbers, loan.all_or_nothing)
+    await commit_and_invalidate(db, changed)
+    logger.info("Préstamo %s registrado con %s artículos, %s no disponibles", l['loan_id'], len(l['items']), len(l['failed']))
+    return l
+
+# Listado de préstamos, de los más recientes a los más antiguos, filtrando por usuario, por si están devueltos o no y por fecha
+@app.get("/Prestamos/", status_code=status.HTTP_200_OK, response_model=Page[LoanResponse])
+async def list_loans(user_id: Optional[int] = Query(None, description="Solo los préstamos de este usuario"),
+                     returned: Optional[bool] = Query(None, description="Solo los préstamos devueltos (true) o pendientes (false)"),
+                     from_date: Optional[datetime] = Query(None, description="Realizados desde esta fecha (incluida)"),
+                     to_date: Optional[datetime] = Query(None, description="Realizados antes de esta fecha"),
+                     cursor: Optional[str] = Query(None, description="Cursor devuelto por la página anterior"),
+                     limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Número de elementos por página"),
+                     db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para listar préstamos")
+    stmt = select(Loan_DB)
+    if user_id is not None:
+        stmt = stmt.where(Loan_DB.user_id==user_id)
+    if returned is not None:
+        stmt = stmt.where(Loan_DB.return_date.isnot(None) if returned else Loan_DB.return_date.is_(None))
+    if from_date:
+        stmt = stmt.where(Loan_DB.loan_date>=from_date)
+    if to_date:
+        stmt = stmt.where(Loan_DB.loan_date<to_date)
+    return await keyset_page(db, stmt, [Loan_DB.loan_id], cursor, limit, descending=True)
+
+
+# Búsqueda de texto en libros (nombre y autor) y películas (nombre y reparto), sin distinguir mayúsculas ni acentos y ordenada
+# por relevancia. Si no se encuentra nada se devuelven sugerencias de nombres parecidos
+@app.get("/Buscar", status_code=status.HTTP_200_OK, response_model=SearchResults)
+async def search(q: str = Query(..., min_length=1, max_length=200, description="Texto a buscar"),
+                 type: Optional[Literal["book", "film"]] = Query(None, description="Buscar solo libros o solo películas"),
+                 limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE, description="Número máximo de resultados"),
+                 db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para buscar en el catálogo")
+    results = await search_catalog(db, q, type, limit)
+    suggestions = await suggest(db, q, type) if not results else []
+    request_logger.info("Petición resuelta")
+    return {"query": q, "results": results, "suggestions": suggestions}
+
+
 # Aqui lo que se pretende es poder gestionar el tema de las devoluciones de los prestamos.
-@app.patch("/Devolver_prestamo/", status_code=status.HTTP_200_OK)
-def loan_returned(loan: Loan, db: Session = Depends(get_db)):
-    logger.info("Petición recibida para devolver un préstamo")
-    logger.info("Verificamos que el préstamo es correcto")
-    # Aqui verificamos la casuística del préstamo, si sera de libro y peli, solo libro o solo peli
-    if loan.film_ref_number and loan.book_ref_number:
-        existing_loan = db.query(Loan_DB).filter(and_(Loan_DB.user_id==loan.user_id, Loan_DB.book_ref_number==loan.book_ref_number, Loan_DB.film_ref_number==loan.film_ref_number)).first()
-    elif loan.film_ref_number and loan.book_ref_number is None:
-        existing_loan = db.query(Loan_DB).filter(and_(Loan_DB.user_id==loan.user_id, Loan_DB.film_ref_number==loan.film_ref_number)).first()
-    elif loan.film_ref_number is None and loan.book_ref_number:
-        existing_loan = db.query(Loan_DB).filter(and_(Loan_DB.user_id==loan.user_id, Loan_DB.book_ref_number==loan.book_ref_number)).first()
-    else:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No puede existir un préstamo donde no se haya prestado nada!!")
-    if(existing_loan):
-        logger.info("Procedemos a ver que es exactamente lo que se ha prestado")
-        if existing_loan.book_ref_number:
-            existing_book = db.query(Book_DB).filter(Book_DB.ref_number==existing_loan.book_ref_number).first()
-            existing_book.item_returned() # Empleamos las funciones declaradas en la clase abstracta para reflejar la devolución de los item
-            db.add(existing_book)
-            # db.refresh(existing_book)
-        if existing_loan.film_ref_number:
-            existing_film = db.query(Film_DB).filter(Film_DB.ref_number==existing_loan.film_ref_number).first()
-            existing_film.item_returned()
-            db.add(existing_film)
-            # db.refresh(existing_film)
-    else:
-         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No existe el prestamo")       
-    existing_loan.return_date = func.now()
-    db.add(existing_loan)
-    db.commit()
-    db.refresh(existing_loan)
-    
-    return existing_loan
+@app.patch("/Devolver_prestamo/", status_code=status.HTTP_200_OK, response_model=LoanDetailResponse)
+async def loan_returned(loan: Loan, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para devolver un préstamo")
+    request_logger.info("Verificamos que el préstamo es correcto")
+    # Aqui verificamos la casuística del préstamo, si sera de libro y peli, solo libro o solo peli. Solo se buscan los préstamos que
+    # siguen abiertos y el libro y la película tienen que estar en el mismo préstamo, así solo se devuelve uno. El cierre del
+    # préstamo y la devolución de los artículos se hacen en una única sentencia (ver loans.py)
+    loans, changed = await return_loans(db, user_loan_items(loan.user_id, loan.book_ref_number, loan.film_ref_number))
+    if not loans:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No existe el prestamo")
+    await commit_and_invalidate(db, changed)
+    return loans[0]
+
+
+# Devolución de un préstamo por su id
+@app.patch("/Prestamos/{loan_id}/Devolucion", status_code=status.HTTP_200_OK, response_model=LoanDetailResponse)
+async def return_loan_by_id(loan_id: int = Path(..., description="ID del préstamo a devolver"), db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para devolver el préstamo %s", loan_id)
+    l, changed = await return_loan(db, loan_id)
+    await commit_and_invalidate(db, changed)
+    return l
+
+
+# Devuelve de una vez todos los préstamos abiertos de un usuario, por ejemplo lo que deja en el buzón de devoluciones
+@app.patch("/Usuarios/{user_id}/Prestamos/Devolucion", status_code=status.HTTP_200_OK, response_model=ReturnSummary)
+async def return_user_loans(user_id: int = Path(..., description="ID del usuario que devuelve sus préstamos"), db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición recibida para devolver todos los préstamos del usuario %s", user_id)
+    loans, changed = await return_loans(db, user_open_items(user_id))
+    if not loans and not await db.scalar(select(exists(select(UserDB.user_id).where(UserDB.user_id==user_id)))):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El usuario no existe")
+    await commit_and_invalidate(db, changed)
+    logger.info("Devueltos %s préstamos del usuario %s", len(loans), user_id)
+    return {"returned": sum(len(l["items"]) for l in loans), "loans": loans}
 
 # Funciones para borrar los item de la BDD, libros y películas. Para el caso de géneros, usuarios o prestamos no lo considero interesante pues siempre conviene tener registros de esas tablas
 @app.delete("/Libros/{ref_number}/", status_code=status.HTTP_204_NO_CONTENT)
-def delete_book(ref_number: int, db: Session = Depends(get_db)):
-    logger.info(f"Petición de borrado del libro con referencia: {ref_number}")
-    existing_book = db.query(Book_DB).filter(Book_DB.ref_number==ref_number).first()
+async def delete_book(ref_number: int, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición de borrado del libro con referencia: %s", ref_number)
+    existing_book = await db.scalar(select(Book_DB).where(Book_DB.ref_number==ref_number))
     if existing_book:
-        db.delete(existing_book)
-        db.commit()
+        name = existing_book.name
+        await db.delete(existing_book)
+        await commit_and_invalidate(db, [("book", name)])
     else:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail= "No se ha encontrado el registro correspondiente al libro que hay que borrar")
     
     
 @app.delete("/Peliculas/{ref_number}/", status_code=status.HTTP_204_NO_CONTENT)
-def delete_film(ref_number: int, db: Session = Depends(get_db)):
-    logger.info(f"Petición de borrado del libro con referencia: {ref_number}")
-    existing_film = db.query(Film_DB).filter(Film_DB.ref_number==ref_number).first()
+async def delete_film(ref_number: int, db: AsyncSession = Depends(get_db)):
+    request_logger.info("Petición de borrado del libro con referencia: %s", ref_number)
+    existing_film = await db.scalar(select(Film_DB).where(Film_DB.ref_number==ref_number))
     if existing_film:
-        db.delete(existing_film)
-        db.commit()
+        name = existing_film.name
+        await db.delete(existing_film)
+        await commit_and_invalidate(db, [("film", name)])
     else:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail= "No se ha encontrado el registro correspondiente a la pelicula que hay que borrar")
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail= "No se ha encontrado el registro correspondiente a la pelicula que hay que borrar")
+
+
+# Estado del servicio de cifrado: coste calibrado, cola y tiempos medios de espera frente a tiempos de cifrado
+@app.get("/Estadisticas/cifrado", status_code=status.HTTP_200_OK, response_model=Dict[str, Any])
+async def get_hashing_stats():
+    return hashing_service.stats()
+
+
+# Estado del pool de conexiones: conexiones en uso, overflow y tiempos de espera por una conexión
+@app.get("/Estadisticas/pool", status_code=status.HTTP_200_OK, response_model=Dict[str, Any])
+async def get_pool_stats():
+    return get_pool_status()
+
+
+# Estado de las cachés: tamaño, aciertos, fallos y si está escuchando los avisos del resto de workers
+@app.get("/Estadisticas/cache", status_code=status.HTTP_200_OK, response_model=Dict[str, Any])
+async def get_cache_stats():
+    return {"genres": genre_cache.stats(), "responses": response_cache.stats()}
+
+
+# Tiempos del arranque de este worker: comprobación del esquema, calibración del cifrado, conexiones del pool y cachés
+@app.get("/Estadisticas/arranque", status_code=status.HTTP_200_OK, response_model=Dict[str, Any])
+async def get_startup_stats():
+    return startup_stats
+
+
+# Consultas que han pasado de SLOW_QUERY_MS en este worker agrupadas por su texto normalizado, de la que más tiempo suma a la que
+# menos (u ordenadas por veces o por la más lenta), con los endpoints que las lanzan, sus últimos parámetros sin datos personales
+# y los últimos planes de EXPLAIN
+@app.get("/Estadisticas/consultas_lentas", status_code=status.HTTP_200_OK, response_model=Dict[str, Any])
+async def get_slow_queries(limit: int = Query(default=20, ge=1, le=200), order: Literal["total_ms", "count", "max_ms"] = "total_ms"):
+    return slow_query_log.summary(limit, order)
+
+
+# Últimas trazas que ha guardado este worker (TRACE_EXPORTERS con memory), de la más reciente a la más antigua
+@app.get("/Estadisticas/trazas", status_code=status.HTTP_200_OK, response_model=List[Dict[str, Any]])
+async def get_recent_traces(limit: int = Query(default=50, ge=1, le=500)):
+    return memory_collector.recent(limit)
+
+
+# Todos los spans de una traza ordenados por inicio. El id es el del traceparent que devuelve cada respuesta
+@app.get("/Estadisticas/trazas/{trace_id}", status_code=status.HTTP_200_OK, response_model=List[Dict[str, Any]])
+async def get_trace(trace_id: str):
+    spans = memory_collector.get(trace_id)
+    if not spans:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No hay ninguna traza con ese id en este worker")
+    return spans
+
+
+# Métricas en formato de texto de Prometheus: latencia por ruta, peticiones en curso, sentencias y tiempo de BDD por petición,
+# duración de cada sentencia, esperas del pool y tiempos de bcrypt. Con gunicorn suma las de todos los workers
+@app.get(METRICS_PATH, include_in_schema=False)
+async def get_metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE_LATEST)
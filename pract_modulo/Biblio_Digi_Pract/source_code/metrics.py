@@ -0,0 +1,139 @@
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from prometheus_client.mmap_dict import MmapedDict
+from sqlalchemy import event
+from contextvars import ContextVar
+import time
+import os
+
+# Con varios workers (gunicorn) cada proceso escribe sus métricas en ficheros de este directorio y /metrics las suma todas, da igual
+# qué worker conteste. Sin la variable (un solo proceso de uvicorn) las métricas se guardan en memoria
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+METRICS_PATH = "/metrics"
+
+# Segundos, pensados para consultas que van de décimas de milisegundo a algún segundo
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+HASH_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.75, 1.0, 2.0, 5.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+requests_total = Counter("http_requests_total", "Peticiones atendidas", ["method", "route", "status"])
+request_duration = Histogram("http_request_duration_seconds", "Latencia de las peticiones", ["method", "route"])
+requests_in_flight = Gauge("http_requests_in_flight", "Peticiones en curso", multiprocess_mode="livesum")
+request_statements = Histogram("db_statements_per_request", "Sentencias SQL por petición", ["route"], buckets=STATEMENT_BUCKETS)
+request_db_time = Histogram("db_time_per_request_seconds", "Tiempo en la BDD por petición", ["route"], buckets=QUERY_BUCKETS)
+query_duration = Histogram("db_query_duration_seconds", "Duración de cada sentencia SQL", ["route", "operation"], buckets=QUERY_BUCKETS)
+pool_wait = Histogram("db_pool_wait_seconds", "Espera por una conexión libre del pool", buckets=WAIT_BUCKETS)
+limiter_wait = Histogram("db_limiter_wait_seconds", "Espera por un hueco del limitador de sesiones", buckets=WAIT_BUCKETS)
+hash_duration = Histogram("bcrypt_hash_seconds", "Tiempo de cifrado de bcrypt dentro del pool de procesos", buckets=HASH_BUCKETS)
+hash_queue_wait = Histogram("bcrypt_queue_wait_seconds", "Espera en cola antes de cifrar", buckets=WAIT_BUCKETS)
+hash_rejected = Counter("bcrypt_rejected_total", "Cifrados rechazados con la cola llena")
+
+NO_ROUTE = "ninguna"  # sentencias fuera de una petición (arranque, cachés) o peticiones que no casan con ninguna ruta
+
+
+# Sentencias y tiempo en la BDD de la petición en curso. Lo crea el middleware y lo van sumando los eventos del engine, que se
+# ejecutan en el mismo contexto que la petición (también en modo síncrono, porque el threadpool copia el contexto)
+class Request_DB_Stats:
+    __slots__ = ("scope", "statements", "db_time")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.statements = 0
+        self.db_time = 0.0
+
+
+request_db_stats = ContextVar("request_db_stats", default=None)
+
+
+# Plantilla de la ruta (/Libros/{name}) y no la ruta real, para no tener una serie por cada libro
+def route_template(scope):
+    route = scope.get("route")
+    return route.path if route is not None else NO_ROUTE
+
+
+def statement_operation(statement: str):
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "OTRA"
+
+
+# Mide cada sentencia del engine que usan los endpoints
+def instrument_engine(sync_engine):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_start
+        stats = request_db_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += elapsed
+        query_duration.labels(route_template(stats.scope) if stats else NO_ROUTE, statement_operation(statement)).observe(elapsed)
+
+
+# Middleware ASGI que mide cada petición: latencia por ruta, peticiones en curso y sentencias y tiempo de BDD por petición
+class Metrics_Middleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == METRICS_PATH:
+            return await self.app(scope, receive, send)
+        status_code = 500  # si la petición lanza una excepción se contesta con un 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = Request_DB_Stats(scope)
+        token = request_db_stats.set(stats)
+        requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            requests_in_flight.dec()
+            request_db_stats.reset(token)
+            route = route_template(scope)
+            method = scope["method"]
+            request_duration.labels(method, route).observe(elapsed)
+            requests_total.labels(method, route, str(status_code)).inc()
+            request_statements.labels(route).observe(stats.statements)
+            request_db_time.labels(route).observe(stats.db_time)
+
+
+# Texto en formato Prometheus con las métricas de este proceso o, con PROMETHEUS_MULTIPROC_DIR, de todos los workers
+def render_metrics():
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+# Cada proceso escribe sus contadores e histogramas en sus propios ficheros (counter_<pid>.db, histogram_<pid>.db), que hay que
+# conservar al terminar el proceso para que los totales no bajen. Con el reciclado de workers (max_requests) el directorio crecería
+# sin límite y cada lectura de /metrics sería más lenta, así que los valores del proceso que termina se suman a un fichero
+# counter_archive.db / histogram_archive.db (MultiProcessCollector suma todos los ficheros de cada tipo) y se borran los suyos.
+# Lo llama el maestro de gunicorn en child_exit
+def archive_process_metrics(pid: int, path: str = PROMETHEUS_MULTIPROC_DIR):
+    for kind in ("counter", "histogram"):
+        dead = os.path.join(path, f"{kind}_{pid}.db")
+        if not os.path.exists(dead):
+            continue
+        archive = MmapedDict(os.path.join(path, f"{kind}_archive.db"))
+        try:
+            for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(dead):
+                total, last = archive.read_value(key)
+                archive.write_value(key, total + value, max(last, timestamp))
+        finally:
+            archive.close()
+        os.remove(dead)
+    multiprocess.mark_process_dead(pid, path)
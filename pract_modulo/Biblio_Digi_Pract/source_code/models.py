@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table
-from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table, Index, CheckConstraint, Computed
+from sqlalchemy.sql import func, text
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from .database import * 
 from abc import ABC, abstractmethod
 
@@ -9,6 +10,8 @@ from abc import ABC, abstractmethod
 class UserDB(Base):
     
     __tablename__ = "users"
+    # Para el listado ordenado por nombre, el user_id desempata los usuarios que se llaman igual
+    __table_args__ = (Index("ix_users_full_name_user_id", "full_name", "user_id"),)
     
     user_id = Column(Integer, primary_key=True, index=True)
     full_name = Column(String, index=True, nullable=False)
@@ -30,9 +33,10 @@ class UserDB(Base):
 # La idea es que tanto las peliculas como los libros tengan atributos en comun y aplicando herencia posteriormente cada uno tenga sus particularidades
 class Library_Item:
     
-    def __init__(self, name: str):
+    def __init__(self, name: str, copies: int = 1):
         self._name = name
-        self._available = True
+        self.total_copies = copies
+        self.available_copies = copies
         # self.genre_id = genre
     
     @property
@@ -43,11 +47,12 @@ class Library_Item:
     def status(self):
         return self.available # si esta disponible o no en nuestra web para alquilar este item
     
+    # available ya no se cambia a mano, la BDD lo calcula a partir de los ejemplares libres
     def item_took(self):
-        self.available = False
+        self.available_copies -= 1
     
     def item_returned(self):
-        self.available = True
+        self.available_copies += 1
         
     @abstractmethod
     def get_item_type(self):
@@ -61,14 +66,26 @@ class Library_Item:
 class Film_DB(Base, Library_Item):
     
     __tablename__ = "films"
+    # Para el listado filtrado por género paginando por ref_number, el mismo índice solo con las películas que tienen algún
+    # ejemplar libre (filtro available=true) y el índice GIN de la búsqueda de texto
+    __table_args__ = (CheckConstraint("available_copies >= 0 AND available_copies <= total_copies", name="ck_films_copies"),
+                      Index("ix_films_genre_id_ref_number", "genre_id", "ref_number"),
+                      Index("ix_films_free_genre_id_ref_number", "genre_id", "ref_number", postgresql_where=text("available_copies > 0")),
+                      Index("ix_films_search_vector", "search_vector", postgresql_using="gin"))
     
     ref_number = Column(Integer, primary_key=True, index=True)
     # It is typically not desirable to have “autoincrement” enabled on a column that refers to another via foreign key, as such a column is required to refer to a value that originates from elsewhere.
     name = Column(String, unique=True, index=True)
     actors = Column(String, nullable=True) # Aquí hemos quitado el indice (index=True) porque la lista de actores se pasara como un string donde vendran separados por comas
-    available = Column(Boolean, default=True, nullable=False) # Inicialmente lo declaramos a true porque si lo hemos añadido a la BDD es porque lo tenemos
-    date_registered = Column(DateTime(timezone=True), server_default=func.now())
+    # El string se mantiene tal cual lo manda el usuario (y alimenta la búsqueda de texto), pero las consultas de reparto van por las tablas actors y film_actor
+    # Ejemplares que tiene la biblioteca y cuántos quedan sin prestar. Los préstamos y devoluciones los restan y suman en la propia
+    # sentencia (ver loans.py) y available lo calcula la BDD, así que no se puede desincronizar de los contadores
+    total_copies = Column(Integer, nullable=False, server_default="1")
+    available_copies = Column(Integer, nullable=False, server_default="1")
+    available = Column(Boolean, Computed("available_copies > 0", persisted=True))
+    date_registered = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     genre_id = Column(Integer, ForeignKey("genero.genre_id"), nullable=False)
+    search_vector = deferred(Column(TSVECTOR, nullable=True)) # Nombre y reparto para la búsqueda, lo calcula un trigger (ver migrations/versions/0001)
     
     genres = relationship("Genre_DB", back_populates="films")
     loans = relationship("Loan_DB", back_populates="film_loaned")
@@ -86,29 +103,53 @@ class Film_DB(Base, Library_Item):
         return self.ref_number
     
     def actors_listing(self):
-        actors_list = self.actors.split(",")
-        l = dict()
-        if actors_list:
-            elem_added = 0
-            l["Info"] = "Film casting"
-            for a in actors_list:
-                l[f"A{elem_added}"] = a.strip()
-                elem_added +=1
-        return l   
+        return casting_listing(split_actors(self.actors))
+
+
+# Separa el string de actores de una película en nombres, sin huecos vacíos ni repetidos y respetando el orden del casting
+def split_actors(actors: str):
+    names = []
+    for a in (actors or "").split(","):
+        a = a.strip()
+        if a and a not in names:
+            names.append(a)
+    return names
+
+
+def casting_listing(actors_list: list):
+    l = dict()
+    if actors_list:
+        elem_added = 0
+        l["Info"] = "Film casting"
+        for a in actors_list:
+            l[f"A{elem_added}"] = a
+            elem_added +=1
+    return l
         
 
 
 class Book_DB(Base, Library_Item):
     
     __tablename__ = "books"
+    # Para el listado filtrado por género paginando por ref_number, el mismo índice solo con los libros que tienen algún
+    # ejemplar libre (filtro available=true) y el índice GIN de la búsqueda de texto
+    __table_args__ = (CheckConstraint("available_copies >= 0 AND available_copies <= total_copies", name="ck_books_copies"),
+                      Index("ix_books_genre_id_ref_number", "genre_id", "ref_number"),
+                      Index("ix_books_free_genre_id_ref_number", "genre_id", "ref_number", postgresql_where=text("available_copies > 0")),
+                      Index("ix_books_search_vector", "search_vector", postgresql_using="gin"))
     
     ref_number = Column(Integer, primary_key=True, index=True)
     # It is typically not desirable to have “autoincrement” enabled on a column that refers to another via foreign key, as such a column is required to refer to a value that originates from elsewhere.
     name = Column(String, unique=True, index=True)
     author = Column(String, index=True)
-    available = Column(Boolean, default=True, nullable=False) # Inicialmente lo declaramos a true porque si lo hemos añadido a la BDD es porque lo tenemos
-    date_registered = Column(DateTime(timezone=True), server_default=func.now())
+    # Ejemplares que tiene la biblioteca y cuántos quedan sin prestar. Los préstamos y devoluciones los restan y suman en la propia
+    # sentencia (ver loans.py) y available lo calcula la BDD, así que no se puede desincronizar de los contadores
+    total_copies = Column(Integer, nullable=False, server_default="1")
+    available_copies = Column(Integer, nullable=False, server_default="1")
+    available = Column(Boolean, Computed("available_copies > 0", persisted=True))
+    date_registered = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     genre_id = Column(Integer, ForeignKey("genero.genre_id"), nullable=False)
+    search_vector = deferred(Column(TSVECTOR, nullable=True)) # Nombre y autor para la búsqueda, lo calcula un trigger (ver migrations/versions/0001)
     
     genres = relationship("Genre_DB", back_populates="books")
     loans = relationship("Loan_DB", back_populates="book_loaned")
@@ -145,17 +186,24 @@ class Genre_DB(Base):
 class Loan_DB(Base):
     
     __tablename__ = "prestamo"
+    # Para el listado de los préstamos de un usuario paginando por loan_id, y el índice parcial de los préstamos abiertos (sin
+    # devolver) de cada usuario, que es lo que buscan las devoluciones y se queda pequeño aunque el histórico de préstamos crezca
+    __table_args__ = (Index("ix_prestamo_user_id_loan_id", "user_id", "loan_id"),
+                      Index("ix_prestamo_open_user_id", "user_id", postgresql_where=text("return_date IS NULL")))
     
     loan_id = Column(Integer, primary_key=True, index=True)
-    loan_date = Column(DateTime(timezone=True), server_default=func.now())
+    loan_date = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     user_id = Column(Integer, ForeignKey("users.user_id"), nullable=False) # Un préstamo siempre tiene un usuario
+    # Lo que se presta está en loan_items. Estas dos columnas se mantienen por compatibilidad con los préstamos de un libro y/o
+    # una película: guardan el primer libro y la primera película del préstamo
     book_ref_number = Column(Integer, ForeignKey("books.ref_number"), nullable=True)
     film_ref_number = Column(Integer, ForeignKey("films.ref_number"), nullable=True)
-    return_date = Column(DateTime(timezone=True), nullable=True)
+    return_date = Column(DateTime(timezone=True), nullable=True) # Se rellena cuando se han devuelto todos los artículos
     
     user_resp = relationship("UserDB", back_populates="loans")
     book_loaned = relationship("Book_DB", back_populates="loans")
     film_loaned = relationship("Film_DB", back_populates="loans")
+    items = relationship("Loan_Item_DB", back_populates="loan", passive_deletes=True)
     
     # def __init__(self, user_id: int, book_ref_number: int, film_ref_number: int):
     #     self.user_id=user_id
@@ -164,18 +212,81 @@ class Loan_DB(Base):
     
 
 
-# Estas tablas para las relaciones N:M de mi diagrama. Tablas de asociación Many to Many
+# Cada uno de los artículos (un libro o una película) de un préstamo, que se pueden devolver por separado. Los índices parciales
+# de los artículos sin devolver son los que usan las devoluciones. Si se borra un libro o una película el histórico de préstamos
+# se mantiene pero sin la referencia al artículo borrado (ON DELETE SET NULL), como pasaba con las columnas de prestamo
+class Loan_Item_DB(Base):
+    
+    __tablename__ = "loan_items"
+    __table_args__ = (CheckConstraint("num_nonnulls(book_ref_number, film_ref_number) <= 1", name="ck_loan_items_one_item"),
+                      Index("ix_loan_items_open_book_ref_number", "book_ref_number", postgresql_where=text("return_date IS NULL")),
+                      Index("ix_loan_items_open_film_ref_number", "film_ref_number", postgresql_where=text("return_date IS NULL")))
+    
+    loan_item_id = Column(Integer, primary_key=True)
+    loan_id = Column(Integer, ForeignKey("prestamo.loan_id", ondelete="CASCADE"), nullable=False, index=True)
+    book_ref_number = Column(Integer, ForeignKey("books.ref_number", ondelete="SET NULL"), nullable=True)
+    film_ref_number = Column(Integer, ForeignKey("films.ref_number", ondelete="SET NULL"), nullable=True)
+    copy_id = Column(Integer, ForeignKey("copies.copy_id", ondelete="SET NULL"), nullable=True) # Ejemplar concreto que se ha prestado
+    return_date = Column(DateTime(timezone=True), nullable=True)
     
-# film_genre_association_table = Table(
-#         "film_genre_association", Base.metadata,
-#         Column("film_ref_number", Integer, ForeignKey("films.ref_number"), primary_key=True),
-#         Column("genre_id", Integer, ForeignKey("genero.genre_id"), primary_key=True)
-#     )
+    loan = relationship("Loan_DB", back_populates="items")
+
+
+# Ejemplares físicos de los libros y películas, cada uno con su código de barras. Si no se indica el código lo genera un trigger a
+# partir de copy_id (EJ00000001...) y al dar de alta un título se crean sus total_copies ejemplares (ver migrations/versions/0001).
+# Los índices parciales de ejemplares libres son los que usa el préstamo para escoger el ejemplar que se lleva el usuario
+class Copy_DB(Base):
+    
+    __tablename__ = "copies"
+    __table_args__ = (CheckConstraint("num_nonnulls(book_ref_number, film_ref_number) = 1", name="ck_copies_one_title"),
+                      Index("ix_copies_book_ref_number_copy_id", "book_ref_number", "copy_id"),
+                      Index("ix_copies_film_ref_number_copy_id", "film_ref_number", "copy_id"),
+                      Index("ix_copies_free_book_ref_number", "book_ref_number", "copy_id", postgresql_where=text("NOT on_loan")),
+                      Index("ix_copies_free_film_ref_number", "film_ref_number", "copy_id", postgresql_where=text("NOT on_loan")))
+    
+    copy_id = Column(Integer, primary_key=True)
+    barcode = Column(String, unique=True, nullable=False)
+    book_ref_number = Column(Integer, ForeignKey("books.ref_number", ondelete="CASCADE"), nullable=True)
+    film_ref_number = Column(Integer, ForeignKey("films.ref_number", ondelete="CASCADE"), nullable=True)
+    on_loan = Column(Boolean, nullable=False, server_default="false")
+    date_added = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class Actor_DB(Base):
     
+    __tablename__ = "actors"
     
-# book_genre_association_table = Table(
-#         "book_genre_association", Base.metadata,
-#         Column("book_ref_number", Integer, ForeignKey("books.ref_number"), primary_key=True),
-#         Column("genre_id", Integer, ForeignKey("genero.genre_id"), primary_key=True)
-#     )
-    
\ No newline at end of file
+    actor_id = Column(Integer, primary_key=True, index=True)
+    full_name = Column(String, unique=True, index=True, nullable=False)
+
+
+# Reparto de cada película (N:M entre películas y actores). La clave primaria (película, actor) sirve para los actores de una
+# película y el índice (actor, película) para las películas de un actor. position guarda el orden en el que venían en el casting.
+# Al borrar una película la BDD borra su reparto (ON DELETE CASCADE), así que no hace falta cargarlo desde el ORM
+film_actor_association_table = Table(
+        "film_actor", Base.metadata,
+        Column("film_ref_number", Integer, ForeignKey("films.ref_number", ondelete="CASCADE"), primary_key=True),
+        Column("actor_id", Integer, ForeignKey("actors.actor_id", ondelete="CASCADE"), primary_key=True),
+        Column("position", Integer, nullable=False, server_default="0"),
+        Index("ix_film_actor_actor_id_film_ref_number", "actor_id", "film_ref_number"),
+    )
+
+
+# Estas tablas para las relaciones N:M de mi diagrama. Tablas de asociación Many to Many
+# genre_id de cada título es su género principal y un trigger lo copia también aquí (ver migrations/versions/0002), los demás
+# géneros solo están en estas tablas. Al borrar el título o el género la BDD borra la asociación (ON DELETE CASCADE)
+
+film_genre_association_table = Table(
+        "film_genre_association", Base.metadata,
+        Column("film_ref_number", Integer, ForeignKey("films.ref_number", ondelete="CASCADE"), primary_key=True),
+        Column("genre_id", Integer, ForeignKey("genero.genre_id", ondelete="CASCADE"), primary_key=True),
+        Index("ix_film_genre_association_genre_id_film_ref_number", "genre_id", "film_ref_number"),
+    )
+    
+    
+book_genre_association_table = Table(
+        "book_genre_association", Base.metadata,
+        Column("book_ref_number", Integer, ForeignKey("books.ref_number", ondelete="CASCADE"), primary_key=True),
+        Column("genre_id", Integer, ForeignKey("genero.genre_id", ondelete="CASCADE"), primary_key=True),
+        Index("ix_book_genre_association_genre_id_book_ref_number", "genre_id", "book_ref_number"),
+    )
@@ -0,0 +1,66 @@
+from fastapi import HTTPException, status
+from sqlalchemy import tuple_, exc
+import base64
+import json
+import os
+
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 200))  # tamaño máximo de página que se puede pedir en los listados
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', 50))
+
+
+# Paginación por cursor (keyset): en lugar de OFFSET, que obliga a la BDD a recorrer todas las filas anteriores, cada página
+# continúa a partir de la clave de ordenación del último elemento de la anterior: WHERE (columnas) > (últimos valores).
+# Con un índice sobre esas columnas cada página cuesta lo mismo esté al principio o al final de la tabla.
+# El cursor que se devuelve al cliente son esos últimos valores codificados en base64, el cliente no tiene que interpretarlo
+
+def encode_cursor(values: list):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def invalid_cursor():
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="El cursor indicado no es válido")
+
+
+# Cada valor del cursor tiene que ser del tipo de su columna (un cursor manipulado podría traer listas, objetos...) y solo puede
+# ser null si la columna lo admite. bool se descarta aparte porque en Python es un int
+def valid_cursor_value(value, column):
+    if value is None:
+        return column.nullable
+    return isinstance(value, column.type.python_type) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor: str, sort_columns: list):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        values = None
+    if (not isinstance(values, list) or len(values) != len(sort_columns)
+            or not all(valid_cursor_value(value, column) for value, column in zip(values, sort_columns))):
+        raise invalid_cursor()
+    return values
+
+
+# stmt es la consulta ya filtrada y sort_columns las columnas (indexadas) por las que se ordena, la última debe ser única.
+# Con scalars=True se devuelven objetos del ORM y si no filas con las columnas seleccionadas
+async def keyset_page(db, stmt, sort_columns: list, cursor: str = None, limit: int = DEFAULT_PAGE_SIZE, descending: bool = False, scalars: bool = True):
+    key = tuple_(*sort_columns) if len(sort_columns) > 1 else sort_columns[0]
+    if cursor:
+        values = decode_cursor(cursor, sort_columns)
+        last = tuple_(*values) if len(values) > 1 else values[0]
+        stmt = stmt.where(key < last if descending else key > last)
+    stmt = stmt.order_by(*[c.desc() if descending else c for c in sort_columns]).limit(limit + 1)
+    try:
+        result = await db.execute(stmt)
+    except exc.StatementError:
+        # Con el tipo correcto la BDD aún puede rechazar el valor (un entero fuera de rango...), y eso también es culpa del cursor
+        if not cursor:
+            raise
+        await db.rollback()
+        raise invalid_cursor()
+    items = result.scalars().all() if scalars else [dict(row) for row in result.mappings().all()]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last_item = items[-1]
+        next_cursor = encode_cursor([getattr(last_item, c.key) if scalars else last_item[c.key] for c in sort_columns])
+    return {"items": items, "next_cursor": next_cursor}
@@ -0,0 +1,27 @@
+# Código que se ejecuta dentro de los procesos del pool de cifrado (ver hashing.py). Va en un módulo aparte que solo importa bcrypt:
+# los procesos hijos importan el módulo de las funciones que ejecutan, y si fuera hashing.py importarían también metrics.py y
+# cada uno dejaría sus ficheros de métricas en PROMETHEUS_MULTIPROC_DIR sin que nadie los borre al terminar
+import bcrypt
+import time
+import os
+
+
+# Se ejecuta al arrancar cada proceso del pool. Sin la variable, si algo importa prometheus_client en el proceso guarda las
+# métricas en memoria y no escribe ficheros en el directorio de los workers
+def init_hash_process():
+    os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+
+
+# Funcion para cifrar la contraseña del usuario. Se ejecuta dentro de los procesos del pool así que tiene que ser una función de módulo
+def hash_password(pwd: str, rounds: int = 12):
+    pwd_to_encode = pwd.encode("utf-8")
+    sal = bcrypt.gensalt(rounds=rounds)
+    encripted_pwd = bcrypt.hashpw(pwd_to_encode, sal)
+    return encripted_pwd.decode("utf-8")
+
+
+# Igual que hash_password pero devolviendo también lo que ha tardado dentro del proceso, para separar la espera en cola del tiempo de cifrado
+def timed_hash_password(pwd: str, rounds: int):
+    start = time.perf_counter()
+    hashed = hash_password(pwd, rounds)
+    return hashed, time.perf_counter() - start
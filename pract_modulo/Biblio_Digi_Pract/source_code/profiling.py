@@ -0,0 +1,173 @@
+from .metrics import request_db_stats, route_template
+from anyio import to_thread
+import tempfile
+import logging
+import random
+import hashlib
+import hmac
+import json
+import time
+import os
+import re
+
+# Perfilado bajo demanda de peticiones concretas con pyinstrument (un perfilador por muestreo que sigue a la petición a través de
+# sus await). Está apagado por defecto: se activa firmando la petición con PROFILE_SECRET o con una fracción de peticiones al azar
+PROFILE_SECRET = os.getenv('PROFILE_SECRET')  # clave para firmar la cabecera X-Profile-Token, sin ella no se acepta ninguna
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))  # fracción de peticiones que se perfilan sin pedirlo
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.001))  # segundos entre muestras
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), "biblioteca_profiles"))
+PROFILE_MAX_PER_ROUTE = int(os.getenv('PROFILE_MAX_PER_ROUTE', 20))  # perfiles que se guardan por ruta, se borran los más antiguos
+PROFILE_MAX_AGE_HOURS = float(os.getenv('PROFILE_MAX_AGE_HOURS', 24))
+
+TOKEN_HEADER = b"x-profile-token"
+PROFILE_HEADER = b"x-profile"
+
+# Funciones en las que se pasa la respuesta a JSON: el response_model de FastAPI, las clases de respuesta y la caché de respuestas
+SERIALIZATION_FUNCTIONS = {"serialize_response", "jsonable_encoder", "render", "serialize_body"}
+
+logger = logging.getLogger(__name__)
+
+
+# La firma vale para una ruta concreta y hasta una fecha (segundos desde epoch), así una cabecera filtrada no sirve para otra
+# ruta ni para siempre. La cabecera es "<expira>.<firma>"
+def sign_profile_token(path: str, expires: int, secret: str = PROFILE_SECRET):
+    signature = hmac.new(secret.encode("utf-8"), f"{expires}:{path}".encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"{expires}.{signature}"
+
+
+def valid_profile_token(token: str, path: str):
+    if not PROFILE_SECRET:
+        return False
+    expires, _, signature = token.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(sign_profile_token(path, int(expires)), f"{expires}.{signature}")
+
+
+# Desglose del tiempo de la petición a partir del árbol de muestras: lo que se ha pasado esperando en un await (BDD en modo
+# asíncrono, hilos en modo síncrono, bcrypt...), pasando la respuesta a JSON y el resto ejecutando Python
+def time_breakdown(root):
+    if root is None:
+        return {"python_ms": 0.0, "await_ms": 0.0, "serialization_ms": 0.0}
+    serialization = 0.0
+    pending = [root]
+    while pending:
+        frame = pending.pop()
+        if frame.function in SERIALIZATION_FUNCTIONS:
+            serialization += frame.time - frame.await_time()
+        else:
+            pending.extend(frame.children)
+    waiting = root.await_time()
+    return {"python_ms": round((root.time - waiting - serialization) * 1000, 2), "await_ms": round(waiting * 1000, 2),
+            "serialization_ms": round(serialization * 1000, 2)}
+
+
+def route_directory(route: str):
+    return os.path.join(PROFILE_DIR, re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "raiz")
+
+
+# Se queda con los PROFILE_MAX_PER_ROUTE perfiles más recientes de la ruta que no superen PROFILE_MAX_AGE_HOURS
+def prune(directory: str):
+    profiles = sorted(name for name in os.listdir(directory) if name.endswith(".speedscope.json"))
+    oldest = time.time() - PROFILE_MAX_AGE_HOURS * 3600
+    keep = profiles[-PROFILE_MAX_PER_ROUTE:] if PROFILE_MAX_PER_ROUTE > 0 else []
+    for name in profiles:
+        path = os.path.join(directory, name)
+        if name not in keep or os.path.getmtime(path) < oldest:
+            for stale in (path, path.replace(".speedscope.json", ".resumen.json")):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+
+
+# Guarda el perfil en formato speedscope (se abre en https://www.speedscope.app o se convierte a flame graph) junto con un
+# resumen con el desglose de tiempos. Se ejecuta en un hilo para no ocupar el event loop con el renderizado y la escritura
+def save_profile(profiler, route: str, name: str, summary: dict):
+    from pyinstrument.renderers import SpeedscopeRenderer
+    directory = route_directory(route)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.speedscope.json")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(profiler.output(SpeedscopeRenderer()))
+    with open(path.replace(".speedscope.json", ".resumen.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    prune(directory)
+    return path
+
+
+# Middleware ASGI que perfila las peticiones firmadas y una fracción PROFILE_SAMPLE_RATE del resto. pyinstrument solo admite un
+# perfilador a la vez por hilo, así que si ya hay una petición perfilándose en este worker la siguiente se atiende sin perfilar.
+# Va dentro de Metrics_Middleware para poder leer el tiempo de BDD que suman los eventos del engine
+class Profiling_Middleware:
+
+    def __init__(self, app):
+        self.app = app
+        self.active = False
+        self.enabled = bool(PROFILE_SECRET) or PROFILE_SAMPLE_RATE > 0
+        if self.enabled:
+            try:
+                import pyinstrument
+            except ImportError:
+                logger.warning("pyinstrument no está instalado, no se perfilará ninguna petición")
+                self.enabled = False
+
+    def wanted(self, scope):
+        if PROFILE_SECRET:
+            for name, value in scope["headers"]:
+                if name == TOKEN_HEADER:
+                    return valid_profile_token(value.decode("latin-1"), scope["path"])
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http" or self.active or not self.wanted(scope):
+            return await self.app(scope, receive, send)
+        from pyinstrument import Profiler
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}_{os.getpid()}_{random.getrandbits(32):08x}"
+        status_code = 500
+
+        async def send_with_profile(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []), (PROFILE_HEADER, name.encode("latin-1"))]
+            await send(message)
+
+        db_stats = request_db_stats.get()
+        db_time, statements = (db_stats.db_time, db_stats.statements) if db_stats else (0.0, 0)
+        self.active = True
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+        start = time.perf_counter()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            profiler.stop()
+            self.active = False
+            elapsed = time.perf_counter() - start
+            # La respuesta ya se ha enviado: si falla el resumen o el guardado del perfil solo se avisa en el log, sin que la
+            # petición termine con una excepción
+            try:
+                route = route_template(scope)
+                summary = {"method": scope["method"], "path": scope["path"], "route": route, "status": status_code,
+                           "total_ms": round(elapsed * 1000, 2),
+                           "db_ms": round(((db_stats.db_time - db_time) if db_stats else 0.0) * 1000, 2),
+                           "db_statements": (db_stats.statements - statements) if db_stats else 0,
+                           **time_breakdown(profiler.last_session.root_frame() if profiler.last_session else None)}
+                path = await to_thread.run_sync(save_profile, profiler, route, name, summary)
+                logger.info("Perfil de %s %s guardado en %s", scope["method"], scope["path"], path, extra={"profile": summary})
+            except Exception as e:
+                logger.warning("No se ha podido guardar el perfil de %s: %r", scope["path"], e)
+
+
+# Cabecera firmada para perfilar una petición, por ejemplo:
+#   PROFILE_SECRET=... python -m source_code.profiling /Realizar_un_prestamo/ --ttl 300
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Genera la cabecera X-Profile-Token para perfilar una petición")
+    parser.add_argument("path", help="ruta exacta de la petición, sin parámetros de consulta")
+    parser.add_argument("--ttl", type=int, default=300, help="segundos de validez de la firma")
+    args = parser.parse_args()
+    if not PROFILE_SECRET:
+        raise SystemExit("Falta la variable de entorno PROFILE_SECRET")
+    print(f"X-Profile-Token: {sign_profile_token(args.path, int(time.time()) + args.ttl)}")
@@ -0,0 +1,45 @@
+from .database import *
+from sqlalchemy import text
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Configuración de búsqueda de texto: la de español de PostgreSQL más unaccent, para que "garcia" encuentre "García"
+SEARCH_CONFIG = "biblioteca_es"
+
+# Extensiones que usa la búsqueda. Si el servidor no las tiene (no vienen con todas las instalaciones de PostgreSQL) la API
+# funciona igual pero la búsqueda distingue acentos (sin unaccent) o no da sugerencias (sin pg_trgm)
+search_features = {"unaccent": False, "pg_trgm": False}
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+
+
+class Schema_Outdated(RuntimeError):
+    pass
+
+
+# El esquema lo crean y actualizan las migraciones de Alembic (carpeta migrations), que se aplican antes de arrancar la API con
+# "alembic upgrade head". Al arrancar solo se comprueba que la BDD está en la última versión, para fallar enseguida con un
+# mensaje claro en lugar de con errores de columnas que no existen en mitad de las peticiones
+def schema_head():
+    return ScriptDirectory.from_config(Config(ALEMBIC_INI)).get_current_head()
+
+
+async def check_schema():
+    head = schema_head()
+    async with session_scope() as db:
+        current = None
+        if await db.scalar(text("SELECT to_regclass('alembic_version') IS NOT NULL")):
+            current = await db.scalar(text("SELECT version_num FROM alembic_version"))
+        installed = set((await db.execute(text("SELECT extname FROM pg_extension WHERE extname IN ('unaccent', 'pg_trgm')"))).scalars())
+    if current != head:
+        raise Schema_Outdated(f"La BDD está en la versión {current} del esquema y la API necesita la {head}, "
+                              f"ejecute alembic upgrade head antes de arrancar")
+    for name in search_features:
+        search_features[name] = name in installed
+        if name not in installed:
+            logger.warning("La extensión %s no está instalada en la BDD, la búsqueda funcionará sin ella", name)
+    return current
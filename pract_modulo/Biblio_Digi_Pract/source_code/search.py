@@ -0,0 +1,68 @@
+from .models import *
+from .schema import SEARCH_CONFIG, search_features
+from fastapi import HTTPException, status
+from sqlalchemy import select, func, literal, null, union_all
+import re
+import os
+
+SEARCH_SUGGESTIONS = int(os.getenv('SEARCH_SUGGESTIONS', 5))  # sugerencias que se devuelven cuando una búsqueda no encuentra nada
+SEARCH_SUGGEST_THRESHOLD = float(os.getenv('SEARCH_SUGGEST_THRESHOLD', 0.4))  # parecido mínimo (0-1) de una sugerencia con lo buscado
+
+
+# Búsqueda de texto en el catálogo. Los libros (nombre y autor) y las películas (nombre y reparto) tienen una columna tsvector
+# que mantiene un trigger y un índice GIN, así que la búsqueda no recorre las tablas. Todas las palabras tienen que aparecer y
+# la última se busca como prefijo, para que "harry pot" ya encuentre "Harry Potter" mientras el usuario escribe
+
+def build_tsquery(q: str):
+    words = re.findall(r"\w+", q.lower())
+    if not words:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="La búsqueda debe contener al menos una palabra")
+    # Solo se usan caracteres de palabra, así que el texto del usuario no puede inyectar operadores de tsquery
+    return func.to_tsquery(SEARCH_CONFIG, " & ".join(words[:-1] + [f"{words[-1]}:*"]))
+
+
+# Una única consulta con UNION ALL de libros y películas ordenada por relevancia. ts_rank_cd tiene en cuenta los pesos (el
+# nombre cuenta más que el autor o el reparto) y la normalización 32 deja la relevancia entre 0 y 1
+async def search_catalog(db, q: str, kind: str = None, limit: int = 20):
+    query = build_tsquery(q)
+    selects = []
+    if kind in (None, "book"):
+        selects.append(select(literal("book").label("type"), Book_DB.ref_number, Book_DB.name, Book_DB.author.label("author"),
+                              null().label("actors"), Book_DB.genre_id, Book_DB.available,
+                              Book_DB.total_copies, Book_DB.available_copies,
+                              func.ts_rank_cd(Book_DB.search_vector, query, 32).label("rank"))
+                       .where(Book_DB.search_vector.op("@@")(query)))
+    if kind in (None, "film"):
+        selects.append(select(literal("film").label("type"), Film_DB.ref_number, Film_DB.name, null().label("author"),
+                              Film_DB.actors.label("actors"), Film_DB.genre_id, Film_DB.available,
+                              Film_DB.total_copies, Film_DB.available_copies,
+                              func.ts_rank_cd(Film_DB.search_vector, query, 32).label("rank"))
+                       .where(Film_DB.search_vector.op("@@")(query)))
+    found = union_all(*selects).subquery() if len(selects) > 1 else selects[0].subquery()
+    stmt = select(found).order_by(found.c.rank.desc(), found.c.name).limit(limit)
+    return [dict(row) for row in (await db.execute(stmt)).mappings().all()]
+
+
+# Sugerencias de "quizás quisiste decir" cuando no hay resultados: los nombres de libros y películas y los autores más parecidos
+# a lo buscado por trigramas, sin tener en cuenta mayúsculas ni acentos. Necesita la extensión pg_trgm
+async def suggest(db, q: str, kind: str = None, limit: int = SEARCH_SUGGESTIONS):
+    if not search_features["pg_trgm"]:
+        return []
+    term = func.f_unaccent(func.lower(q))
+    columns = []
+    if kind in (None, "book"):
+        columns += [Book_DB.name, Book_DB.author]
+    if kind in (None, "film"):
+        columns.append(Film_DB.name)
+    selects = []
+    for column in columns:
+        target = func.f_unaccent(func.lower(column))
+        score = func.word_similarity(term, target)
+        # El operador <% usa el índice de trigramas y filtra por pg_trgm.word_similarity_threshold
+        selects.append(select(column.label("suggestion"), score.label("score")).where(term.op("<%")(target))
+                       .order_by(score.desc()).limit(limit))
+    await db.execute(select(func.set_config("pg_trgm.word_similarity_threshold", str(SEARCH_SUGGEST_THRESHOLD), True)))
+    candidates = union_all(*[s.subquery().select() for s in selects]).subquery()
+    stmt = (select(candidates.c.suggestion).group_by(candidates.c.suggestion)
+            .order_by(func.max(candidates.c.score).desc(), candidates.c.suggestion).limit(limit))
+    return list((await db.execute(stmt)).scalars().all())
@@ -0,0 +1,210 @@
+from .metrics import request_db_stats, route_template, statement_operation
+from .tracing import current_span, normalize_statement
+from sqlalchemy import event
+from datetime import datetime, date, timezone
+from decimal import Decimal
+from uuid import UUID
+import contextvars
+import threading
+import asyncio
+import logging
+import time
+import os
+
+# Registro de consultas lentas: cada sentencia de los endpoints que pasa de SLOW_QUERY_MS se apunta agrupada por su texto
+# normalizado (la misma consulta con otros parámetros cuenta como la misma), con el endpoint que la ha lanzado y sus parámetros
+# sin datos personales. De una parte de ellas se saca además el plan con EXPLAIN (ANALYZE, BUFFERS). El resumen está en
+# /Estadisticas/consultas_lentas
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))  # umbral a partir del que una sentencia es lenta, 0 o menos lo apaga
+SLOW_QUERY_EXPLAINS_PER_MINUTE = int(os.getenv('SLOW_QUERY_EXPLAINS_PER_MINUTE', 6))  # EXPLAIN como mucho por minuto y worker
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.getenv('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 5000))  # statement_timeout del EXPLAIN
+SLOW_QUERY_MAX_STATEMENTS = int(os.getenv('SLOW_QUERY_MAX_STATEMENTS', 200))  # consultas distintas que se guardan
+SLOW_QUERY_PLANS = int(os.getenv('SLOW_QUERY_PLANS', 3))  # planes que se guardan de cada consulta, los más recientes
+
+logger = logging.getLogger(__name__)
+
+# Los números, fechas y booleanos se dejan (ids, límites, cursores...) porque ayudan a reproducir la consulta; los textos y
+# binarios (nombres, correos, contraseñas cifradas) se sustituyen por su tipo y longitud
+KEPT_TYPES = (bool, int, float, Decimal, UUID)
+
+
+def redact_value(value):
+    if value is None or isinstance(value, KEPT_TYPES):
+        return value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__} {len(value)}>"
+    if isinstance(value, (list, tuple)):
+        return [redact_value(v) for v in value]
+    return f"<{type(value).__name__}>"
+
+
+def redact_parameters(parameters):
+    if isinstance(parameters, dict):
+        return {key: redact_value(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact_value(value) for value in parameters]
+    return redact_value(parameters)
+
+
+# Solo se ejecutan con ANALYZE las lecturas: un INSERT/UPDATE/DELETE se volvería a aplicar (aunque se deshaga, gasta valores de
+# las secuencias y se pelea por los bloqueos con la transacción original), así que de las escrituras se guarda el plan estimado
+def explain_statement(statement: str):
+    words = statement.lstrip().split(None, 1)
+    analyze = bool(words) and words[0].upper() == "SELECT"
+    return ("EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN ") + statement, analyze
+
+
+class Slow_Query_Log:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.slow = 0
+        self.explained = 0
+        self.explain_errors = 0
+        self.explain_running = False
+        self.explain_window = 0.0
+        self.explains_in_window = 0
+        self.sync_engine = None
+        self.async_engine = None
+        self.tasks = set()
+
+    # Registra los eventos en el engine de los endpoints. El EXPLAIN se lanza con el mismo engine (async_engine en modo asíncrono)
+    # para que los parámetros tengan el formato de su driver
+    def listen(self, sync_engine, async_engine=None):
+        self.sync_engine = sync_engine
+        self.async_engine = async_engine
+
+        @event.listens_for(sync_engine, "before_cursor_execute")
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            context._slow_query_start = time.perf_counter()
+
+        @event.listens_for(sync_engine, "after_cursor_execute")
+        def after_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed_ms = (time.perf_counter() - context._slow_query_start) * 1000
+            if 0 < SLOW_QUERY_MS <= elapsed_ms and not conn.info.get("slow_query_explain"):
+                self.record(statement, parameters, executemany, elapsed_ms)
+
+    def record(self, statement: str, parameters, executemany: bool, elapsed_ms: float):
+        text = normalize_statement(statement)
+        stats = request_db_stats.get()
+        scope = stats.scope if stats is not None else None
+        endpoint = f"{scope['method']} {route_template(scope)}" if scope is not None else "ninguno"
+        handler = getattr(scope.get("endpoint"), "__name__", None) if scope is not None else None
+        span = current_span.get()
+        redacted = {"filas": len(parameters), "primera": redact_parameters(parameters[0])} if executemany and parameters else redact_parameters(parameters)
+        with self.lock:
+            self.slow += 1
+            query = self.queries.get(text)
+            if query is None:
+                if len(self.queries) >= SLOW_QUERY_MAX_STATEMENTS:
+                    del self.queries[min(self.queries, key=lambda k: self.queries[k]["total_ms"])]
+                query = self.queries[text] = {"statement": text, "operation": statement_operation(statement), "count": 0,
+                                              "total_ms": 0.0, "max_ms": 0.0, "endpoints": {}, "plans": []}
+            query["count"] += 1
+            query["total_ms"] += elapsed_ms
+            query["max_ms"] = max(query["max_ms"], elapsed_ms)
+            query["endpoints"][endpoint] = query["endpoints"].get(endpoint, 0) + 1
+            query["last_parameters"] = redacted
+            query["last_seen"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+            explain = not executemany and self.take_explain_slot()
+        logger.warning("Consulta lenta (%.1f ms) en %s: %s", elapsed_ms, endpoint, text,
+                       extra={"slow_query": {"ms": round(elapsed_ms, 3), "endpoint": endpoint, "handler": handler,
+                                             "parameters": redacted, "trace_id": span.trace_id if span is not None else None}})
+        if explain:
+            self.schedule_explain(text, statement, parameters)
+
+    # Un EXPLAIN a la vez y como mucho SLOW_QUERY_EXPLAINS_PER_MINUTE por minuto, así una racha de consultas lentas (justo cuando
+    # la BDD va cargada) no la carga todavía más. Se llama con el lock cogido
+    def take_explain_slot(self):
+        if SLOW_QUERY_EXPLAINS_PER_MINUTE <= 0 or self.explain_running:
+            return False
+        now = time.monotonic()
+        if now - self.explain_window >= 60:
+            self.explain_window = now
+            self.explains_in_window = 0
+        if self.explains_in_window >= SLOW_QUERY_EXPLAINS_PER_MINUTE:
+            return False
+        self.explains_in_window += 1
+        self.explain_running = True
+        return True
+
+    # El EXPLAIN va fuera de la petición y en otra conexión: en modo asíncrono como tarea del event loop y en modo síncrono en un
+    # hilo. Se ejecuta con un contexto vacío para que no cuente en las métricas ni en la traza de la petición que lo ha disparado
+    def schedule_explain(self, text: str, statement: str, parameters):
+        if self.async_engine is not None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.finish_explain(text, None, False, "sin event loop")
+                return
+            task = loop.create_task(self.explain_async(text, statement, parameters), context=contextvars.Context())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        else:
+            threading.Thread(target=self.explain_sync, args=(text, statement, parameters), name="slow-query-explain",
+                             daemon=True).start()
+
+    async def explain_async(self, text: str, statement: str, parameters):
+        explain, analyze = explain_statement(statement)
+        try:
+            async with self.async_engine.connect() as conn:
+                conn.sync_connection.info["slow_query_explain"] = True
+                try:
+                    await conn.exec_driver_sql(f"SET LOCAL statement_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}")
+                    await conn.exec_driver_sql(f"SET LOCAL lock_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}")
+                    result = await conn.exec_driver_sql(explain, parameters)
+                    plan = "\n".join(row[0] for row in result)
+                finally:
+                    conn.sync_connection.info.pop("slow_query_explain", None)
+                    await conn.rollback()
+            self.finish_explain(text, plan, analyze)
+        except Exception as e:
+            self.finish_explain(text, None, analyze, repr(e))
+
+    def explain_sync(self, text: str, statement: str, parameters):
+        explain, analyze = explain_statement(statement)
+        try:
+            with self.sync_engine.connect() as conn:
+                conn.info["slow_query_explain"] = True
+                try:
+                    conn.exec_driver_sql(f"SET LOCAL statement_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}")
+                    conn.exec_driver_sql(f"SET LOCAL lock_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}")
+                    plan = "\n".join(row[0] for row in conn.exec_driver_sql(explain, parameters))
+                finally:
+                    conn.info.pop("slow_query_explain", None)
+                    conn.rollback()
+            self.finish_explain(text, plan, analyze)
+        except Exception as e:
+            self.finish_explain(text, None, analyze, repr(e))
+
+    def finish_explain(self, text: str, plan, analyze: bool, error: str = None):
+        with self.lock:
+            self.explain_running = False
+            if error is not None:
+                self.explain_errors += 1
+            else:
+                self.explained += 1
+                query = self.queries.get(text)
+                if query is not None:
+                    query["plans"] = [*query["plans"], {"captured": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                                                         "analyze": analyze, "plan": plan}][-SLOW_QUERY_PLANS:]
+        if error is not None:
+            logger.warning("No se ha podido sacar el plan de la consulta lenta %s: %s", text, error)
+        else:
+            logger.info("Plan de la consulta lenta %s\n%s", text, plan)
+
+    # Las consultas que más tiempo suman (o más veces han ido lentas, o la más lenta) con sus últimos planes
+    def summary(self, limit: int = 20, order: str = "total_ms"):
+        with self.lock:
+            queries = sorted(self.queries.values(), key=lambda q: q[order], reverse=True)[:limit]
+            top = [{**query, "total_ms": round(query["total_ms"], 3), "max_ms": round(query["max_ms"], 3),
+                    "mean_ms": round(query["total_ms"] / query["count"], 3), "endpoints": dict(query["endpoints"]),
+                    "plans": list(query["plans"])} for query in queries]
+            return {"threshold_ms": SLOW_QUERY_MS, "slow": self.slow, "statements": len(self.queries),
+                    "explained": self.explained, "explain_errors": self.explain_errors, "top": top}
+
+
+slow_query_log = Slow_Query_Log()
@@ -0,0 +1,69 @@
+from .models import *
+from fastapi import HTTPException, status
+from sqlalchemy import select, update, delete, insert, exists, literal, null, true, func, exc, String
+from sqlalchemy.dialects.postgresql import ARRAY
+import os
+
+STOCK_MAX_COPIES = int(os.getenv('STOCK_MAX_COPIES', 1000))  # ejemplares que se pueden dar de alta como mucho en una petición
+
+
+# Stock de ejemplares. Cada libro o película tiene sus ejemplares en la tabla copies y dos contadores, total_copies y
+# available_copies, que se cambian siempre en la misma transacción que copies. Los préstamos y devoluciones los mantienen en
+# loans.py; aquí están las altas y bajas de ejemplares que hace la biblioteca
+
+def copies_column(model):
+    return Copy_DB.book_ref_number if model is Book_DB else Copy_DB.film_ref_number
+
+
+def cache_kind(model):
+    return "book" if model is Book_DB else "film"
+
+
+# Alta de ejemplares de un título en una sola sentencia: se suman a los contadores (lo que bloquea el título igual que un préstamo)
+# y se insertan los ejemplares, con los códigos de barras indicados o con los que genera la BDD. Devuelve el título con sus
+# contadores y los ejemplares nuevos, y las claves de caché que hay que invalidar al hacer commit
+async def add_copies(db, model, name: str, copies: int, barcodes: list = None):
+    bumped = (update(model).where(model.name==name)
+              .values(total_copies=model.total_copies + copies, available_copies=model.available_copies + copies)
+              .returning(model.ref_number, model.name, model.total_copies, model.available_copies).cte("bumped"))
+    if barcodes:
+        source = func.unnest(literal(barcodes, ARRAY(String))).table_valued("barcode").render_derived()
+        barcode = source.c.barcode
+    else:
+        source = func.generate_series(1, copies).table_valued("n").render_derived()
+        barcode = null()  # lo rellena el trigger copies_barcode
+    rows = select(bumped.c.ref_number, barcode).select_from(bumped.join(source, true()))
+    inserted = (insert(Copy_DB).from_select([copies_column(model).key, "barcode"], rows)
+                .returning(Copy_DB.copy_id, Copy_DB.barcode).cte("inserted"))
+    stmt = (select(bumped, inserted.c.copy_id, inserted.c.barcode).select_from(bumped.join(inserted, true()))
+            .order_by(inserted.c.copy_id))
+    try:
+        rows = (await db.execute(stmt)).mappings().all()
+    except exc.IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Alguno de los códigos de barras ya está registrado")
+    if not rows:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="El título no esta registrado en la BDD")
+    title = {key: rows[0][key] for key in ("ref_number", "name", "total_copies", "available_copies")}
+    title["copies"] = [{"copy_id": row["copy_id"], "barcode": row["barcode"]} for row in rows]
+    return title, [(cache_kind(model), title["name"])]
+
+
+# Baja de un ejemplar que no esté prestado. Primero se bloquea el título y luego el ejemplar, en el mismo orden que los préstamos,
+# porque al revés la baja podría quedarse esperando a un préstamo que a su vez espera por el ejemplar que se está borrando
+async def retire_copy(db, barcode: str):
+    copy = (await db.execute(select(Copy_DB.book_ref_number, Copy_DB.film_ref_number).where(Copy_DB.barcode==barcode))).first()
+    if copy is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No existe ningún ejemplar con ese código de barras")
+    model, ref_number = (Book_DB, copy.book_ref_number) if copy.book_ref_number is not None else (Film_DB, copy.film_ref_number)
+    name = await db.scalar(select(model.name).where(model.ref_number==ref_number).with_for_update())
+    removed = (delete(Copy_DB).where(Copy_DB.barcode==barcode, ~Copy_DB.on_loan)
+               .returning(Copy_DB.copy_id).cte("removed"))
+    title = model.__table__  # sobre la tabla: el ORM no devuelve filas de un UPDATE que usa un CTE
+    stmt = (update(title).where(title.c.ref_number==ref_number, exists(select(removed.c.copy_id)))
+            .values(total_copies=title.c.total_copies - 1, available_copies=title.c.available_copies - 1)
+            .returning(title.c.total_copies, title.c.available_copies))
+    if (await db.execute(stmt)).first() is None:
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="El ejemplar está prestado, no se puede dar de baja hasta que se devuelva")
+    return [(cache_kind(model), name)]
@@ -0,0 +1,292 @@
+from .metrics import route_template
+from .logs import request_id_var
+from logging.handlers import QueueListener, RotatingFileHandler
+from sqlalchemy import event
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from collections import OrderedDict
+from contextvars import ContextVar
+from functools import lru_cache, wraps
+import tempfile
+import logging
+import atexit
+import random
+import queue
+import json
+import time
+import os
+import re
+
+# Trazas locales con el formato de OpenTelemetry (trace_id, span_id, parent_span_id, tiempos en nanosegundos, atributos y estado)
+# sin depender de ningún servicio externo: cada petición es una traza con spans para el handler, la sesión de BDD, cada sentencia
+# SQL y el cifrado de contraseñas. Se exportan a memoria (las últimas trazas de cada worker, ver /Estadisticas/trazas) y/o a
+# ficheros NDJSON rotados, una línea por span
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 1.0))  # fracción de peticiones que se trazan si el cliente no lo indica
+TRACE_EXPORTERS = {e.strip() for e in os.getenv('TRACE_EXPORTERS', 'memory').split(",") if e.strip()}  # memory, file
+TRACE_MEMORY_TRACES = int(os.getenv('TRACE_MEMORY_TRACES', 200))  # trazas que guarda cada worker en memoria
+TRACE_DIR = os.getenv('TRACE_DIR', os.path.join(tempfile.gettempdir(), "biblioteca_traces"))
+TRACE_FILE_MAX_BYTES = int(os.getenv('TRACE_FILE_MAX_BYTES', 50 * 1024 * 1024))  # tamaño de cada fichero antes de rotar
+TRACE_FILE_BACKUPS = int(os.getenv('TRACE_FILE_BACKUPS', 5))  # ficheros rotados que se conservan por worker
+TRACE_MAX_STATEMENT = int(os.getenv('TRACE_MAX_STATEMENT', 2000))  # caracteres del texto SQL que se guardan en el span
+
+TRACEPARENT_HEADER = b"traceparent"
+TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+logger = logging.getLogger(__name__)
+
+# Span en curso. Solo hay span si la petición se está trazando, así fuera de las peticiones o en las que no se trazan crear un
+# span no cuesta nada
+current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_span_id", "name", "kind", "start_ns", "end_ns", "attributes", "status", "trace")
+
+    def __init__(self, name: str, trace_id: str, parent_span_id: str = None, kind: str = "INTERNAL", attributes: dict = None, trace=None):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.status = "UNSET"
+        self.trace = trace  # spans de la misma traza en este worker, se exportan todos juntos al terminar la petición
+
+    def child(self, name: str, kind: str = "INTERNAL", attributes: dict = None):
+        return Span(name, self.trace_id, self.span_id, kind, attributes, self.trace)
+
+    # Las HTTPException 4xx son respuestas normales de la API (no existe, ya está prestado...) y no marcan el span como fallido
+    def record_exception(self, e: BaseException):
+        if isinstance(e, HTTPException) and e.status_code < 500:
+            self.attributes["http.status_code"] = e.status_code
+            return
+        self.status = "ERROR"
+        self.attributes["exception.type"] = type(e).__name__
+        self.attributes["exception.message"] = str(e)[:500]
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        self.trace.append(self)
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_span_id": self.parent_span_id, "name": self.name,
+                "kind": self.kind, "start_time_unix_nano": self.start_ns, "end_time_unix_nano": self.end_ns,
+                "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3), "status": self.status, "attributes": self.attributes}
+
+
+# Span hijo del span en curso durante un bloque with (también dentro de funciones async). Si no se está trazando devuelve None
+class start_span:
+
+    def __init__(self, name: str, kind: str = "INTERNAL", attributes: dict = None):
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        parent = current_span.get()
+        if parent is not None:
+            self.span = parent.child(self.name, self.kind, self.attributes)
+            self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+        if exc is not None:
+            self.span.record_exception(exc)
+        current_span.reset(self.token)
+        self.span.end()
+        return False
+
+
+# Últimas trazas completas de este worker, para consultarlas sin salir de la API
+class Memory_Collector:
+
+    def __init__(self, max_traces: int = TRACE_MEMORY_TRACES):
+        self.max_traces = max_traces
+        self.traces = OrderedDict()
+
+    def export(self, spans: list):
+        trace_id = spans[0].trace_id
+        self.traces.setdefault(trace_id, []).extend(span.to_dict() for span in spans)
+        self.traces.move_to_end(trace_id)
+        while len(self.traces) > self.max_traces:
+            self.traces.popitem(last=False)
+
+    def recent(self, limit: int):
+        summaries = []
+        for trace_id, spans in reversed(self.traces.items()):
+            root = min(spans, key=lambda s: s["start_time_unix_nano"])
+            summaries.append({"trace_id": trace_id, "name": root["name"], "start_time_unix_nano": root["start_time_unix_nano"],
+                              "duration_ms": root["duration_ms"], "status": root["status"], "spans": len(spans)})
+            if len(summaries) >= limit:
+                break
+        return summaries
+
+    def get(self, trace_id: str):
+        return sorted(self.traces.get(trace_id, []), key=lambda s: s["start_time_unix_nano"])
+
+
+class Span_Formatter(logging.Formatter):
+
+    def format(self, record):
+        return "\n".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) for span in record.msg)
+
+
+# Exporta a TRACE_DIR/trazas-<pid>.ndjson, un fichero por worker para que la rotación no se pise entre procesos. Como los logs,
+# la escritura la hace un hilo aparte y se arranca en el primer uso de cada proceso (los hilos no sobreviven al fork de gunicorn)
+class File_Exporter:
+
+    def __init__(self, directory: str = TRACE_DIR):
+        self.directory = directory
+        self.pid = None
+        self.queue = None
+        self.listener = None
+
+    def _start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        handler = RotatingFileHandler(os.path.join(self.directory, f"trazas-{os.getpid()}.ndjson"), maxBytes=TRACE_FILE_MAX_BYTES,
+                                      backupCount=TRACE_FILE_BACKUPS, encoding="utf-8", delay=True)
+        handler.setFormatter(Span_Formatter())
+        self.queue = queue.SimpleQueue()
+        self.listener = QueueListener(self.queue, handler)
+        self.listener.start()
+        if self.pid is None:
+            atexit.register(self.stop)  # escribe antes lo que quede en la cola
+        self.pid = os.getpid()
+
+    def export(self, spans: list):
+        if self.pid != os.getpid():
+            self._start()
+        self.queue.put(logging.makeLogRecord({"msg": spans}))
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+
+
+memory_collector = Memory_Collector()
+file_exporter = File_Exporter()
+exporters = ([memory_collector] if "memory" in TRACE_EXPORTERS else []) + ([file_exporter] if "file" in TRACE_EXPORTERS else [])
+
+
+def export(spans: list):
+    for exporter in exporters:
+        try:
+            exporter.export(spans)
+        except Exception as e:
+            logger.warning("No se ha podido exportar la traza %s: %r", spans[0].trace_id, e)
+
+
+# Middleware ASGI que abre el span raíz de cada petición. Si llega una cabecera traceparent (W3C Trace Context) la petición
+# continúa esa traza y se traza si el cliente la ha marcado como muestreada; si no, se empieza una traza nueva con probabilidad
+# TRACE_SAMPLE_RATE. La respuesta lleva el traceparent de la petición para poder buscar su traza
+class Tracing_Middleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not exporters:
+            return await self.app(scope, receive, send)
+        trace_id, parent_id, sampled = None, None, None
+        for name, value in scope["headers"]:
+            if name == TRACEPARENT_HEADER:
+                match = TRACEPARENT.fullmatch(value.decode("latin-1").strip())
+                if match and match.group(1) != "0" * 32 and match.group(2) != "0" * 16:
+                    trace_id, parent_id, sampled = match.group(1), match.group(2), int(match.group(3), 16) & 1 == 1
+                break
+        if sampled is None:
+            sampled = random.random() < TRACE_SAMPLE_RATE
+        if not sampled:
+            return await self.app(scope, receive, send)
+
+        span = Span(scope["method"], trace_id or f"{random.getrandbits(128):032x}", parent_id, "SERVER",
+                    {"http.method": scope["method"], "http.target": scope["path"], "request_id": request_id_var.get()}, [])
+        header = (TRACEPARENT_HEADER, f"00-{span.trace_id}-{span.span_id}-01".encode("latin-1"))
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                span.attributes["http.status_code"] = message["status"]
+                if message["status"] >= 500:
+                    span.status = "ERROR"
+                message["headers"] = [*message.get("headers", []), header]
+            await send(message)
+
+        token = current_span.set(span)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            current_span.reset(token)
+            route = route_template(scope)
+            span.name = f"{scope['method']} {route}"
+            span.attributes["http.route"] = route
+            span.end()
+            export(list(span.trace))
+
+
+# Clase de ruta que envuelve cada endpoint en un span "handler <función>". Se asigna a app.router.route_class antes de
+# declarar los endpoints. FastAPI sigue viendo la firma original gracias a functools.wraps
+def traced_endpoint(endpoint):
+    name = f"handler {endpoint.__name__}"
+    attributes = {"code.function": endpoint.__name__}
+
+    @wraps(endpoint)
+    async def handler(*args, **kwargs):
+        with start_span(name, attributes=dict(attributes)):
+            return await endpoint(*args, **kwargs)
+
+    return handler
+
+
+class Traced_Route(APIRoute):
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, traced_endpoint(endpoint), **kwargs)
+
+
+# Texto de la sentencia sin saltos de línea ni espacios repetidos y con las listas de parámetros de los IN (...) resumidas, para
+# que la misma consulta salga igual en todas las trazas. Los valores nunca aparecen porque van como parámetros
+PARAMETER = r"(?:\$\d+(?:::\w+)?|%\(\w+\)s)"  # $1::VARCHAR con asyncpg, %(name_1)s con psycopg2
+PARAMETER_LIST = re.compile(rf"({PARAMETER})(?:, {PARAMETER})+")
+
+
+@lru_cache(maxsize=1024)
+def normalize_statement(statement: str):
+    return PARAMETER_LIST.sub(r"\1, ...", " ".join(statement.split()))[:TRACE_MAX_STATEMENT]
+
+
+# Un span por cada sentencia SQL del engine que usan los endpoints
+def trace_engine(sync_engine):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        parent = current_span.get()
+        if parent is not None:
+            text = normalize_statement(statement)
+            context._trace_span = parent.child("db.query", "CLIENT", {"db.system": "postgresql", "db.statement": text,
+                                                                        "db.operation": text.split(" ", 1)[0].upper()})
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_trace_span", None)
+        if span is not None:
+            if cursor.rowcount is not None and cursor.rowcount >= 0:
+                span.attributes["db.rows"] = cursor.rowcount
+            span.end()
+            context._trace_span = None
+
+    @event.listens_for(sync_engine, "handle_error")
+    def on_error(exception_context):
+        context = exception_context.execution_context
+        span = getattr(context, "_trace_span", None) if context is not None else None
+        if span is not None:
+            span.record_exception(exception_context.original_exception)
+            span.end()
+            context._trace_span = None
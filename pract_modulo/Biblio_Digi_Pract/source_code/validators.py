@@ -1,8 +1,9 @@
 from .database import *
 from .models import *
 
-from pydantic import BaseModel, Field, field_validator, model_validator, EmailStr
-from typing import Optional, List 
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator, EmailStr
+from typing import Optional, List, Dict, Literal, Union, Annotated, Any, Generic, TypeVar
+from datetime import datetime
 
 class Book(BaseModel):
     
@@ -90,6 +91,43 @@ class Loan(BaseModel):
             raise ValueError("Un préstamo debe ser por lo menos de un libro o de una película")
         return instance
 
+# Préstamo de varios artículos a la vez (POST /Prestamos/Lote)
+class LoanBatch(BaseModel):
+    
+    user_id: int = Field(..., description="Id del usuario que realiza el préstamo")
+    book_ref_numbers: List[int] = Field(default_factory=list, description="Referencias de los libros que se quieren alquilar")
+    film_ref_numbers: List[int] = Field(default_factory=list, description="Referencias de las películas que se quieren alquilar")
+    all_or_nothing: bool = Field(False, description="Si es true, o se prestan todos los artículos o ninguno")
+    
+    @model_validator(mode= "after")
+    def loan_minimum_items(cls, instance):
+        if not(instance.book_ref_numbers) and not(instance.film_ref_numbers):
+            raise ValueError("Un préstamo debe ser por lo menos de un libro o de una película")
+        # Cada referencia es un ejemplar, si se repite solo se prestaría uno sin avisar de que falta el resto
+        if len(set(instance.book_ref_numbers)) != len(instance.book_ref_numbers):
+            raise ValueError("Hay referencias de libros repetidas")
+        if len(set(instance.film_ref_numbers)) != len(instance.film_ref_numbers):
+            raise ValueError("Hay referencias de películas repetidas")
+        return instance
+
+# Alta de ejemplares de un libro o una película. Se indica cuántos o directamente sus códigos de barras
+class Copies(BaseModel):
+    
+    copies: Optional[int] = Field(None, ge=1, description="Número de ejemplares nuevos, por defecto uno por código de barras o uno si no se indican")
+    barcodes: Optional[List[Annotated[str, Field(min_length=1, max_length=40)]]] = Field(None, description="Códigos de barras de los ejemplares (opcional), si no se indican los genera la BDD")
+    
+    @model_validator(mode= "after")
+    def copies_and_barcodes(cls, instance):
+        if instance.barcodes:
+            if len(set(instance.barcodes)) != len(instance.barcodes):
+                raise ValueError("Hay códigos de barras repetidos")
+            if instance.copies is not None and instance.copies != len(instance.barcodes):
+                raise ValueError("El número de ejemplares no coincide con el de códigos de barras")
+            instance.copies = len(instance.barcodes)
+        elif instance.copies is None:
+            instance.copies = 1
+        return instance
+
 class Genre(BaseModel):
     
     # genre_id: int = Field(..., description="Id del usuario en el sistema") # Este campo no es necesario para el Pydantic Model si la DB lo auto-genera
@@ -99,4 +137,167 @@ class Genre(BaseModel):
     def genrename_with_vowels(cls, value):
         if not any(vowel in value.lower() for vowel in ["a", "e", "i", "o", "u"]):
             raise ValueError("El nombre del género debe contener vocales!") 
-        return value
\ No newline at end of file
+        return value
+
+
+# Resultados de la búsqueda en el catálogo (GET /Buscar). Cada resultado lleva un campo type que indica si es un libro o una
+# película, así el cliente sabe qué campos tiene cada uno
+class BookResult(BaseModel):
+
+    type: Literal["book"] = "book"
+    ref_number: int
+    name: str
+    author: Optional[str] = None
+    genre_id: int
+    available: bool
+    total_copies: int
+    available_copies: int
+    rank: float = Field(..., description="Relevancia del resultado entre 0 y 1")
+
+class FilmResult(BaseModel):
+
+    type: Literal["film"] = "film"
+    ref_number: int
+    name: str
+    actors: Optional[str] = None
+    genre_id: int
+    available: bool
+    total_copies: int
+    available_copies: int
+    rank: float = Field(..., description="Relevancia del resultado entre 0 y 1")
+
+class SearchResults(BaseModel):
+
+    query: str
+    results: List[Annotated[Union[BookResult, FilmResult], Field(discriminator="type")]]
+    suggestions: List[str] = Field(default_factory=list, description="Si no hay resultados, nombres y autores parecidos a lo buscado")
+
+
+# Esquemas de las respuestas de la API. Se construyen directamente desde los objetos del ORM o las filas que devuelve la BDD
+# (from_attributes) y FastAPI los serializa con pydantic, mucho más rápido que recorrer el __dict__ de cada objeto con
+# jsonable_encoder. Además solo salen los campos que aparecen aquí, por ejemplo la contraseña cifrada de los usuarios no sale nunca
+class UserResponse(BaseModel):
+
+    model_config = ConfigDict(from_attributes=True)
+    user_id: int
+    full_name: str
+    contact_mail: str
+    age: Optional[int] = None
+    date_added: Optional[datetime] = None
+
+class BookResponse(BaseModel):
+
+    model_config = ConfigDict(from_attributes=True)
+    ref_number: int
+    name: str
+    author: Optional[str] = None
+    genre_id: int
+    total_copies: int
+    available_copies: int
+    available: bool
+    date_registered: Optional[datetime] = None
+
+class FilmResponse(BaseModel):
+
+    model_config = ConfigDict(from_attributes=True)
+    ref_number: int
+    name: str
+    actors: Optional[str] = None
+    genre_id: int
+    total_copies: int
+    available_copies: int
+    available: bool
+    date_registered: Optional[datetime] = None
+
+class GenreResponse(BaseModel):
+
+    model_config = ConfigDict(from_attributes=True)
+    genre_id: int
+    genre_name: str
+
+class CopyResponse(BaseModel):
+
+    model_config = ConfigDict(from_attributes=True)
+    copy_id: int
+    barcode: str
+    book_ref_number: Optional[int] = None
+    film_ref_number: Optional[int] = None
+    on_loan: bool
+    date_added: Optional[datetime] = None
+
+class NewCopy(BaseModel):
+
+    copy_id: int
+    barcode: str
+
+# Título con sus contadores después de dar de alta ejemplares, y los ejemplares nuevos
+class NewCopiesResponse(BaseModel):
+
+    ref_number: int
+    name: str
+    total_copies: int
+    available_copies: int
+    copies: List[NewCopy]
+
+class LoanResponse(BaseModel):
+
+    model_config = ConfigDict(from_attributes=True)
+    loan_id: int
+    loan_date: Optional[datetime] = None
+    user_id: int
+    book_ref_number: Optional[int] = None
+    film_ref_number: Optional[int] = None
+    return_date: Optional[datetime] = None
+
+class LoanItemResponse(BaseModel):
+
+    loan_item_id: int
+    book_ref_number: Optional[int] = None
+    film_ref_number: Optional[int] = None
+    copy_id: Optional[int] = None
+    barcode: Optional[str] = None
+    return_date: Optional[datetime] = None
+
+# Préstamo con los artículos prestados o devueltos en la petición
+class LoanDetailResponse(LoanResponse):
+
+    items: List[LoanItemResponse]
+
+# Artículo que no se ha podido prestar: 404 si no existe y 409 si no le quedan ejemplares libres
+class LoanFailure(BaseModel):
+
+    book_ref_number: Optional[int] = None
+    film_ref_number: Optional[int] = None
+    status: int
+    detail: str
+
+class CheckoutResponse(LoanDetailResponse):
+
+    failed: List[LoanFailure] = Field(default_factory=list)
+
+class ReturnSummary(BaseModel):
+
+    returned: int = Field(..., description="Artículos devueltos")
+    loans: List[LoanDetailResponse]
+
+class BulkError(BaseModel):
+
+    line: int
+    name: Any = None
+    detail: Union[str, List[str]]
+
+class BulkSummary(BaseModel):
+
+    received: int
+    inserted: int
+    error_count: int
+    errors: List[BulkError] = Field(..., description="Primeros errores, como mucho BULK_MAX_ERRORS")
+
+
+T = TypeVar("T")
+
+# Página de un listado paginado por cursor (ver pagination.py)
+class Page(BaseModel, Generic[T]):
+
+    items: List[T]
+    next_cursor: Optional[str] = Field(None, description="Cursor para pedir la página siguiente, null si es la última")